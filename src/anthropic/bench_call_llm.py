@@ -0,0 +1,84 @@
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+# Modules shared by both servers and the router (metrics, clients, storage, ...) live in src/common
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "common"))
+
+from anthropic import AsyncAnthropic
+
+import call_llm
+from stub_anthropic import start_stub
+
+SYSTEM = "You are a helpful University counselor that gives advice."
+
+
+async def per_call_client(system_message: str, messages: list) -> str:
+    """The previous call_llm: a fresh client (and connection) for every call"""
+    client = AsyncAnthropic(api_key=os.getenv("ANTHROPIC_API_KEY"), base_url=os.getenv("ANTHROPIC_BASE_URL"))
+    message = await client.messages.create(
+        max_tokens=256,
+        system=system_message,
+        messages=messages,
+        model="claude-sonnet-4-20250514",
+    )
+    return message.content[0].text
+
+
+async def run(name: str, call, requests: int, stub) -> None:
+    for key in stub.stats:
+        stub.stats[key] = 0
+    stub.transports.clear()
+
+    latencies = []
+    errors = 0
+
+    async def one(i):
+        nonlocal errors
+        start = time.perf_counter()
+        try:
+            await call(SYSTEM, [{"role": "user", "content": f"Question {i}"}])
+            latencies.append(time.perf_counter() - start)
+        except Exception:
+            errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*[one(i) for i in range(requests)])
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    p50 = latencies[len(latencies) // 2] if latencies else float("nan")
+    p95 = latencies[int(len(latencies) * 0.95) - 1] if latencies else float("nan")
+    print(f"{name:<16} {elapsed:>8.2f}s {requests / elapsed:>9.1f} {p50 * 1000:>9.0f} {p95 * 1000:>9.0f} "
+          f"{errors:>7} {stub.stats['connections']:>6} {stub.stats['rate_limited'] + stub.stats['overloaded']:>9}")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Pooled call_llm vs. a new client per call, against the offline stub")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--rate-limit-ratio", type=float, default=0.1)
+    parser.add_argument("--max-concurrent", type=int, default=0)
+    args = parser.parse_args()
+
+    os.environ["ANTHROPIC_BASE_URL"] = f"http://localhost:{args.port}"
+    os.environ.setdefault("ANTHROPIC_API_KEY", "stub-key")
+
+    stub, runner = await start_stub(args.port, latency=args.latency, jitter=args.latency / 5,
+                                    rate_limit_ratio=args.rate_limit_ratio, retry_after=0.1,
+                                    max_concurrent=args.max_concurrent)
+    try:
+        print(f"{'client':<16} {'wall':>9} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'errors':>7} {'conns':>6} {'throttled':>9}")
+        await run("per-call", per_call_client, args.requests, stub)
+        await run("pooled", call_llm.call_llm, args.requests, stub)
+        print(f"\npooled call_llm stats: {call_llm.stats}")
+    finally:
+        await call_llm.close_client()
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
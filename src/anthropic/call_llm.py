@@ -1,18 +1,173 @@
 import os
 import asyncio
-from anthropic import AsyncAnthropic
+import random
+import sys
+import time
+from email.utils import parsedate_to_datetime
+
+from anthropic import (AsyncAnthropic, APIConnectionError, APIStatusError, DefaultAsyncHttpxClient,
+                       DEFAULT_CONNECTION_LIMITS, Timeout)
 from dotenv import load_dotenv
 
+# Modules shared by both servers and the router (metrics, clients, storage, ...) live in src/common
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "common"))
+
+from metrics import REGISTRY
+
 load_dotenv()
-async def call_llm(system_message: str, messages: list) -> str:
-    client = AsyncAnthropic(api_key=os.getenv("ANTHROPIC_API_KEY"))
-    message = await client.messages.create(
-        max_tokens=256,
-        system=system_message,
-        messages=messages,
-        model="claude-sonnet-4-20250514",
-    )
-    return message.content[0].text
+
+API_REQUEST_SECONDS = REGISTRY.histogram("anthropic_request_seconds", "Time for one Messages API attempt", ["outcome"])
+CONCURRENCY_WAIT = REGISTRY.histogram("anthropic_concurrency_wait_seconds",
+                                      "Time waiting for a free slot under ANTHROPIC_MAX_CONCURRENCY")
+RETRIES = REGISTRY.counter("anthropic_retries_total", "Retried Messages API attempts", ["reason"])
+API_TOKENS = REGISTRY.counter("anthropic_tokens_total", "Tokens reported by the Messages API", ["kind"])
+
+# One client (and connection pool) per process instead of one per call
+MAX_CONCURRENCY = int(os.getenv("ANTHROPIC_MAX_CONCURRENCY", "16"))  # Requests in flight at once
+MAX_CONNECTIONS = int(os.getenv("ANTHROPIC_MAX_CONNECTIONS", "32"))
+MAX_RETRIES = int(os.getenv("ANTHROPIC_MAX_RETRIES", "5"))
+RETRY_BASE_DELAY = 0.5  # Seconds; doubled on every attempt
+RETRY_MAX_DELAY = 30.0
+
+# The SDK's own Limits class (httpx or httpx2, depending on the SDK version)
+Limits = type(DEFAULT_CONNECTION_LIMITS)
+
+# 429 rate limited, 529 overloaded, plus transient server errors
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504, 529}
+
+_client = None
+_semaphore = None
+_client_loop = None
+
+# Offline mode (set with configure_mock) answers after a delay without calling the API
+_mock = None
+
+stats = {"calls": 0, "attempts": 0, "retries": 0, "failures": 0}
+
+
+def get_client() -> AsyncAnthropic:
+    """The shared client; recreated if the event loop changes (pooled connections belong to one loop)"""
+    global _client, _semaphore, _client_loop
+    loop = asyncio.get_running_loop()
+    if _client is None or _client_loop is not loop:
+        http_client = DefaultAsyncHttpxClient(
+            limits=Limits(
+                max_connections=MAX_CONNECTIONS,
+                max_keepalive_connections=MAX_CONNECTIONS,
+                keepalive_expiry=60.0,
+            ),
+        )
+        _client = AsyncAnthropic(
+            api_key=os.getenv("ANTHROPIC_API_KEY"),
+            base_url=os.getenv("ANTHROPIC_BASE_URL") or None,
+            http_client=http_client,
+            timeout=Timeout(60.0, connect=5.0),
+            max_retries=0,  # Retries are handled below so they can honor retry-after and release the semaphore
+        )
+        _semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+        _client_loop = loop
+    return _client
+
+
+async def close_client():
+    global _client, _client_loop
+    if _client is not None:
+        await _client.close()
+        _client = None
+        _client_loop = None
+
+
+def configure_mock(latency: float, jitter: float = 0.0, response_words: int = 32):
+    """
+    Replace API calls with canned answers so server overhead can be benchmarked offline
+    Args:
+        latency: Mean seconds per call
+        jitter: Standard deviation of the latency
+        response_words: Length of the canned answer
+    """
+    global _mock
+    _mock = {"latency": latency, "jitter": jitter, "response_words": response_words}
+
+
+async def _mock_call(messages: list) -> str:
+    await asyncio.sleep(max(0.0, random.gauss(_mock["latency"], _mock["jitter"])))
+    question = messages[-1]["content"] if messages else ""
+    return f"Mock answer to: {question[:40]} " + " ".join(["lorem"] * _mock["response_words"])
+
+
+def retry_delay(attempt: int, error: Exception) -> float:
+    """Server-requested delay from retry-after headers, else jittered exponential backoff"""
+    response = getattr(error, "response", None)
+    if response is not None:
+        retry_after_ms = response.headers.get("retry-after-ms")
+        retry_after = response.headers.get("retry-after")
+        try:
+            if retry_after_ms is not None:
+                return min(float(retry_after_ms) / 1000, RETRY_MAX_DELAY)
+            if retry_after is not None:
+                return min(float(retry_after), RETRY_MAX_DELAY)
+        except ValueError:
+            try:
+                return min(max(parsedate_to_datetime(retry_after).timestamp() - time.time(), 0), RETRY_MAX_DELAY)
+            except (TypeError, ValueError):
+                pass
+
+    # Full jitter keeps many clients that failed together from retrying together
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+
+def is_retryable(error: Exception) -> bool:
+    if isinstance(error, APIStatusError):
+        return error.status_code in RETRYABLE_STATUS_CODES
+    return isinstance(error, APIConnectionError)
+
+
+def outcome_label(error: Exception) -> str:
+    if isinstance(error, APIStatusError):
+        return str(error.status_code)
+    return type(error).__name__
+
+
+async def call_llm(system_message: str, messages: list, max_tokens: int = 256) -> str:
+    stats["calls"] += 1
+    if _mock is not None:
+        with API_REQUEST_SECONDS.time(outcome="mock"):
+            return await _mock_call(messages)
+
+    client = get_client()
+
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            # Only the request itself holds a concurrency slot, not the backoff sleep
+            wait_start = time.perf_counter()
+            async with _semaphore:
+                start = time.perf_counter()
+                CONCURRENCY_WAIT.observe(start - wait_start)
+                stats["attempts"] += 1
+                outcome = "ok"
+                try:
+                    message = await client.messages.create(
+                        max_tokens=max_tokens,
+                        system=system_message,
+                        messages=messages,
+                        model="claude-sonnet-4-20250514",
+                    )
+                except Exception as e:
+                    outcome = outcome_label(e)
+                    raise
+                finally:
+                    API_REQUEST_SECONDS.observe(time.perf_counter() - start, outcome=outcome)
+            API_TOKENS.inc(message.usage.input_tokens, kind="input")
+            API_TOKENS.inc(message.usage.output_tokens, kind="output")
+            return message.content[0].text
+        except Exception as e:
+            if attempt == MAX_RETRIES or not is_retryable(e):
+                stats["failures"] += 1
+                raise
+            stats["retries"] += 1
+            RETRIES.inc(reason=outcome_label(e))
+            await asyncio.sleep(retry_delay(attempt, e))
+
 
 async def call_llm_simple(prompt: str) -> str:
     system_message = "You are a helpful University counselor that give advices. Please keep your response short (less than 100 words), concise, straight to the point."
@@ -27,4 +182,4 @@ async def call_llm_simple(prompt: str) -> str:
 if __name__ == "__main__":
     result = asyncio.run(call_llm_simple('Can you tell me why I suck'))
 
-    print('Call Result:', result)
\ No newline at end of file
+    print('Call Result:', result)
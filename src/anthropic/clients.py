@@ -1,6 +1,13 @@
+import argparse
 import asyncio
-import aiohttp
+import os
 import random
+import sys
+
+# Modules shared by both servers and the router (metrics, clients, storage, ...) live in src/common
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "common"))
+
+from counseling_client import ANTHROPIC_URL, CounselingClient
 
 # Available users (matching server's UserDatabase)
 USERS = ['Linda', 'Miguel', 'Mike']
@@ -17,13 +24,8 @@ SAMPLE_QUESTIONS = [
     "What are good mental health practices?",
 ]
 
-async def ask_question(session, user, question):
-    async with session.post('http://localhost:8080/ask', 
-                          json={'user': user, 'question': question}) as resp:
-        return await resp.json()
-
-async def main():
-    async with aiohttp.ClientSession() as session:
+async def main(url: str):
+    async with CounselingClient(url) as client:
         print("Enter the amount of concurrent user calls (Ctrl+C to exit)")
         while True:
             try:
@@ -33,23 +35,21 @@ async def main():
                     print("Please enter a number between 1 and 10")
                     continue
                 
-                # Create list of concurrent tasks
-                tasks = []
+                # Create list of concurrent requests
+                items = []
                 for _ in range(n_calls):
                     user = random.choice(USERS)
                     question = random.choice(SAMPLE_QUESTIONS)
                     print(f"Queuing request as {user}: {question}")
-                    tasks.append(ask_question(session, user, question))
-                
-                # Execute all tasks concurrently and wait for results
-                # Create a list to collect responses
-                responses = []
-                # Wait for responses and print them as they arrive
+                    items.append((user, question))
+
+                # Send them all at once and print responses as they arrive
                 i = 1
-                for task in asyncio.as_completed(tasks):
-                    response = await task
-                    responses.append(response)
-                    print(f"{i}. LLM Response to {response['user']}: {response['response']}\n")
+                async for response in client.ask_many(items, concurrency=n_calls):
+                    if 'error' in response:
+                        print(f"{i}. Error for {response['user']}: {response['error']}\n")
+                    else:
+                        print(f"{i}. LLM Response to {response['user']}: {response['response']}\n")
                     i += 1
 
             except KeyboardInterrupt:
@@ -61,4 +61,7 @@ async def main():
                 print(f"Error: {e}")
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    parser = argparse.ArgumentParser(description="Send concurrent questions to the counseling server")
+    parser.add_argument("--url", default=ANTHROPIC_URL, help="Server address")
+    args = parser.parse_args()
+    asyncio.run(main(args.url))
@@ -1,41 +1,102 @@
-from typing import Dict, List
+from typing import Dict, List, Tuple
+from collections import OrderedDict
 from datetime import datetime
-import json
-import os
+import threading
+
+from context_builder import ContextBuilder, summary_message
+from conversation_store import ConversationStore
+from metrics import REGISTRY
+
+# Approximate resident size of a message beyond its content: the dict, the role and timestamp strings
+MESSAGE_OVERHEAD_BYTES = 400
+HISTORY_OVERHEAD_BYTES = 200
+
+HISTORY_CACHE_BYTES = REGISTRY.gauge("conversation_cache_bytes", "Estimated size of the histories held in memory")
+HISTORY_CACHE_EVICTIONS = REGISTRY.counter("conversation_cache_evictions_total",
+                                           "Histories dropped from memory to stay under the cache limit")
+
+
+def history_bytes(history: List[Dict]) -> int:
+    return HISTORY_OVERHEAD_BYTES + sum(len(msg["content"]) + MESSAGE_OVERHEAD_BYTES for msg in history)
+
 
 class ConversationMemory:
-    def __init__(self, storage_file: str = "conversations.json"):
+    SYSTEM_PROMPT_TEMPLATE = "You are a helpful University counselor that gives advice. The user is a university {user_role}. Please keep your response short (less than 100 words), concise, straight to the point."
+
+    def __init__(self, storage_file: str = "conversations.json", compact_every: int = 1000,
+                 max_cached_bytes: int = 256 * 2 ** 20):
+        """
+        Args:
+            storage_file: Base path of the conversation log and the per-user files
+            compact_every: Logged records between compactions
+            max_cached_bytes: Estimated memory the histories may take; the least recently used are dropped beyond it
+                and read from disk again when next needed
+        """
         self.storage_file = storage_file
-        self.conversations: Dict[str, List[Dict]] = {}
+        self.max_cached_bytes = max_cached_bytes
+        # Histories in use, least recently used first; the rest stay on disk until someone asks for them
+        self.conversations: "OrderedDict[str, List[Dict]]" = OrderedDict()
+        self.cached_bytes = 0
+        self._sizes: Dict[str, int] = {}
+        self.hits = 0
+        self.evictions = 0
+        self.lock = threading.Lock()  # Guards conversations and the cache accounting
+        self.store = ConversationStore(storage_file, compact_every=compact_every)
         self._load_conversations()
 
     def _load_conversations(self):
-        if os.path.exists(self.storage_file):
-            try:
-                with open(self.storage_file, 'r') as f:
-                    self.conversations = json.load(f)
-            except (json.JSONDecodeError, FileNotFoundError):
-                self.conversations = {}
+        # Only the log tail is read at startup; each history is read on first access
+        self.store.load()
 
     def _save_conversations(self):
-        with open(self.storage_file, 'w') as f:
-            json.dump(self.conversations, f, indent=2)
+        """Block until every change so far is on disk (changes are written in the background)"""
+        self.store.flush()
+
+    def _history(self, user: str) -> List[Dict]:
+        """A user's history, read from disk if it isn't cached (call with the lock held)"""
+        history = self.conversations.get(user)
+        if history is not None:
+            self.conversations.move_to_end(user)
+            self.hits += 1
+            return history
+        history = self.store.load_user(user)
+        self.conversations[user] = history
+        self._resize(user)
+        return history
+
+    def _resize(self, user: str, size: int = None):
+        """Record a cached history's size (counted if not given) and evict others while over the limit"""
+        if size is None:
+            size = history_bytes(self.conversations[user])
+        self.cached_bytes += size - self._sizes.get(user, 0)
+        self._sizes[user] = size
+        # Everything is on disk or in the store's pending records, so eviction never loses a change
+        while self.cached_bytes > self.max_cached_bytes and len(self.conversations) > 1:
+            evicted, history = self.conversations.popitem(last=False)
+            if evicted == user:
+                # The history being changed is never the one dropped
+                self.conversations[user] = history
+                continue
+            self.cached_bytes -= self._sizes.pop(evicted)
+            self.evictions += 1
+            HISTORY_CACHE_EVICTIONS.inc()
+        HISTORY_CACHE_BYTES.set(self.cached_bytes)
 
     def get_conversation_history(self, user: str) -> List[Dict]:
-        return self.conversations.get(user, [])
+        with self.lock:
+            return self._history(user)
 
     def add_message(self, user: str, role: str, content: str):
-        if user not in self.conversations:
-            self.conversations[user] = []
-
         message = {
             "role": role,
             "content": content,
             "timestamp": datetime.now().isoformat()
         }
 
-        self.conversations[user].append(message)
-        self._save_conversations()
+        with self.lock:
+            self._history(user).append(message)
+            self.store.append({"op": "add", "user": user, "message": message})
+            self._resize(user, self._sizes[user] + len(content) + MESSAGE_OVERHEAD_BYTES)
 
     def add_user_message(self, user: str, content: str):
         self.add_message(user, "user", content)
@@ -43,25 +104,99 @@ class ConversationMemory:
     def add_assistant_message(self, user: str, content: str):
         self.add_message(user, "assistant", content)
 
+    def add_turn(self, user: str, question: str, answer: str):
+        """Store a question together with its answer, so a question that never got one is never stored"""
+        with self.lock:
+            history = self._history(user)
+            size = self._sizes[user]
+            for role, content in (("user", question), ("assistant", answer)):
+                message = {
+                    "role": role,
+                    "content": content,
+                    "timestamp": datetime.now().isoformat()
+                }
+                history.append(message)
+                self.store.append({"op": "add", "user": user, "message": message})
+                size += len(content) + MESSAGE_OVERHEAD_BYTES
+            self._resize(user, size)
+
+    def replace_with_summary(self, user: str, replaced: List[Dict], summary: str, replaced_tokens: int) -> bool:
+        """
+        Replace the oldest messages of a history with one summary message
+        Args:
+            user: Whose history
+            replaced: The messages the summary covers, as read from the start of the history
+            summary: Summary text
+            replaced_tokens: Tokens the replaced turns took up (kept to report prompt savings)
+        Returns:
+            False if the history no longer starts with those messages (e.g. it was cleared meanwhile)
+        """
+        message = {
+            "role": "summary",
+            "content": summary,
+            "replaced_tokens": replaced_tokens,
+            "timestamp": datetime.now().isoformat()
+        }
+
+        with self.lock:
+            # A history dropped from the cache since it was read is a different list now, so this fails too
+            history = self.conversations.get(user, [])
+            if len(history) < len(replaced) or any(a is not b for a, b in zip(history, replaced)):
+                return False
+            history[:len(replaced)] = [message]
+            self.store.append({"op": "summarize", "user": user, "count": len(replaced), "message": message})
+            self._resize(user)
+        return True
+
     def clear_conversation(self, user: str):
-        if user in self.conversations:
-            del self.conversations[user]
-            self._save_conversations()
+        with self.lock:
+            # A history that isn't cached may still be on disk, so it is cleared without reading it first
+            if self.conversations.get(user) != []:
+                self.conversations[user] = []
+                self.conversations.move_to_end(user)
+                self.store.append({"op": "clear", "user": user})
+                self._resize(user)
+
+    def stats(self) -> Dict:
+        return {
+            "cached_users": len(self.conversations),
+            "cached_bytes": self.cached_bytes,
+            "max_cached_bytes": self.max_cached_bytes,
+            "hits": self.hits,
+            "loads": self.store.user_loads,
+            "evictions": self.evictions,
+            "store": self.store.stats(),
+        }
 
     def get_messages_for_api(self, user: str, user_role: str) -> tuple[str, List[Dict]]:
         history = self.get_conversation_history(user)
 
         # System message content
-        system_content = f"You are a helpful University counselor that gives advice. The user is a university {user_role}. Please keep your response short (less than 100 words), concise, straight to the point."
+        system_content = self.SYSTEM_PROMPT_TEMPLATE.format(user_role=user_role)
 
         messages = []
 
         # Add conversation history (excluding timestamps and system messages)
         for msg in history:
-            if msg["role"] in ["user", "assistant"]:
+            if msg["role"] == "summary":
+                messages.append(summary_message(msg))
+            elif msg["role"] in ["user", "assistant"]:
                 messages.append({
                     "role": msg["role"],
                     "content": msg["content"]
                 })
 
-        return system_content, messages
\ No newline at end of file
+        return system_content, messages
+
+    def get_context_for_api(self, user: str, user_role: str, builder: ContextBuilder,
+                            question: str = None) -> Tuple[str, List[Dict]]:
+        """
+        Like get_messages_for_api, but only the newest turns that fit the builder's token budget
+        Args:
+            question: A new question, not stored yet, to end the messages with (see add_turn)
+        """
+        system_content = self.SYSTEM_PROMPT_TEMPLATE.format(user_role=user_role)
+        history = self.get_conversation_history(user)
+        if question is not None:
+            history = history + [{"role": "user", "content": question}]
+        return system_content, builder.build(system_content, history)
@@ -1,83 +1,184 @@
-import os
-import aiofiles
-import asyncio
-from pocketflow import AsyncFlow, AsyncParallelBatchNode
 import asyncio
+from pocketflow import AsyncParallelBatchNode
 from dataclasses import dataclass
-from typing import Dict, Any
+from datetime import datetime
+from typing import Dict, Any, List
 
 from call_llm import call_llm
+from metrics import REGISTRY
+from response_cache import ResponseCache
 
 @dataclass
 class UserRequest:
     user: str
     question: str
-    response_queue: asyncio.Queue  # To send response back to client
+    response: asyncio.Future  # Resolved with the result dict for the client
+    enqueued_at: float = 0.0  # Event loop time when the request was queued
+    queue_wait: float = 0.0   # Seconds spent in the queue before its batch was dispatched
+
+BATCH_QUEUE_WAIT = REGISTRY.histogram("batch_queue_wait_seconds", "Time a request waited for its micro-batch to flush")
+BATCH_SIZE = REGISTRY.histogram("batch_size", "Requests per dispatched micro-batch", buckets=(1, 2, 4, 8, 16, 32, 64))
+BATCH_QUEUE_DEPTH = REGISTRY.gauge("batch_queue_depth", "Requests waiting for a micro-batch")
 
 UserDataBase = {'Linda': 'Student',
                 'Miguel': 'Counselor',
                 'Mike': 'Athlete'}
 
 class RequestHandler:
-    def __init__(self):
+    '''Collects incoming requests into micro-batches and runs each batch through ParallelNode.
+
+        A batch is flushed as soon as it holds batch_size requests, or when its oldest
+        request has waited max_wait seconds, whichever comes first. Batches are
+        dispatched without waiting for the previous one to finish.
+    '''
+    def __init__(self, memory, context_builder, user_roles: Dict[str, str] = None,
+                 batch_size: int = 8, max_wait: float = 0.05, response_cache: ResponseCache = None):
+        """
+        Args:
+            memory: ConversationMemory used for history and to store answers
+            context_builder: ContextBuilder that fits each history into the prompt budget
+            user_roles: User name -> role used in the system prompt
+            batch_size: Flush once this many requests are queued
+            max_wait: Flush once the oldest queued request has waited this long (seconds)
+            response_cache: Optional cache consulted before calling the LLM
+        """
+        self.memory = memory
+        self.context_builder = context_builder
+        self.user_roles = user_roles or UserDataBase
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.response_cache = response_cache
+
         self.request_queue = asyncio.Queue()
-        self.batch_size = 3  # Process requests in batches
         self.processing = False
+        self._worker = None
+        self._batches = set()
+        self.stats = {"batches": 0, "requests": 0, "full_flushes": 0, "deadline_flushes": 0,
+                      "total_queue_wait": 0.0, "max_queue_wait": 0.0}
+
+    def start(self):
+        if self._worker is None:
+            self.processing = True
+            self._worker = asyncio.create_task(self.process_requests())
+
+    async def stop(self):
+        self.processing = False
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+        if self._batches:
+            await asyncio.gather(*self._batches, return_exceptions=True)
 
     async def add_request(self, user: str, question: str) -> Dict[str, Any]:
-        # Create response queue for this specific request
-        response_queue = asyncio.Queue()
-        await self.request_queue.put(UserRequest(user, question, response_queue))
-        
+        loop = asyncio.get_running_loop()
+        request = UserRequest(user, question, loop.create_future(), enqueued_at=loop.time())
+        await self.request_queue.put(request)
+
         # Wait for response
-        response = await response_queue.get()
-        return response
+        return await request.response
 
     async def process_requests(self):
-        self.processing = True
+        loop = asyncio.get_running_loop()
         while self.processing:
-            batch = []
-            try:
-                # Collect batch_size requests or wait for 2 seconds
-                while len(batch) < self.batch_size:
-                    try:
-                        request = await asyncio.wait_for(self.request_queue.get(), timeout=2.0)
-                        batch.append(request)
-                    except asyncio.TimeoutError:
-                        break
-
-                if batch:
-                    # Process batch with ParallelNode
-                    node = ParallelNode()
-                    shared = {
-                        "requests": batch
-                    }
-                    results = await node.process(shared)
-                    
-                    # Send responses back to clients
-                    for request, result in zip(batch, results):
-                        await request.response_queue.put(result)
-                        
-            except Exception as e:
-                print(f"Error processing batch: {e}")
+            # Block for the first request; its arrival time sets the batch deadline
+            batch = [await self.request_queue.get()]
+            deadline = batch[0].enqueued_at + self.max_wait
+
+            while len(batch) < self.batch_size:
+                remaining = deadline - loop.time()
+                if remaining <= 0 and self.request_queue.empty():
+                    break
+                try:
+                    if remaining <= 0:
+                        batch.append(self.request_queue.get_nowait())
+                    else:
+                        batch.append(await asyncio.wait_for(self.request_queue.get(), timeout=remaining))
+                except (asyncio.TimeoutError, asyncio.QueueEmpty):
+                    break
+
+            dispatched_at = loop.time()
+            for request in batch:
+                request.queue_wait = dispatched_at - request.enqueued_at
+            self._record_batch(batch)
+
+            task = asyncio.create_task(self._run_batch(batch))
+            self._batches.add(task)
+            task.add_done_callback(self._batches.discard)
+
+    def _record_batch(self, batch: List[UserRequest]):
+        BATCH_SIZE.observe(len(batch))
+        BATCH_QUEUE_DEPTH.set(self.request_queue.qsize())
+        self.stats["batches"] += 1
+        self.stats["requests"] += len(batch)
+        self.stats["full_flushes" if len(batch) >= self.batch_size else "deadline_flushes"] += 1
+        for request in batch:
+            BATCH_QUEUE_WAIT.observe(request.queue_wait)
+            self.stats["total_queue_wait"] += request.queue_wait
+            self.stats["max_queue_wait"] = max(self.stats["max_queue_wait"], request.queue_wait)
+
+    async def _run_batch(self, batch: List[UserRequest]):
+        current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        print(f"[{current_time}] Dispatching batch of {len(batch)} "
+              f"(oldest waited {max(r.queue_wait for r in batch) * 1000:.1f} ms)")
+
+        shared = {
+            "requests": batch,
+            "memory": self.memory,
+            "context_builder": self.context_builder,
+            "user_roles": self.user_roles,
+            "response_cache": self.response_cache,
+        }
+        try:
+            results = await ParallelNode().run_async(shared)
+        except Exception as e:
+            print(f"[{current_time}] Error processing batch: {e}")
+            results = [{'user': request.user, 'error': str(e)} for request in batch]
+
+        # Send responses back to clients
+        for request, result in zip(batch, results):
+            if request.response.done():
+                continue
+            result['queue_wait'] = request.queue_wait
+            request.response.set_result(result)
 
 class ParallelNode(AsyncParallelBatchNode):
     '''Takes multiple user calls and return llm response in parallel
-        Workflow: prep, exec, clean up.    
+        Workflow: prep (read history), exec (call the LLM), post (store questions with their answers).
     '''
     async def prep_async(self, shared):
-        requests = shared.get("requests", [])
-        return [(req.question, req.user) for req in requests]
-    
+        memory = shared["memory"]
+        jobs = []
+        for req in shared.get("requests", []):
+            role = shared["user_roles"][req.user]
+            # The question is stored in post, together with its answer
+            system_message, messages = memory.get_context_for_api(req.user, role, shared["context_builder"],
+                                                                  question=req.question)
+            key = ResponseCache.make_key(system_message, req.question, messages[:-1])
+            jobs.append((req.user, system_message, messages, shared.get("response_cache"), key))
+        return jobs
+
     async def exec_async(self, one_job_tuple):
         '''Handle request for ONE user only. Runs concurrently for all users'''
-        user_prompt, user = one_job_tuple
-        print(f'     Handling prompt with length {len(user_prompt)} for {user}')
-        prompt = f'User {user} is a university {UserDataBase[user]}. Please assist this user with following question: \n{user_prompt}'
-        response = await call_llm(prompt)
+        user, system_message, messages, response_cache, key = one_job_tuple
+        print(f'     Handling {len(messages)} messages for {user}')
+        if response_cache is not None:
+            response, cached = await response_cache.get_or_generate(key, lambda: call_llm(system_message, messages))
+            return {'user': user, 'response': response, 'cached': cached}
+        response = await call_llm(system_message, messages)
 
         return {'user': user, 'response': response}
-    
+
+    async def exec_fallback_async(self, prep_res, exc):
+        # One failed call shouldn't fail the rest of the batch
+        return {'user': prep_res[0], 'error': str(exc)}
+
     async def post_async(self, shared, prep_res, list_of_all_results):
+        memory = shared["memory"]
+        for request, result in zip(shared.get("requests", []), list_of_all_results):
+            if 'response' in result:
+                memory.add_turn(request.user, request.question, result['response'])
         return list_of_all_results
-
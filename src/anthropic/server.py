@@ -1,15 +1,39 @@
+import argparse
 import asyncio
+import os
+import sys
+
+# Modules shared by both servers and the router (metrics, clients, storage, ...) live in src/common
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "common"))
+
 from aiohttp import web
-from call_llm import call_llm
+from call_llm import call_llm, configure_mock
 from memory import ConversationMemory
+from node import RequestHandler
+from response_cache import ResponseCache
+from metrics import metrics_middleware, handle_metrics
+from context_builder import ContextBuilder, estimate_tokens
+from user_sequencer import UserSequencer
+from summarizer import HistorySummarizer
+from batch_stream import parse_batch, stream_batch
 from datetime import datetime
 
 UserDataBase = {'Linda': 'Student',
                 'Miguel': 'Counselor',
                 'Mike': 'Athlete'}
 
+# Maximum prompt size sent to the API; the oldest turns are dropped first
+CONTEXT_TOKEN_BUDGET = 4000
+
 # Initialize global memory instance
 memory = ConversationMemory()
+context_builder = ContextBuilder(estimate_tokens, token_budget=CONTEXT_TOKEN_BUDGET)
+
+# Set when the server runs with --batching; requests then go through micro-batches
+request_handler = None
+response_cache = None  # Set with --response-cache
+sequencer = UserSequencer()  # Coalesces with --coalesce
+summarizer = None  # Set with --summarize-after: folds old turns into a summary in the background
 
 async def handle_request(request):
     try:
@@ -20,33 +44,118 @@ async def handle_request(request):
         if user not in UserDataBase:
             return web.json_response({'error': 'Unknown user'}, status=400)
 
-        # Add user's question to memory
-        memory.add_user_message(user, question)
-
-        # Get messages for API call (includes conversation history)
-        system_message, messages = memory.get_messages_for_api(user, UserDataBase[user])
-
-        # Log received question
+        # One turn per user at a time; with --coalesce, questions queued behind it share one answer
+        result, merged = await sequencer.submit(user, question, lambda text: answer_question(user, text))
+        if 'error' in result:
+            return web.json_response(result, status=500)
+        if summarizer is not None:
+            summarizer.note_turn(user)
+        if merged > 1:
+            result = {**result, 'coalesced': merged}
+        return web.json_response(result)
+    except Exception as e:
+        # Log error
         current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        print(f"[{current_time}] User {user} asked: {question}")
+        print(f"[{current_time}] Error occurred with status code: 400")
+        return web.json_response({'error': str(e)}, status=400)
 
-        # Get response from LLM using conversation history
+async def answer_question(user: str, question: str) -> dict:
+    if request_handler is not None:
+        return await answer_batched(user, question)
+
+    # Get messages for API call (newest conversation history that fits the token budget). The question is
+    # stored only together with its answer, so a failed call leaves the history as it was
+    system_message, messages = memory.get_context_for_api(user, UserDataBase[user], context_builder,
+                                                          question=question)
+
+    # Log received question
+    current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    print(f"[{current_time}] User {user} asked: {question}")
+
+    # Get response from LLM using conversation history
+    cached = False
+    if response_cache is not None:
+        key = ResponseCache.make_key(system_message, question, messages[:-1])
+        response, cached = await response_cache.get_or_generate(key, lambda: call_llm(system_message, messages))
+    else:
         response = await call_llm(system_message, messages)
 
-        # Add LLM's response to memory
-        memory.add_assistant_message(user, response)
+    # Add the question and the LLM's response to memory
+    memory.add_turn(user, question, response)
 
-        # Log response
-        current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        print(f"[{current_time}] Responded to {user} with status code: 200")
+    # Log response
+    current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    print(f"[{current_time}] Responded to {user} with status code: 200{' (cached)' if cached else ''}")
+
+    return {'user': user, 'response': response}
 
-        return web.json_response({'user': user, 'response': response})
+async def answer_batched(user: str, question: str) -> dict:
+    current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    print(f"[{current_time}] User {user} asked (batched): {question}")
+
+    # The handler stores the question and the answer in memory as part of its batch
+    result = await request_handler.add_request(user, question)
+
+    current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    if 'error' in result:
+        print(f"[{current_time}] Error occurred with status code: 500")
+        return result
+
+    print(f"[{current_time}] Responded to {user} with status code: 200 "
+          f"(queue wait {result['queue_wait'] * 1000:.1f} ms)")
+    return result
+
+async def handle_batch_request(request):
+    """Answer a list of {user, question} items together, streaming NDJSON results as they finish"""
+    try:
+        items = parse_batch(await request.json())
     except Exception as e:
-        # Log error
-        current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        print(f"[{current_time}] Error occurred with status code: 400")
         return web.json_response({'error': str(e)}, status=400)
 
+    current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    print(f"[{current_time}] Batch of {len(items)} questions received")
+
+    async def answer(user: str, question: str) -> dict:
+        if user not in UserDataBase:
+            return {'user': user, 'error': 'Unknown user', 'status': 400}
+        # Never merged: every item gets its own answer. With --batching the items share micro-batches.
+        result, _ = await sequencer.submit(user, question, lambda text: answer_question(user, text), mergeable=False)
+        if 'error' in result:
+            return {**result, 'status': 500}
+        if summarizer is not None:
+            summarizer.note_turn(user)
+        return result
+
+    # Each turn is logged as it finishes; the log's writer group-commits whatever piles up meanwhile
+    response = await stream_batch(request, items, answer)
+
+    current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    print(f"[{current_time}] Finished batch of {len(items)} questions")
+    return response
+
+async def summarize_with_api(system_message: str, text: str) -> str:
+    return await call_llm(system_message, [{'role': 'user', 'content': text}])
+
+async def stop_summarizer(app):
+    await summarizer.close()
+
+async def start_batching(app):
+    request_handler.start()
+
+async def stop_batching(app):
+    await request_handler.stop()
+
+async def health_check(request):
+    return web.json_response({
+        'status': 'healthy',
+        'batching': request_handler.stats if request_handler is not None else None,
+        'response_cache': response_cache.stats() if response_cache is not None else None,
+        'sequencer': sequencer.stats(),
+        'summarizer': summarizer.stats() if summarizer is not None else None,
+        'memory': memory.stats(),
+        'timestamp': datetime.now().isoformat()
+    })
+
 async def clear_conversation(request):
     try:
         data = await request.json()
@@ -66,9 +175,58 @@ async def clear_conversation(request):
         print(f"[{current_time}] Error clearing conversation: {e}")
         return web.json_response({'error': str(e)}, status=400)
 
-app = web.Application()
+app = web.Application(middlewares=[metrics_middleware])
 app.router.add_post('/ask', handle_request)
+app.router.add_post('/ask_batch', handle_batch_request)
 app.router.add_post('/clear', clear_conversation)
+app.router.add_get('/health', health_check)
+app.router.add_get('/metrics', handle_metrics)
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Anthropic-backed counseling server")
+    parser.add_argument("--batching", action="store_true", help="Group requests into micro-batches")
+    parser.add_argument("--batch-size", type=int, default=8, help="Flush a batch at this many requests")
+    parser.add_argument("--max-wait-ms", type=float, default=50.0,
+                        help="Flush a batch once its oldest request has waited this long")
+    parser.add_argument("--response-cache", action="store_true",
+                        help="Reuse answers to repeated questions from users with the same role and history")
+    parser.add_argument("--cache-size", type=int, default=1024, help="Maximum cached responses")
+    parser.add_argument("--cache-ttl", type=float, default=600.0, help="Seconds a cached response stays valid")
+    parser.add_argument("--coalesce", action="store_true",
+                        help="Answer questions a user sends while their previous one is running with one generation")
+    parser.add_argument("--summarize-after", type=int, default=0,
+                        help="Summarize a user's oldest turns once their history reaches this many tokens (0 = never)")
+    parser.add_argument("--summary-keep-tokens", type=int, default=512,
+                        help="Newest part of a summarized history kept word for word")
+    parser.add_argument("--summary-interval", type=float, default=10.0, help="Seconds between summarization jobs")
+    parser.add_argument("--mock-latency-ms", type=float, default=None,
+                        help="Benchmark the server offline: answer after this delay instead of calling the API")
+    parser.add_argument("--mock-jitter-ms", type=float, default=0.0, help="Standard deviation of the mock latency")
+    parser.add_argument("--history-cache-mb", type=float, default=256.0,
+                        help="Memory for conversation histories; the least recently used are read from disk again")
+    args = parser.parse_args()
+
+    memory.max_cached_bytes = int(args.history_cache_mb * 2 ** 20)
+    if args.mock_latency_ms is not None:
+        configure_mock(args.mock_latency_ms / 1000, args.mock_jitter_ms / 1000)
+
+    if args.coalesce:
+        sequencer = UserSequencer(coalesce=True)
+
+    if args.summarize_after > 0:
+        summarizer = HistorySummarizer(memory, context_builder, UserDataBase, summarize_with_api,
+                                       threshold_tokens=args.summarize_after, keep_tokens=args.summary_keep_tokens,
+                                       min_interval=args.summary_interval)
+        app.on_cleanup.append(stop_summarizer)
+
+    if args.response_cache:
+        response_cache = ResponseCache(max_entries=args.cache_size, ttl=args.cache_ttl)
+
+    if args.batching:
+        request_handler = RequestHandler(memory, context_builder, UserDataBase,
+                                         batch_size=args.batch_size, max_wait=args.max_wait_ms / 1000,
+                                         response_cache=response_cache)
+        app.on_startup.append(start_batching)
+        app.on_cleanup.append(stop_batching)
+
     web.run_app(app, port=8080)
\ No newline at end of file
@@ -1,10 +1,15 @@
-import asyncio
-import aiohttp
+import argparse
+import os
 import sys
 
+# Modules shared by both servers and the router (metrics, clients, storage, ...) live in src/common
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "common"))
+
+from counseling_client import ANTHROPIC_URL, SyncCounselingClient
+
 USERS = ['Linda', 'Miguel', 'Mike']
 
-async def chat_session(session, selected_user):
+def chat_session(client, selected_user):
     print(f"\nStarting chat as {selected_user}. Type 'quit' to exit.")
     print("Ask your question:")
     
@@ -18,18 +23,13 @@ async def chat_session(session, selected_user):
             if not question.strip():
                 continue
                 
-            async with session.post('http://localhost:8080/ask', 
-                                  json={'user': selected_user, 'question': question}) as resp:
-                response = await resp.json()
-                if 'error' in response:
-                    print(f"Error: {response['error']}")
-                else:
-                    print(f"\nResponse: {response['response']}\n")
-                    
+            response = client.ask(selected_user, question)
+            print(f"\nResponse: {response['response']}\n")
+
         except Exception as e:
             print(f"Error: {e}")
 
-async def main():
+def main(url: str):
     # User selection
     print("Welcome to the AI Assistant! Please select your user:")
     for idx, user in enumerate(USERS, 1):
@@ -49,11 +49,14 @@ async def main():
             sys.exit(0)
     
     # Start chat session
-    async with aiohttp.ClientSession() as session:
-        await chat_session(session, selected_user)
+    with SyncCounselingClient(url) as client:
+        chat_session(client, selected_user)
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Chat with the counseling server as one user")
+    parser.add_argument("--url", default=ANTHROPIC_URL, help="Server address")
+    args = parser.parse_args()
     try:
-        asyncio.run(main())
+        main(args.url)
     except KeyboardInterrupt:
         print("\nGoodbye!")
@@ -0,0 +1,101 @@
+"""
+Offline stand-in for the Anthropic Messages API.
+
+Point the client at it with ANTHROPIC_BASE_URL=http://localhost:8090 to test
+connection pooling and retry behavior without a real API key. Latency, the
+share of 429 responses and their retry-after value are configurable, and
+requests beyond --max-concurrent are rejected with 529 (overloaded).
+"""
+import argparse
+import asyncio
+import random
+from aiohttp import web
+
+
+class StubAnthropic:
+    def __init__(self, latency: float = 0.2, jitter: float = 0.05, rate_limit_ratio: float = 0.0,
+                 retry_after: float = 0.2, max_concurrent: int = 0):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit_ratio = rate_limit_ratio
+        self.retry_after = retry_after
+        self.max_concurrent = max_concurrent
+
+        self.in_flight = 0
+        self.transports = set()
+        self.stats = {"requests": 0, "responses": 0, "rate_limited": 0, "overloaded": 0, "connections": 0}
+
+    async def handle_messages(self, request):
+        self.stats["requests"] += 1
+
+        # A new transport means the client opened a new TCP connection instead of reusing one
+        transport = id(request.transport)
+        if transport not in self.transports:
+            self.transports.add(transport)
+            self.stats["connections"] += 1
+
+        if random.random() < self.rate_limit_ratio:
+            self.stats["rate_limited"] += 1
+            return self._error(429, "rate_limit_error", "Rate limited by stub")
+        if self.max_concurrent and self.in_flight >= self.max_concurrent:
+            self.stats["overloaded"] += 1
+            return self._error(529, "overloaded_error", "Stub is overloaded")
+
+        self.in_flight += 1
+        try:
+            data = await request.json()
+            await asyncio.sleep(max(0.0, random.gauss(self.latency, self.jitter)))
+        finally:
+            self.in_flight -= 1
+
+        question = data["messages"][-1]["content"] if data.get("messages") else ""
+        self.stats["responses"] += 1
+        return web.json_response({
+            "id": f"msg_stub_{self.stats['responses']}",
+            "type": "message",
+            "role": "assistant",
+            "model": data.get("model", "stub"),
+            "content": [{"type": "text", "text": f"Stub answer to: {question}"}],
+            "stop_reason": "end_turn",
+            "stop_sequence": None,
+            "usage": {"input_tokens": len(str(data.get("messages", ""))) // 4, "output_tokens": 8},
+        })
+
+    def _error(self, status: int, error_type: str, message: str):
+        return web.json_response(
+            {"type": "error", "error": {"type": error_type, "message": message}},
+            status=status,
+            headers={"retry-after": str(self.retry_after)},
+        )
+
+    async def handle_stats(self, request):
+        return web.json_response(dict(self.stats, in_flight=self.in_flight))
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post('/v1/messages', self.handle_messages)
+        app.router.add_get('/stats', self.handle_stats)
+        return app
+
+
+async def start_stub(port: int, **kwargs):
+    """Run the stub in the current event loop; returns (stub, runner) so callers can clean up"""
+    stub = StubAnthropic(**kwargs)
+    runner = web.AppRunner(stub.make_app(), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, 'localhost', port).start()
+    return stub, runner
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Offline stub of the Anthropic Messages API")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--latency", type=float, default=0.2, help="Mean response latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.05, help="Standard deviation of the latency")
+    parser.add_argument("--rate-limit-ratio", type=float, default=0.0, help="Share of requests answered with 429")
+    parser.add_argument("--retry-after", type=float, default=0.2, help="retry-after seconds sent with 429/529")
+    parser.add_argument("--max-concurrent", type=int, default=0, help="Answer 529 beyond this many in flight (0 = no limit)")
+    args = parser.parse_args()
+
+    stub = StubAnthropic(args.latency, args.jitter, args.rate_limit_ratio, args.retry_after, args.max_concurrent)
+    web.run_app(stub.make_app(), port=args.port)
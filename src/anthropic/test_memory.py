@@ -1,48 +1,49 @@
+import argparse
 import asyncio
-import aiohttp
-import json
+import os
+import sys
 
-async def test_memory():
-    async with aiohttp.ClientSession() as session:
+# Modules shared by both servers and the router (metrics, clients, storage, ...) live in src/common
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "common"))
+
+from counseling_client import ANTHROPIC_URL, CounselingClient
+
+async def test_memory(url: str):
+    async with CounselingClient(url) as client:
         user = "Linda"
 
         print("=== Testing Memory Functionality ===\n")
 
         # Clear conversation history first
         print("1. Clearing conversation history...")
-        async with session.post('http://localhost:8080/clear',
-                              json={'user': user}) as resp:
-            result = await resp.json()
-            print(f"   Clear result: {result}\n")
+        result = await client.clear(user)
+        print(f"   Clear result: {result}\n")
 
         # First conversation
         print("2. First question (should not have context)...")
         question1 = "My name is Sarah and I'm struggling with time management"
-        async with session.post('http://localhost:8080/ask',
-                              json={'user': user, 'question': question1}) as resp:
-            result1 = await resp.json()
-            print(f"   Q: {question1}")
-            print(f"   A: {result1['response']}\n")
+        result1 = await client.ask(user, question1)
+        print(f"   Q: {question1}")
+        print(f"   A: {result1['response']}\n")
 
         # Second conversation - should remember previous context
         print("3. Second question (should remember my name and topic)...")
         question2 = "What specific techniques would work for me?"
-        async with session.post('http://localhost:8080/ask',
-                              json={'user': user, 'question': question2}) as resp:
-            result2 = await resp.json()
-            print(f"   Q: {question2}")
-            print(f"   A: {result2['response']}\n")
+        result2 = await client.ask(user, question2)
+        print(f"   Q: {question2}")
+        print(f"   A: {result2['response']}\n")
 
         # Third conversation - should continue remembering
         print("4. Third question (should still have full context)...")
         question3 = "Can you remind me what we discussed earlier?"
-        async with session.post('http://localhost:8080/ask',
-                              json={'user': user, 'question': question3}) as resp:
-            result3 = await resp.json()
-            print(f"   Q: {question3}")
-            print(f"   A: {result3['response']}\n")
+        result3 = await client.ask(user, question3)
+        print(f"   Q: {question3}")
+        print(f"   A: {result3['response']}\n")
 
         print("=== Memory Test Complete ===")
 
 if __name__ == "__main__":
-    asyncio.run(test_memory())
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Check that the counseling server remembers earlier turns")
+    parser.add_argument("--url", default=ANTHROPIC_URL, help="Server address")
+    args = parser.parse_args()
+    asyncio.run(test_memory(args.url))
\ No newline at end of file
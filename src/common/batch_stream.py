@@ -0,0 +1,79 @@
+"""
+Many questions in one HTTP request: the /ask_batch endpoint of both servers.
+
+The body is a JSON list of {"user", "question"} items (or {"items": [...]}).
+Every item is started at once, so the model layer sees them together and
+can batch them. Turns of one user still run in item order. Results are
+written as newline-delimited JSON as soon as each one finishes, so fast
+answers don't wait behind slow ones:
+
+    {"index": 2, "user": "Mike", "response": "..."}
+    {"index": 0, "user": "Linda", "response": "..."}
+    {"index": 1, "error": "Unknown user", "status": 400}
+    {"done": true, "items": 3, "errors": 1}
+"""
+import asyncio
+import json
+from typing import Awaitable, Callable, Dict, List
+
+from aiohttp import web
+
+from metrics import REGISTRY
+
+MAX_BATCH_ITEMS = 256
+
+BATCH_ITEMS = REGISTRY.histogram("ask_batch_items", "Items per /ask_batch request",
+                                 buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256))
+
+
+def parse_batch(data) -> List[Dict]:
+    """The items of an /ask_batch body; raises ValueError for a body that isn't a list of up to MAX_BATCH_ITEMS"""
+    items = data.get('items') if isinstance(data, dict) else data
+    if not isinstance(items, list) or not items:
+        raise ValueError('Expected a non-empty list of {"user", "question"} items')
+    if len(items) > MAX_BATCH_ITEMS:
+        raise ValueError(f'At most {MAX_BATCH_ITEMS} items per batch, got {len(items)}')
+    return items
+
+
+async def stream_batch(request, items: List[Dict], answer: Callable[[str, str], Awaitable[Dict]]) -> web.StreamResponse:
+    """
+    Answer every item concurrently and stream one NDJSON line per result, in completion order
+    Args:
+        request: The /ask_batch request
+        items: Parsed items; malformed ones get an error line of their own
+        answer: Coroutine function (user, question) -> result dict; a result with 'error' counts as failed
+    Returns:
+        The finished stream response
+    """
+    BATCH_ITEMS.observe(len(items))
+    response = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+    await response.prepare(request)
+
+    async def run(index: int, item) -> Dict:
+        if not isinstance(item, dict) or not isinstance(item.get('user'), str) \
+                or not isinstance(item.get('question'), str):
+            return {'index': index, 'error': 'Each item needs a "user" and a "question"', 'status': 400}
+        try:
+            result = await answer(item['user'], item['question'])
+        except Exception as e:
+            result = {'user': item['user'], 'error': str(e), 'status': 500}
+        return {'index': index, **result}
+
+    # Tasks start in item order, so each user's turns are queued in the order they were sent
+    tasks = [asyncio.create_task(run(index, item)) for index, item in enumerate(items)]
+    errors = 0
+    try:
+        for finished in asyncio.as_completed(tasks):
+            result = await finished
+            errors += 'error' in result
+            await response.write((json.dumps(result) + '\n').encode())
+        await response.write((json.dumps({'done': True, 'items': len(items), 'errors': errors}) + '\n').encode())
+        await response.write_eof()
+    except ConnectionResetError:
+        # The client went away; turns already started still finish and are stored
+        pass
+    finally:
+        if any(not task.done() for task in tasks):
+            await asyncio.gather(*tasks, return_exceptions=True)
+    return response
@@ -0,0 +1,131 @@
+from typing import Callable, Dict, List
+
+from metrics import REGISTRY
+
+SUMMARY_TOKENS_SAVED = REGISTRY.histogram(
+    "prompt_summary_tokens_saved", "Prompt tokens saved per request by sending a summary instead of the turns it replaced",
+    buckets=(0, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 25000))
+
+# Stored summaries (role "summary") are sent as a user message starting with this
+SUMMARY_PREFIX = "Summary of our conversation so far: "
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (about 4 characters per token) for backends without a local tokenizer"""
+    return max(1, len(text) // 4)
+
+
+class ContextBuilder:
+    """
+    Fits a conversation into a token budget.
+
+    The system prompt and the newest turns are always kept; the oldest turns
+    are dropped first, and the oldest turn that only partly fits is trimmed
+    from its start. Token counts are cached on each stored message under
+    "token_count", so a message is only tokenized once no matter how many
+    prompts it ends up in.
+
+    A summary message at the start of the history (see summarizer.py) is sent
+    first, ahead of the turns that still fit, as long as it takes no more
+    than half the budget.
+    """
+
+    def __init__(self, count_tokens: Callable[[str], int], token_budget: int,
+                 per_message_overhead: int = 4, min_trimmed_tokens: int = 32):
+        """
+        Args:
+            count_tokens: Returns the number of tokens in a piece of text
+            token_budget: Maximum prompt size, system prompt included
+            per_message_overhead: Tokens added per message by role labels and separators
+            min_trimmed_tokens: Don't keep a trimmed old turn shorter than this
+        """
+        self.count_tokens = count_tokens
+        self.token_budget = token_budget
+        self.per_message_overhead = per_message_overhead
+        self.min_trimmed_tokens = min_trimmed_tokens
+        self._system_counts: Dict[str, int] = {}
+        self.summarized_prompts = 0
+        self.summary_tokens_saved = 0
+
+    def message_tokens(self, message: Dict) -> int:
+        count = message.get("token_count")
+        if count is None:
+            count = self.count_tokens(message["content"])
+            message["token_count"] = count
+        return count
+
+    def system_tokens(self, system_message: str) -> int:
+        count = self._system_counts.get(system_message)
+        if count is None:
+            if len(self._system_counts) > 1024:
+                self._system_counts.clear()
+            count = self.count_tokens(system_message)
+            self._system_counts[system_message] = count
+        return count
+
+    def build(self, system_message: str, history: List[Dict]) -> List[Dict]:
+        """
+        Select the newest messages of a stored history that fit the budget
+        Args:
+            system_message: System prompt (always kept)
+            history: Stored messages, oldest first; token counts are cached on them
+        Returns:
+            API-ready messages ({"role", "content"} only), oldest first
+        """
+        remaining = self.token_budget - self.system_tokens(system_message) - self.per_message_overhead
+        selected = []
+
+        summary = history[0] if history and history[0]["role"] == "summary" else None
+        if summary is not None:
+            summary_cost = (self.system_tokens(SUMMARY_PREFIX) + self.message_tokens(summary)
+                            + self.per_message_overhead)
+            if summary_cost <= remaining // 2:
+                remaining -= summary_cost
+            else:
+                summary = None
+
+        for message in reversed(history):
+            if message["role"] not in ["user", "assistant"]:
+                continue
+
+            cost = self.message_tokens(message) + self.per_message_overhead
+            if cost <= remaining:
+                selected.append({"role": message["role"], "content": message["content"]})
+                remaining -= cost
+                continue
+
+            # Trim the oldest turn that still partly fits; the newest message is always kept
+            available = remaining - self.per_message_overhead
+            if not selected or available >= self.min_trimmed_tokens:
+                content = self._trim_start(message["content"], max(available, 1))
+                selected.append({"role": message["role"], "content": content})
+            break
+
+        selected.reverse()
+
+        # Conversations must start with a user turn
+        while len(selected) > 1 and selected[0]["role"] != "user":
+            selected.pop(0)
+
+        if summary is not None:
+            selected.insert(0, summary_message(summary))
+            saved = max(0, summary.get("replaced_tokens", 0) - summary_cost)
+            self.summarized_prompts += 1
+            self.summary_tokens_saved += saved
+            SUMMARY_TOKENS_SAVED.observe(saved)
+
+        return selected
+
+    def _trim_start(self, content: str, max_tokens: int) -> str:
+        """Keep the end of content within max_tokens"""
+        tokens = self.count_tokens(content)
+        while tokens > max_tokens and content:
+            keep = max(int(len(content) * max_tokens / tokens * 0.9), 0)
+            content = content[len(content) - keep:] if keep else ""
+            tokens = self.count_tokens(content) if content else 0
+        return "..." + content if content else content
+
+
+def summary_message(summary: Dict) -> Dict:
+    """API message carrying a stored summary"""
+    return {"role": "user", "content": SUMMARY_PREFIX + summary["content"]}
@@ -0,0 +1,313 @@
+from typing import Dict, List, Optional, Tuple
+import atexit
+import contextlib
+import hashlib
+import json
+import os
+import queue
+import threading
+import time
+
+from metrics import REGISTRY
+
+STORE_WRITE_SECONDS = REGISTRY.histogram("conversation_store_write_seconds",
+                                         "Time to append one group commit to the conversation log")
+STORE_COMPACTION_SECONDS = REGISTRY.histogram("conversation_store_compaction_seconds",
+                                              "Time to rewrite the logged users' files and truncate the log")
+STORE_RECORDS = REGISTRY.counter("conversation_store_records_total", "Records written to the conversation log")
+STORE_BYTES = REGISTRY.gauge("conversation_store_file_bytes", "Size of the conversation log", ["file"])
+STORE_USER_LOAD_SECONDS = REGISTRY.histogram("conversation_store_user_load_seconds",
+                                             "Time to read one user's history from disk")
+
+
+class ConversationStore:
+    """
+    Append-only, per-user persistence for conversation memory.
+
+    Every change is one JSON record appended to `<storage_file>.log`. A
+    background writer thread group-commits everything queued since its last
+    write, so callers never touch the disk. After `compact_every` records the
+    writer compacts the log: every user it mentions gets their history
+    rewritten to a file of their own under `<storage_file>.d/` (sharded by a
+    hash of the name), and the log is truncated.
+
+    Startup reads only the log tail, never the user files, so it costs the
+    same for ten users or a million. load_user() reads one user's file and
+    applies that user's records since the last compaction, which the store
+    keeps in memory until the next one.
+
+    Records carry a sequence number. Each user file stores the last one it
+    includes, and the manifest the last one of a finished compaction, so a
+    crash part-way through a compaction never applies a record twice.
+
+    A whole-file snapshot at `storage_file`, written before user files
+    existed, is split into user files on first start and then left alone.
+    """
+
+    def __init__(self, storage_file: str, compact_every: int = 1000, fsync: bool = False):
+        """
+        Args:
+            storage_file: Base path; the log is storage_file + ".log", the user files are under storage_file + ".d/"
+            compact_every: Number of logged records that triggers a compaction
+            fsync: fsync after every group commit (slower, survives power loss)
+        """
+        self.storage_file = storage_file
+        self.log_file = storage_file + ".log"
+        self.user_dir = storage_file + ".d"
+        self.manifest_file = os.path.join(self.user_dir, "manifest.json")
+        self.compact_every = compact_every
+        self.fsync = fsync
+
+        self.last_seq = 0  # Last sequence number handed out
+        self.written_seq = 0  # Last sequence number in the log
+        self.compacted_seq = 0  # Last sequence number in the user files
+        self.records_since_compaction = 0
+        self.group_commits = 0
+        self.compactions = 0
+        self.user_loads = 0
+
+        # Records since the last compaction, by user, as (seq, JSON line); load_user() applies them to the file
+        self._pending: Dict[str, List[Tuple[int, str]]] = {}
+        self._queue: "queue.Queue[Tuple[int, str]]" = queue.Queue()
+        self._seq_lock = threading.Lock()  # Guards last_seq and _pending
+        self._written = threading.Condition()
+        self._thread = None
+
+    def load(self):
+        """Read the manifest and the log tail (user files are read later, by load_user)"""
+        if not os.path.exists(self.manifest_file) and os.path.exists(self.storage_file):
+            self._migrate_snapshot()
+        self.compacted_seq = self._read_manifest()
+        last_seq = self.compacted_seq
+        replayed = 0
+
+        if os.path.exists(self.log_file):
+            valid_bytes = 0
+            with open(self.log_file, 'rb') as f:
+                for raw in f:
+                    if not raw.endswith(b"\n"):
+                        break
+                    try:
+                        line = raw.decode()
+                        record = json.loads(line)
+                    except ValueError:
+                        break
+                    valid_bytes += len(raw)
+                    if record["seq"] <= self.compacted_seq:
+                        continue
+                    self._pending.setdefault(record["user"], []).append((record["seq"], line))
+                    last_seq = record["seq"]
+                    replayed += 1
+            if valid_bytes < os.path.getsize(self.log_file):
+                # A torn final line from a crash mid-write; everything before it is intact. Cut it off,
+                # or the next group commit would be appended to it and lost with it on the next load
+                with open(self.log_file, 'r+b') as f:
+                    f.truncate(valid_bytes)
+
+        self.last_seq = self.written_seq = last_seq
+        self.records_since_compaction = replayed
+        self._record_sizes()
+
+    def load_user(self, user: str) -> List[Dict]:
+        """One user's history: their file plus their records since the last compaction"""
+        start = time.perf_counter()
+        # Pending records first: a compaction writes the file before it drops them, so whichever file
+        # version is read next, these cover everything after it
+        with self._seq_lock:
+            pending = list(self._pending.get(user, ()))
+        messages, file_seq = self._read_user(user)
+
+        conversations = {} if messages is None else {user: messages}
+        for seq, line in pending:
+            if seq > file_seq:
+                apply_record(conversations, json.loads(line))
+        self.user_loads += 1
+        STORE_USER_LOAD_SECONDS.observe(time.perf_counter() - start)
+        return conversations.get(user, [])
+
+    def _user_file(self, user: str) -> str:
+        digest = hashlib.sha1(user.encode()).hexdigest()
+        return os.path.join(self.user_dir, digest[:2], digest + ".json")
+
+    def _read_user(self, user: str) -> Tuple[Optional[List[Dict]], int]:
+        """(messages, last sequence number they include); (None, 0) for a user without a file"""
+        try:
+            with open(self._user_file(user), 'r') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return None, 0
+        except json.JSONDecodeError as e:
+            print(f"Error reading history of {user}: {e}")
+            return None, 0
+        return data["messages"], data["seq"]
+
+    def _write_user(self, user: str, messages: Optional[List[Dict]], seq: int):
+        """Replace a user's file atomically; None removes it"""
+        path = self._user_file(user)
+        if messages is None:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._write_json(path, {"user": user, "seq": seq, "messages": messages})
+
+    def _read_manifest(self) -> int:
+        try:
+            with open(self.manifest_file, 'r') as f:
+                return json.load(f)["seq"]
+        except (FileNotFoundError, json.JSONDecodeError, KeyError):
+            return 0
+
+    @staticmethod
+    def _write_json(path: str, data):
+        tmp_file = path + ".tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, path)
+
+    def _migrate_snapshot(self):
+        """Split a whole-file snapshot into user files (the snapshot itself is kept)"""
+        try:
+            with open(self.storage_file, 'r') as f:
+                data = json.load(f)
+        except (json.JSONDecodeError, FileNotFoundError):
+            return
+        if isinstance(data, dict) and "conversations" in data and "seq" in data:
+            conversations, seq = data["conversations"], data["seq"]
+        else:
+            # Plain {user: [messages]} file written before the log existed
+            conversations, seq = data, 0
+
+        for user, messages in conversations.items():
+            self._write_user(user, messages, seq)
+        os.makedirs(self.user_dir, exist_ok=True)
+        self._write_json(self.manifest_file, {"seq": seq})
+        print(f"Moved {len(conversations)} conversations from {self.storage_file} to {self.user_dir}")
+
+    def append(self, record: Dict) -> int:
+        """Queue a record for the writer thread; returns its sequence number"""
+        with self._seq_lock:
+            self.last_seq += 1
+            seq = self.last_seq
+            # Serialize now: the message dicts may change after this call returns
+            line = json.dumps(dict(record, seq=seq), separators=(',', ':')) + '\n'
+            self._pending.setdefault(record["user"], []).append((seq, line))
+            self._queue.put((seq, line))
+        self._start()
+        return seq
+
+    def flush(self, timeout: float = None) -> bool:
+        """Block until every record appended so far is on disk"""
+        target = self.last_seq
+        with self._written:
+            return self._written.wait_for(lambda: self.written_seq >= target, timeout=timeout)
+
+    def compact(self):
+        """Rewrite the files of every user in the log and truncate it (run by the writer thread)"""
+        start = time.perf_counter()
+        target = self.written_seq  # Everything in the log; records still queued stay pending
+        with self._seq_lock:
+            users = {user: [(seq, line) for seq, line in records if seq <= target]
+                     for user, records in self._pending.items()}
+
+        for user, records in users.items():
+            if not records:
+                continue
+            messages, file_seq = self._read_user(user)
+            conversations = {} if messages is None else {user: messages}
+            for seq, line in records:
+                if seq > file_seq:
+                    apply_record(conversations, json.loads(line))
+            self._write_user(user, conversations.get(user), max(file_seq, records[-1][0]))
+        os.makedirs(self.user_dir, exist_ok=True)
+        self._write_json(self.manifest_file, {"seq": target})
+        open(self.log_file, 'w').close()
+
+        with self._seq_lock:
+            for user in users:
+                remaining = [(seq, line) for seq, line in self._pending.get(user, ()) if seq > target]
+                if remaining:
+                    self._pending[user] = remaining
+                else:
+                    self._pending.pop(user, None)
+        self.compacted_seq = target
+        self.records_since_compaction = 0
+        self.compactions += 1
+        STORE_COMPACTION_SECONDS.observe(time.perf_counter() - start)
+        self._record_sizes()
+
+    def _start(self):
+        if self._thread is None:
+            with self._seq_lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="conversation-writer", daemon=True)
+                    self._thread.start()
+                    atexit.register(self.flush, 5.0)
+
+    def _run(self):
+        while True:
+            # Group commit: one write for everything that piled up while the previous write ran
+            batch = [self._queue.get()]
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            try:
+                lines = [line for seq, line in batch if seq > self.written_seq]
+                if lines:
+                    start = time.perf_counter()
+                    with open(self.log_file, 'a') as f:
+                        f.write(''.join(lines))
+                        f.flush()
+                        if self.fsync:
+                            os.fsync(f.fileno())
+                        STORE_BYTES.set(f.tell(), file="log")
+                    STORE_WRITE_SECONDS.observe(time.perf_counter() - start)
+                    STORE_RECORDS.inc(len(lines))
+                    self.group_commits += 1
+                    self.records_since_compaction += len(lines)
+            except OSError as e:
+                print(f"Error writing conversation log: {e}")
+            # Release flush() waiters even after an error so callers never hang on a broken disk
+            self._mark_written(max(seq for seq, line in batch))
+
+            if self.records_since_compaction >= self.compact_every:
+                try:
+                    self.compact()
+                except Exception as e:
+                    print(f"Error compacting conversation log: {e}")
+
+    def _mark_written(self, seq: int):
+        with self._written:
+            self.written_seq = max(self.written_seq, seq)
+            self._written.notify_all()
+
+    def _record_sizes(self):
+        STORE_BYTES.set(os.path.getsize(self.log_file) if os.path.exists(self.log_file) else 0, file="log")
+
+    def stats(self) -> Dict:
+        return {
+            "last_seq": self.last_seq,
+            "written_seq": self.written_seq,
+            "pending": self.last_seq - self.written_seq,
+            "group_commits": self.group_commits,
+            "compactions": self.compactions,
+            "compacted_seq": self.compacted_seq,
+            "pending_users": len(self._pending),
+            "user_loads": self.user_loads,
+            "log_bytes": os.path.getsize(self.log_file) if os.path.exists(self.log_file) else 0,
+        }
+
+
+def apply_record(conversations: Dict[str, List[Dict]], record: Dict):
+    """Apply one log record to a conversations dict"""
+    if record["op"] == "add":
+        conversations.setdefault(record["user"], []).append(record["message"])
+    elif record["op"] == "clear":
+        conversations.pop(record["user"], None)
+    elif record["op"] == "summarize":
+        conversations.setdefault(record["user"], [])[:record["count"]] = [record["message"]]
@@ -0,0 +1,350 @@
+"""
+Client library for the counseling servers: src/anthropic/server.py (port 8080)
+and src/transformer/local_server.py (port 8081).
+
+CounselingClient keeps one pooled keep-alive aiohttp session for its lifetime, so
+requests reuse connections instead of opening one each. A request whose
+connection could not be opened, or that is answered with 429, is retried after
+the server's Retry-After (capped by max_retry_wait): the question never reached
+a turn, so a retry can't store it twice. A 503 is retried only for requests that
+are safe to repeat (/clear). A question is not retried on 503, because the
+router answers 503 when its deadline passes, and a backend may have stored the
+turn by then. Anything else raises RequestFailed.
+
+    async with CounselingClient("http://localhost:8081") as client:
+        print((await client.ask("Linda", "How do I study for finals?"))["response"])
+        async for event in client.stream("Linda", "And for midterms?"):
+            print(event.get("token", ""), end="")
+        async for result in client.ask_many([("Mike", "Warm-up tips?"), ("Miguel", "Office hours?")]):
+            print(result["index"], result.get("response"))
+
+SyncCounselingClient offers the same calls for blocking code.
+"""
+import asyncio
+import json
+import time
+from typing import AsyncIterator, Dict, Iterable, Iterator, Optional, Tuple, Union
+
+import aiohttp
+
+ANTHROPIC_URL = "http://localhost:8080"
+LOCAL_URL = "http://localhost:8081"
+
+RETRY_STATUSES = (429, 503)  # Requests that are safe to repeat
+QUESTION_RETRY_STATUSES = (429,)  # Requests that store a turn: 429 always comes before anything is stored
+
+Item = Union[Tuple[str, str], Dict]  # (user, question) or {"user": ..., "question": ...}
+
+
+class RequestFailed(Exception):
+    """The server answered with an error (after any retries), or the request timed out"""
+
+    def __init__(self, message: str, status: Optional[int] = None, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+def as_item(item: Item) -> Dict:
+    if isinstance(item, dict):
+        return {"user": item["user"], "question": item["question"]}
+    user, question = item
+    return {"user": user, "question": question}
+
+
+class CounselingClient:
+    def __init__(self, base_url: str = ANTHROPIC_URL, max_connections: int = 100, timeout: float = 300.0,
+                 connect_timeout: float = 10.0, retries: int = 3, max_retry_wait: float = 30.0,
+                 request_timeout: Optional[float] = None):
+        """
+        Args:
+            base_url: Server address, e.g. LOCAL_URL
+            max_connections: Connections kept open to the server at most (more requests wait for one)
+            timeout: Seconds a whole request may take, retries included
+            connect_timeout: Seconds to open a connection
+            retries: Retries after a refused connection, a 429, or a 503 (when safe to repeat)
+            max_retry_wait: Longest wait before a retry, whatever Retry-After says
+            request_timeout: Sent as X-Request-Timeout, so the server drops the request once nobody will wait
+                for the answer
+        """
+        self.base_url = base_url.rstrip("/")
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.retries = retries
+        self.max_retry_wait = max_retry_wait
+        self.request_timeout = request_timeout
+        self._session: Optional[aiohttp.ClientSession] = None
+        self.stats = {"requests": 0, "retries": 0, "failures": 0}
+
+    async def __aenter__(self) -> "CounselingClient":
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        """The shared session, created on first use (inside the running event loop)"""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.max_connections, keepalive_timeout=60)
+            # Timeouts are applied per request, so a stream's total time is bounded by `timeout` too
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def ask(self, user: str, question: str) -> Dict:
+        """Ask one question; returns the server's response ({"user", "response", ...})"""
+        async with self._request("POST", "/ask", {"user": user, "question": question},
+                                 retry_statuses=QUESTION_RETRY_STATUSES) as resp:
+            return await resp.json()
+
+    async def stream(self, user: str, question: str) -> AsyncIterator[Dict]:
+        """
+        Ask one question on /ask_stream (local server)
+        Yields:
+            The server's events: {"token": text} while decoding, then {"done": true, "response": ...}
+        Raises:
+            RequestFailed: On an error event
+        """
+        async with self._request("POST", "/ask_stream", {"user": user, "question": question},
+                                 retry_statuses=QUESTION_RETRY_STATUSES) as resp:
+            async for event in self._events(resp):
+                if "error" in event:
+                    raise RequestFailed(event["error"], resp.status)
+                yield event
+
+    async def ask_stream(self, user: str, question: str, on_token=None) -> Dict:
+        """
+        Stream one answer to completion
+        Args:
+            on_token: Called with each text chunk as it arrives
+        Returns:
+            The final event, plus 'ttft' (seconds to the first token, None if there was none) and 'total' seconds
+        """
+        start = time.perf_counter()
+        ttft = None
+        chunks = []
+        done = {}
+        async for event in self.stream(user, question):
+            if "token" in event:
+                if ttft is None:
+                    ttft = time.perf_counter() - start
+                chunks.append(event["token"])
+                if on_token is not None:
+                    on_token(event["token"])
+            elif event.get("done"):
+                done = event
+        result = {"user": user, "response": "".join(chunks).strip(), **done}
+        result.pop("done", None)
+        return {**result, "ttft": ttft, "total": time.perf_counter() - start}
+
+    async def ask_batch(self, items: Iterable[Item]) -> AsyncIterator[Dict]:
+        """
+        Send many questions in one /ask_batch request
+        Yields:
+            One result per item in completion order, tagged with its 'index'; failed items carry 'error' and 'status'
+        """
+        body = [as_item(item) for item in items]
+        async with self._request("POST", "/ask_batch", body, retry_statuses=QUESTION_RETRY_STATUSES) as resp:
+            async for event in self._events(resp):
+                if not event.get("done"):
+                    yield event
+
+    async def ask_many(self, items: Iterable[Item], concurrency: int = 8) -> AsyncIterator[Dict]:
+        """
+        Send many questions as concurrent /ask requests over the pooled connections
+        Args:
+            concurrency: Requests in flight at once
+        Yields:
+            Results in completion order, tagged with their 'index'; a failed request gives 'error' and 'status'
+            instead of raising, so the rest carry on
+        """
+        slots = asyncio.Semaphore(concurrency)
+
+        async def one(index: int, item: Dict) -> Dict:
+            async with slots:
+                try:
+                    return {"index": index, **await self.ask(item["user"], item["question"])}
+                except RequestFailed as e:
+                    return {"index": index, "user": item["user"], "error": str(e), "status": e.status}
+
+        tasks = [asyncio.create_task(one(index, as_item(item))) for index, item in enumerate(items)]
+        try:
+            for finished in asyncio.as_completed(tasks):
+                yield await finished
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def clear(self, user: str) -> Dict:
+        async with self._request("POST", "/clear", {"user": user}) as resp:
+            return await resp.json()
+
+    async def health(self) -> Dict:
+        """/health; a loading local server answers it too (status "loading")"""
+        async with self._request("GET", "/health", retry=False, ok_statuses=(503,)) as resp:
+            return await resp.json()
+
+    async def wait_until_ready(self, timeout: float = 600.0) -> Dict:
+        """Poll /ready (local server) until the model can serve, waiting as long as its Retry-After suggests"""
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                async with self._request("GET", "/ready", retry=False) as resp:
+                    return await resp.json()
+            except RequestFailed as e:
+                if e.status != 503 or time.monotonic() + (e.retry_after or 1.0) > deadline:
+                    raise
+                await asyncio.sleep(min(e.retry_after or 1.0, self.max_retry_wait))
+
+    def _request(self, method: str, path: str, body=None, retry: bool = True, ok_statuses=(),
+                 retry_statuses=RETRY_STATUSES) -> "_Request":
+        return _Request(self, method, path, body, retry, ok_statuses, retry_statuses)
+
+    @staticmethod
+    async def _events(resp: aiohttp.ClientResponse) -> AsyncIterator[Dict]:
+        """Newline-delimited JSON objects of a streamed response"""
+        async for line in resp.content:
+            if line.strip():
+                yield json.loads(line)
+
+
+class _Request:
+    """One request with retries; `async with` gives the successful response and releases its connection after"""
+
+    def __init__(self, client: CounselingClient, method: str, path: str, body, retry: bool, ok_statuses,
+                 retry_statuses):
+        self.client = client
+        self.method = method
+        self.url = client.base_url + path
+        self.body = body
+        self.retry = retry
+        self.ok_statuses = ok_statuses
+        self.retry_statuses = retry_statuses
+        self.response: Optional[aiohttp.ClientResponse] = None
+
+    async def __aenter__(self) -> aiohttp.ClientResponse:
+        client = self.client
+        deadline = time.monotonic() + client.timeout
+        headers = {}
+        if client.request_timeout is not None:
+            headers["X-Request-Timeout"] = str(client.request_timeout)
+        client.stats["requests"] += 1
+
+        attempt = 0
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                client.stats["failures"] += 1
+                raise RequestFailed(f"{self.method} {self.url} timed out after {client.timeout:.0f}s")
+            timeout = aiohttp.ClientTimeout(total=remaining, connect=min(client.connect_timeout, remaining))
+            wait = None
+            try:
+                response = await client.session.request(self.method, self.url, json=self.body, headers=headers,
+                                                        timeout=timeout)
+            except aiohttp.ClientConnectorError as e:
+                # Nothing reached the server, so asking again can't duplicate the question
+                error = RequestFailed(f"Cannot connect to {client.base_url}: {e}")
+                wait = min(2.0 ** attempt * 0.5, client.max_retry_wait)
+            except asyncio.TimeoutError:
+                client.stats["failures"] += 1
+                raise RequestFailed(f"{self.method} {self.url} timed out after {client.timeout:.0f}s")
+            else:
+                if response.status < 400 or response.status in self.ok_statuses:
+                    self.response = response
+                    return response
+                error = await self._error(response)
+                if response.status in self.retry_statuses:
+                    wait = min(error.retry_after if error.retry_after is not None else 2.0 ** attempt * 0.5,
+                               client.max_retry_wait)
+
+            if not self.retry or wait is None or attempt >= client.retries or time.monotonic() + wait > deadline:
+                client.stats["failures"] += 1
+                raise error
+            attempt += 1
+            client.stats["retries"] += 1
+            await asyncio.sleep(wait)
+
+    async def __aexit__(self, *exc):
+        if self.response is not None:
+            self.response.release()
+
+    @staticmethod
+    async def _error(response: aiohttp.ClientResponse) -> RequestFailed:
+        try:
+            message = (await response.json()).get("error") or response.reason
+        except (aiohttp.ContentTypeError, json.JSONDecodeError, AttributeError):
+            message = response.reason
+        finally:
+            response.release()
+        retry_after = response.headers.get("Retry-After")
+        try:
+            retry_after = float(retry_after) if retry_after is not None else None
+        except ValueError:
+            retry_after = None
+        return RequestFailed(f"{response.status}: {message}", response.status, retry_after)
+
+
+class SyncCounselingClient:
+    """Blocking CounselingClient for scripts; runs its own event loop, so don't use it inside one"""
+
+    def __init__(self, base_url: str = ANTHROPIC_URL, **options):
+        """
+        Args:
+            base_url, options: As for CounselingClient
+        """
+        self._loop = asyncio.new_event_loop()
+        self.client = CounselingClient(base_url, **options)
+
+    def __enter__(self) -> "SyncCounselingClient":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _run(self, coroutine):
+        return self._loop.run_until_complete(coroutine)
+
+    def _iterate(self, iterator: AsyncIterator) -> Iterator:
+        try:
+            while True:
+                try:
+                    yield self._run(iterator.__anext__())
+                except StopAsyncIteration:
+                    return
+        finally:
+            self._run(iterator.aclose())
+
+    def ask(self, user: str, question: str) -> Dict:
+        return self._run(self.client.ask(user, question))
+
+    def stream(self, user: str, question: str) -> Iterator[Dict]:
+        return self._iterate(self.client.stream(user, question))
+
+    def ask_stream(self, user: str, question: str, on_token=None) -> Dict:
+        return self._run(self.client.ask_stream(user, question, on_token))
+
+    def ask_batch(self, items: Iterable[Item]) -> Iterator[Dict]:
+        return self._iterate(self.client.ask_batch(items))
+
+    def ask_many(self, items: Iterable[Item], concurrency: int = 8) -> Iterator[Dict]:
+        return self._iterate(self.client.ask_many(items, concurrency))
+
+    def clear(self, user: str) -> Dict:
+        return self._run(self.client.clear(user))
+
+    def health(self) -> Dict:
+        return self._run(self.client.health())
+
+    def wait_until_ready(self, timeout: float = 600.0) -> Dict:
+        return self._run(self.client.wait_until_ready(timeout))
+
+    def close(self):
+        if not self._loop.is_closed():
+            self._run(self.client.close())
+            self._loop.close()
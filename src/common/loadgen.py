@@ -0,0 +1,210 @@
+"""
+Open-loop load generator for /ask and /ask_stream.
+
+Requests are sent on a fixed schedule (Poisson or constant-rate arrivals)
+whether or not earlier ones have finished, so a saturated server shows up
+as growing latency instead of a politely slowed-down client. Latency is
+measured from each request's scheduled send time, which also counts the
+time it waited for a free connection.
+
+    python loadgen.py --rate 20 --duration 30 --arrival poisson
+    python loadgen.py --url http://localhost:8080 --rate 20 --duration 30   # the Anthropic server
+    python loadgen.py --rate 5 --requests 200 --stream --save run.json
+    python loadgen.py --rate 5 --requests 200 --baseline run.json
+"""
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+from typing import Dict, List, Optional
+
+import aiohttp
+
+USERS = ['Linda', 'Miguel', 'Mike']
+
+SAMPLE_QUESTIONS = [
+    "What are effective study techniques for finals?",
+    "How can I manage my time better?",
+    "What's the best way to prepare for exams?",
+    "How do I deal with academic stress?",
+    "Can you suggest some productivity tips?",
+    "What's a good workout routine?",
+    "How to balance sports and studies?",
+    "What are good mental health practices?",
+]
+
+
+def percentile(values: List[float], p: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(p / 100 * len(values))) - 1))
+    return values[index]
+
+
+def arrival_times(rate: float, arrival: str, count: int, duration: float, rng: random.Random) -> List[float]:
+    """Send offsets (seconds from start) for count requests or until duration, whichever is set"""
+    times = []
+    t = 0.0
+    while True:
+        t += rng.expovariate(rate) if arrival == "poisson" else 1.0 / rate
+        if (count and len(times) >= count) or (not count and t > duration):
+            return times
+        times.append(t)
+
+
+async def send(session: aiohttp.ClientSession, url: str, stream: bool, user: str, question: str) -> Dict:
+    """One request; returns status and, for streams, when the first token arrived"""
+    start = time.perf_counter()
+    first_token = None
+    path = "/ask_stream" if stream else "/ask"
+    async with session.post(url + path, json={'user': user, 'question': question}) as resp:
+        if not stream or resp.status != 200:
+            await resp.read()
+            return {"status": resp.status, "first_token": None}
+
+        error = False
+        async for line in resp.content:
+            if not line.strip():
+                continue
+            event = json.loads(line)
+            if 'token' in event and first_token is None:
+                first_token = time.perf_counter() - start
+            error = error or 'error' in event
+        return {"status": 500 if error else 200, "first_token": first_token}
+
+
+async def run(args) -> Dict:
+    rng = random.Random(args.seed)
+    questions = SAMPLE_QUESTIONS
+    if args.questions_file:
+        with open(args.questions_file) as f:
+            questions = [line.strip() for line in f if line.strip()]
+    users = args.users.split(',')
+
+    schedule = arrival_times(args.rate, args.arrival, args.requests, args.duration, rng)
+    slots = asyncio.Semaphore(args.concurrency)
+    latencies, ttfts, errors = [], [], {}
+    in_flight = 0
+    peak_in_flight = 0
+
+    connector = aiohttp.TCPConnector(limit=args.concurrency)
+    timeout = aiohttp.ClientTimeout(total=args.timeout)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        start = time.perf_counter()
+
+        async def one(offset: float):
+            nonlocal in_flight, peak_in_flight
+            await asyncio.sleep(max(0.0, start + offset - time.perf_counter()))
+            scheduled = start + offset
+            user, question = rng.choice(users), rng.choice(questions)
+            async with slots:
+                sent_at = time.perf_counter()
+                in_flight += 1
+                peak_in_flight = max(peak_in_flight, in_flight)
+                try:
+                    result = await send(session, args.url, args.stream, user, question)
+                except asyncio.TimeoutError:
+                    result = {"status": "timeout", "first_token": None}
+                except aiohttp.ClientError as e:
+                    result = {"status": type(e).__name__, "first_token": None}
+                finally:
+                    in_flight -= 1
+
+            if result["status"] == 200:
+                latencies.append(time.perf_counter() - scheduled)
+                if result["first_token"] is not None:
+                    # First token relative to the scheduled send, like the latency
+                    ttfts.append(sent_at - scheduled + result["first_token"])
+            else:
+                errors[str(result["status"])] = errors.get(str(result["status"]), 0) + 1
+
+        await asyncio.gather(*[one(offset) for offset in schedule])
+        elapsed = time.perf_counter() - start
+
+    sent = len(schedule)
+    return {
+        "url": args.url,
+        "endpoint": "/ask_stream" if args.stream else "/ask",
+        "arrival": args.arrival,
+        "target_rate": args.rate,
+        "sent": sent,
+        "completed": len(latencies),
+        "errors": errors,
+        "error_rate": (sent - len(latencies)) / sent if sent else 0.0,
+        "elapsed": elapsed,
+        "throughput": len(latencies) / elapsed if elapsed else 0.0,
+        "peak_in_flight": peak_in_flight,
+        "latency": {f"p{p}": percentile(latencies, p) for p in (50, 95, 99)},
+        "ttft": {f"p{p}": percentile(ttfts, p) for p in (50, 95, 99)} if ttfts else None,
+    }
+
+
+def print_summary(summary: Dict):
+    def ms(value):
+        return f"{value * 1000:.0f} ms" if value is not None else "n/a"
+
+    print(f"\n{summary['endpoint']} at {summary['target_rate']} req/s ({summary['arrival']} arrivals)")
+    print(f"Sent {summary['sent']}, completed {summary['completed']} in {summary['elapsed']:.1f}s "
+          f"-> {summary['throughput']:.2f} req/s, peak {summary['peak_in_flight']} in flight")
+    print(f"Errors: {summary['error_rate']:.1%} {summary['errors'] or ''}")
+    latency = summary["latency"]
+    print(f"Latency  p50 {ms(latency['p50'])}  p95 {ms(latency['p95'])}  p99 {ms(latency['p99'])}")
+    if summary["ttft"]:
+        ttft = summary["ttft"]
+        print(f"TTFT     p50 {ms(ttft['p50'])}  p95 {ms(ttft['p95'])}  p99 {ms(ttft['p99'])}")
+
+
+def compare(summary: Dict, baseline: Dict, tolerance: float) -> List[str]:
+    """Regressions beyond tolerance (a fraction) against a saved run"""
+    regressions = []
+    for key in ("p50", "p95", "p99"):
+        new, old = summary["latency"][key], baseline["latency"][key]
+        if new is not None and old and new > old * (1 + tolerance):
+            regressions.append(f"latency {key} {old * 1000:.0f} -> {new * 1000:.0f} ms")
+    if summary["throughput"] < baseline["throughput"] * (1 - tolerance):
+        regressions.append(f"throughput {baseline['throughput']:.2f} -> {summary['throughput']:.2f} req/s")
+    if summary["error_rate"] > baseline["error_rate"] + tolerance / 10:
+        regressions.append(f"error rate {baseline['error_rate']:.1%} -> {summary['error_rate']:.1%}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Open-loop load generator for the counseling servers")
+    parser.add_argument("--url", default="http://localhost:8081",
+                        help="Server base URL (local server; the Anthropic server is on port 8080, the router on 8000)")
+    parser.add_argument("--rate", type=float, default=5.0, help="Arrivals per second")
+    parser.add_argument("--arrival", choices=["poisson", "constant"], default="poisson")
+    parser.add_argument("--duration", type=float, default=30.0, help="Seconds of arrivals (ignored with --requests)")
+    parser.add_argument("--requests", type=int, default=0, help="Send exactly this many requests")
+    parser.add_argument("--concurrency", type=int, default=256, help="Maximum open connections")
+    parser.add_argument("--timeout", type=float, default=300.0, help="Per-request timeout in seconds")
+    parser.add_argument("--stream", action="store_true", help="Use /ask_stream and report time to first token")
+    parser.add_argument("--users", default=",".join(USERS), help="Comma-separated users to pick from")
+    parser.add_argument("--questions-file", help="One question per line (default: built-in sample questions)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--save", help="Write the summary as JSON")
+    parser.add_argument("--baseline", help="Summary JSON of an earlier run; exit 1 on regressions")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative regression vs --baseline")
+    args = parser.parse_args()
+
+    summary = asyncio.run(run(args))
+    print_summary(summary)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(summary, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(summary, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION: {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+import asyncio
+import hashlib
+import json
+import re
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+
+def normalize_question(question: str) -> str:
+    """Case, surrounding whitespace and trailing punctuation don't change the answer"""
+    return re.sub(r"\s+", " ", question).strip().rstrip("?!. ").lower()
+
+
+class ResponseCache:
+    """
+    TTL + LRU cache of generated responses with single-flight generation.
+
+    Entries are keyed on the normalized question and a hash of the system
+    prompt and conversation history sent with it, so an answer is reused only
+    for a request the model would see the same way. Identical requests that arrive while one is still generating
+    wait for that generation instead of starting their own.
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl: float = 600.0):
+        """
+        Args:
+            max_entries: Least recently used entries are evicted beyond this
+            ttl: Seconds an entry stays valid
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, Tuple[str, float, float]]" = OrderedDict()  # key -> (response, expires_at, generation_time)
+        self._in_flight: Dict[str, asyncio.Future] = {}
+
+        self.hits = 0
+        self.coalesced = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.saved_seconds = 0.0
+
+    @staticmethod
+    def make_key(system_message: str, question: str, history: List[Dict]) -> str:
+        """
+        Args:
+            system_message: The system prompt the answer is generated with (it may name the user)
+            question: The new question
+            history: Messages sent before the question ({"role", "content"})
+        """
+        context_hash = hashlib.blake2b(
+            json.dumps([system_message, [[m["role"], m["content"]] for m in history]]).encode(), digest_size=16
+        ).hexdigest()
+        return f"{normalize_question(question)}\x00{context_hash}"
+
+    def _lookup(self, key: str) -> Optional[Tuple[str, float, float]]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[1] < time.monotonic():
+            del self._entries[key]
+            self.expirations += 1
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    async def get(self, key: str) -> Optional[str]:
+        """Cached response, or the result of an identical in-flight generation; None on a miss"""
+        entry = self._lookup(key)
+        if entry is not None:
+            self.hits += 1
+            self.saved_seconds += entry[2]
+            return entry[0]
+
+        future = self._in_flight.get(key)
+        if future is not None:
+            start = time.perf_counter()
+            try:
+                response = await asyncio.shield(future)
+            except Exception:
+                self.misses += 1
+                return None
+            self.coalesced += 1
+            self.saved_seconds += self._entries[key][2] if key in self._entries else time.perf_counter() - start
+            return response
+
+        self.misses += 1
+        return None
+
+    def put(self, key: str, response: str, generation_time: float = 0.0):
+        self._entries[key] = (response, time.monotonic() + self.ttl, generation_time)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    async def get_or_generate(self, key: str, generate: Callable[[], Awaitable[str]]) -> Tuple[str, bool]:
+        """
+        Args:
+            key: From make_key
+            generate: Produces the response on a miss
+        Returns:
+            (response, whether it came from the cache or another in-flight request)
+        """
+        response = await self.get(key)
+        if response is not None:
+            return response, True
+
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = future
+        start = time.perf_counter()
+        try:
+            response = await generate()
+        except BaseException as e:
+            # Waiters fall back to generating themselves; errors are never cached
+            future.set_exception(e if isinstance(e, Exception) else RuntimeError("Generation was cancelled"))
+            future.exception()
+            raise
+        finally:
+            self._in_flight.pop(key, None)
+
+        self.put(key, response, time.perf_counter() - start)
+        future.set_result(response)
+        return response, False
+
+    def stats(self) -> Dict:
+        lookups = self.hits + self.coalesced + self.misses
+        return {
+            "entries": len(self._entries),
+            "in_flight": len(self._in_flight),
+            "hits": self.hits,
+            "coalesced": self.coalesced,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.coalesced) / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "saved_generation_seconds": round(self.saved_seconds, 3),
+        }
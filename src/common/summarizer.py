@@ -0,0 +1,168 @@
+"""
+Rolling summaries of long conversation histories.
+
+Every stored turn is kept, so a long conversation keeps growing on disk and
+its oldest turns fall out of the prompt budget and are lost to the model.
+Once a user's history passes threshold_tokens, HistorySummarizer folds the
+oldest turns (and any earlier summary) into one stored summary message and
+keeps only the newest keep_tokens of the conversation verbatim. Prompts then
+carry the summary in place of those turns (see ContextBuilder).
+
+Summaries are written by one background task: at most one at a time and at
+most one every min_interval seconds, never on a request's path.
+"""
+import asyncio
+import time
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from metrics import REGISTRY
+
+SUMMARIES = REGISTRY.counter("conversation_summaries_total", "Background summarization jobs, by outcome", ["outcome"])
+SUMMARY_SECONDS = REGISTRY.histogram("conversation_summary_seconds", "Time to generate one summary")
+SUMMARIZED_TOKENS = REGISTRY.counter("conversation_summarized_tokens_total",
+                                     "Tokens of conversation turns folded into summaries")
+
+SUMMARY_SYSTEM_PROMPT = ("You write a counselor's notes on a conversation with a university {user_role}. "
+                         "Summarize what the user has shared about themselves, their situation and goals, "
+                         "the advice already given, and any open questions. Write plain prose in at most "
+                         "{words} words.")
+
+
+class HistorySummarizer:
+    def __init__(self, memory, context_builder, user_roles: Dict[str, str],
+                 summarize: Callable[[str, str], Awaitable[str]], threshold_tokens: int = 1500,
+                 keep_tokens: int = 512, min_interval: float = 10.0, summary_words: int = 120):
+        """
+        Args:
+            memory: Conversation memory holding the histories
+            context_builder: Counts (and caches) message tokens; its prompts carry the summaries
+            user_roles: Role of each user (the server's user database), as in the chat system prompt
+            summarize: Coroutine function (system_message, text) -> summary, backed by the server's model
+            threshold_tokens: Summarize a history once its turns add up to this many tokens
+            keep_tokens: Newest part of the history kept verbatim
+            min_interval: Seconds between summarization jobs
+            summary_words: Length asked of the model
+        """
+        self.memory = memory
+        self.context_builder = context_builder
+        self.user_roles = user_roles
+        self.summarize = summarize
+        self.threshold_tokens = threshold_tokens
+        self.keep_tokens = keep_tokens
+        self.min_interval = min_interval
+        self.summary_words = summary_words
+
+        self._queue: "asyncio.Queue[str]" = asyncio.Queue()
+        self._queued = set()
+        self._worker: Optional[asyncio.Task] = None
+        self._last_job = 0.0
+        self.jobs = 0
+        self.failures = 0
+        self.summarized_messages = 0
+        self.summarized_tokens = 0
+        self.summary_tokens = 0
+
+    def history_tokens(self, history: List[Dict]) -> int:
+        """Tokens of the turns not yet summarized"""
+        return sum(self.context_builder.message_tokens(m) for m in history if m["role"] in ("user", "assistant"))
+
+    def note_turn(self, user: str):
+        """Called after each finished turn; queues the user for a summary once the history is long enough"""
+        if user in self._queued:
+            return
+        if self.history_tokens(self.memory.get_conversation_history(user)) < self.threshold_tokens:
+            return
+        self._queued.add(user)
+        self._queue.put_nowait(user)
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            user = await self._queue.get()
+            wait = self._last_job + self.min_interval - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            # Turns finished while waiting are folded into this job too
+            self._queued.discard(user)
+            self._last_job = time.monotonic()
+            try:
+                await self.summarize_user(user)
+            except Exception as e:
+                self.failures += 1
+                SUMMARIES.inc(outcome="error")
+                print(f"Error summarizing conversation of {user}: {e}")
+
+    def _split(self, history: List[Dict]) -> int:
+        """Number of leading messages to fold: everything but the newest keep_tokens, cut before a user turn"""
+        kept = 0
+        start = len(history)
+        while start > 0 and history[start - 1]["role"] != "summary":
+            kept += self.context_builder.message_tokens(history[start - 1])
+            if kept > self.keep_tokens:
+                break
+            start -= 1
+        # The verbatim part has to start with a user turn
+        while start < len(history) and history[start]["role"] != "user":
+            start += 1
+        if start == len(history):
+            start = max((i for i, m in enumerate(history) if m["role"] == "user"), default=0)
+        return start
+
+    async def summarize_user(self, user: str) -> bool:
+        """Fold the oldest part of a user's history into a summary; returns False if there was nothing to do"""
+        history = list(self.memory.get_conversation_history(user))
+        if self.history_tokens(history) < self.threshold_tokens:
+            return False
+        count = self._split(history)
+        replaced = history[:count]
+        turns = [m for m in replaced if m["role"] in ("user", "assistant")]
+        if not turns:
+            return False
+
+        previous = replaced[0] if replaced[0]["role"] == "summary" else None
+        lines = []
+        if previous is not None:
+            lines.append(f"Notes so far: {previous['content']}\n")
+        for message in turns:
+            lines.append(f"{'User' if message['role'] == 'user' else 'Counselor'}: {message['content']}")
+        replaced_tokens = self.history_tokens(turns) + (previous.get("replaced_tokens", 0) if previous else 0)
+
+        start = time.perf_counter()
+        system_message = SUMMARY_SYSTEM_PROMPT.format(user_role=self.user_roles[user], words=self.summary_words)
+        summary = (await self.summarize(system_message, "\n".join(lines))).strip()
+        SUMMARY_SECONDS.observe(time.perf_counter() - start)
+        if not summary:
+            raise ValueError("Model returned an empty summary")
+
+        if not self.memory.replace_with_summary(user, replaced, summary, replaced_tokens):
+            SUMMARIES.inc(outcome="stale")
+            return False
+
+        self.jobs += 1
+        self.summarized_messages += len(turns)
+        self.summarized_tokens += self.history_tokens(turns)
+        self.summary_tokens += self.context_builder.count_tokens(summary)
+        SUMMARIES.inc(outcome="ok")
+        SUMMARIZED_TOKENS.inc(self.history_tokens(turns))
+        return True
+
+    async def close(self):
+        if self._worker is not None and not self._worker.done():
+            self._worker.cancel()
+            await asyncio.gather(self._worker, return_exceptions=True)
+
+    def stats(self) -> dict:
+        builder = self.context_builder
+        return {
+            "threshold_tokens": self.threshold_tokens,
+            "queued": len(self._queued),
+            "jobs": self.jobs,
+            "failures": self.failures,
+            "summarized_messages": self.summarized_messages,
+            "summarized_tokens": self.summarized_tokens,
+            "summary_tokens": self.summary_tokens,
+            "summarized_prompts": builder.summarized_prompts,
+            "prompt_tokens_saved_per_request": (builder.summary_tokens_saved / builder.summarized_prompts
+                                                if builder.summarized_prompts else 0.0),
+        }
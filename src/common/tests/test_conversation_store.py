@@ -0,0 +1,32 @@
+"""Conversation log recovery across restarts"""
+from conversation_store import ConversationStore
+
+
+def write(store, user, contents):
+    for content in contents:
+        store.append({"op": "add", "user": user, "message": {"role": "user", "content": content}})
+    assert store.flush(timeout=5)
+
+
+def contents(store, user):
+    return [message["content"] for message in store.load_user(user)]
+
+
+def test_torn_last_line_is_cut_off_before_new_writes(tmp_path):
+    storage_file = str(tmp_path / "conversations.json")
+    store = ConversationStore(storage_file)
+    store.load()
+    write(store, "Linda", ["m0", "m1", "m2"])
+
+    # A crash in the middle of a write leaves half a record at the end of the log
+    with open(store.log_file, 'a') as f:
+        f.write('{"op":"add","user":"Linda","message":{"role":"us')
+
+    store = ConversationStore(storage_file)
+    store.load()
+    assert contents(store, "Linda") == ["m0", "m1", "m2"]
+    write(store, "Linda", ["m3", "m4", "m5"])
+
+    store = ConversationStore(storage_file)
+    store.load()
+    assert contents(store, "Linda") == ["m0", "m1", "m2", "m3", "m4", "m5"]
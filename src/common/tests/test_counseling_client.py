@@ -0,0 +1,53 @@
+import asyncio
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from counseling_client import CounselingClient, RequestFailed
+
+
+def run_with_server(statuses, call):
+    """Run call(client) against a server that answers with statuses in turn (200 once they run out)"""
+    calls = []
+
+    async def handler(request):
+        calls.append(request.path)
+        status = statuses[len(calls) - 1] if len(calls) <= len(statuses) else 200
+        if status != 200:
+            return web.json_response({'error': 'busy'}, status=status, headers={'Retry-After': '0'})
+        return web.json_response({'user': 'Linda', 'response': 'ok'})
+
+    async def run():
+        app = web.Application()
+        app.router.add_post('/ask', handler)
+        app.router.add_post('/clear', handler)
+        server = TestServer(app)
+        await server.start_server()
+        try:
+            async with CounselingClient(str(server.make_url('')), retries=3) as client:
+                try:
+                    return await call(client), calls
+                except RequestFailed as e:
+                    return e, calls
+        finally:
+            await server.close()
+
+    return asyncio.run(run())
+
+
+def test_ask_retries_429():
+    result, calls = run_with_server([429, 429], lambda client: client.ask('Linda', 'hi'))
+    assert result['response'] == 'ok'
+    assert len(calls) == 3
+
+
+def test_ask_does_not_retry_503():
+    result, calls = run_with_server([503], lambda client: client.ask('Linda', 'hi'))
+    assert isinstance(result, RequestFailed) and result.status == 503
+    assert len(calls) == 1
+
+
+def test_clear_retries_503():
+    result, calls = run_with_server([503], lambda client: client.clear('Linda'))
+    assert result['response'] == 'ok'
+    assert len(calls) == 2
@@ -0,0 +1,42 @@
+"""Background summaries of long histories"""
+import asyncio
+
+from context_builder import ContextBuilder
+from summarizer import HistorySummarizer
+
+USER_ROLES = {'Linda': 'Student', 'Mike': 'Athlete'}
+
+
+class Memory:
+    """Just enough of the servers' conversation memory for the summarizer"""
+
+    def __init__(self, histories):
+        self.histories = histories
+
+    def get_conversation_history(self, user):
+        return self.histories[user]
+
+    def replace_with_summary(self, user, replaced, summary, replaced_tokens):
+        self.histories[user][:len(replaced)] = [{"role": "summary", "content": summary,
+                                                 "replaced_tokens": replaced_tokens}]
+        return True
+
+
+def test_summary_prompt_names_the_users_role():
+    turns = [{"role": "user" if i % 2 == 0 else "assistant", "content": f"turn {i} " + "word " * 20}
+             for i in range(8)]
+    memory = Memory({user: [dict(turn) for turn in turns] for user in USER_ROLES})
+    builder = ContextBuilder(lambda text: len(text.split()), token_budget=1000)
+    prompts = []
+
+    async def summarize(system_message, text):
+        prompts.append(system_message)
+        return "Notes."
+
+    summarizer = HistorySummarizer(memory, builder, USER_ROLES, summarize, threshold_tokens=100, keep_tokens=50)
+    for user in USER_ROLES:
+        assert asyncio.run(summarizer.summarize_user(user))
+
+    assert "a university Student" in prompts[0]
+    assert "a university Athlete" in prompts[1]
+    assert memory.histories["Mike"][0]["content"] == "Notes."
@@ -0,0 +1,125 @@
+"""
+Per-user ordering of conversation turns.
+
+A turn reads the user's history, generates an answer and appends it. Two
+turns of the same user running at once would both read the history before
+either answer is written. UserSequencer runs one turn per user at a time, in
+arrival order, while turns of different users run in parallel.
+
+With coalesce=True, questions that queue up before their turn starts (sent
+while the previous answer is generating, or at the same moment) are merged
+into a single turn, answered by one generation that every merged request
+receives.
+"""
+import asyncio
+import time
+from collections import deque
+from typing import Awaitable, Callable, Dict, List, Tuple
+
+from metrics import REGISTRY
+
+QUESTIONS = REGISTRY.counter("sequencer_questions_total", "Questions submitted to the per-user sequencer")
+GENERATIONS = REGISTRY.counter("sequencer_generations_total", "Turns run by the per-user sequencer")
+GENERATIONS_SAVED = REGISTRY.counter("sequencer_generations_saved_total",
+                                     "Generations avoided by merging queued questions from one user")
+TURN_WAIT = REGISTRY.histogram("sequencer_wait_seconds", "Time a question waited for the same user's earlier turns")
+
+
+def merge_questions(questions: List[str]) -> str:
+    return "\n\n".join(questions)
+
+
+class _Turn:
+    __slots__ = ("question", "answer", "future", "mergeable", "submitted_at")
+
+    def __init__(self, question: str, answer, future: asyncio.Future, mergeable: bool):
+        self.question = question
+        self.answer = answer
+        self.future = future
+        self.mergeable = mergeable
+        self.submitted_at = time.perf_counter()
+
+
+class UserSequencer:
+    def __init__(self, coalesce: bool = False, max_merge: int = 8):
+        """
+        Args:
+            coalesce: Merge questions that queue up behind a running turn into one follow-up turn
+            max_merge: Most questions merged into one turn
+        """
+        self.coalesce = coalesce
+        self.max_merge = max_merge
+        self._pending: Dict[str, deque] = {}
+        self._workers: Dict[str, asyncio.Task] = {}
+        self.questions = 0
+        self.generations = 0
+        self.generations_saved = 0
+
+    async def submit(self, user: str, question: str, answer: Callable[[str], Awaitable],
+                     mergeable: bool = True) -> Tuple[object, int]:
+        """
+        Run answer(question) as the user's next turn
+        Args:
+            user: Turns of the same user run one at a time
+            question: The user's question
+            answer: Coroutine function doing the turn; with coalescing it receives the merged questions
+            mergeable: False for turns that can't share an answer (e.g. a stream written to one client)
+        Returns:
+            (answer's result, number of questions that result answers)
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._pending.setdefault(user, deque()).append(_Turn(question, answer, future, mergeable))
+        self.questions += 1
+        QUESTIONS.inc()
+        if user not in self._workers:
+            self._workers[user] = asyncio.create_task(self._drain(user))
+        # A client that goes away doesn't abort its turn; the answer still belongs in the history
+        return await asyncio.shield(future)
+
+    async def _drain(self, user: str):
+        pending = self._pending[user]
+        try:
+            while pending:
+                turns = [pending.popleft()]
+                if self.coalesce and turns[0].mergeable:
+                    while pending and pending[0].mergeable and len(turns) < self.max_merge:
+                        turns.append(pending.popleft())
+
+                now = time.perf_counter()
+                for turn in turns:
+                    TURN_WAIT.observe(now - turn.submitted_at)
+                self.generations += 1
+                GENERATIONS.inc()
+                if len(turns) > 1:
+                    self.generations_saved += len(turns) - 1
+                    GENERATIONS_SAVED.inc(len(turns) - 1)
+
+                question = merge_questions([turn.question for turn in turns])
+                try:
+                    result = await turns[0].answer(question)
+                except Exception as e:
+                    for turn in turns:
+                        if not turn.future.done():
+                            turn.future.set_exception(e)
+                    continue
+                except asyncio.CancelledError:
+                    # Shutting down: nobody gets an answer
+                    for turn in turns + list(pending):
+                        turn.future.cancel()
+                    raise
+                for turn in turns:
+                    if not turn.future.done():
+                        turn.future.set_result((result, len(turns)))
+        finally:
+            del self._workers[user]
+            if not pending:
+                del self._pending[user]
+
+    def stats(self) -> dict:
+        return {
+            "coalesce": self.coalesce,
+            "questions": self.questions,
+            "generations": self.generations,
+            "generations_saved": self.generations_saved,
+            "users_active": len(self._workers),
+        }
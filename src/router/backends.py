@@ -0,0 +1,251 @@
+"""
+Backends the router can send a question to, and the live statistics it routes on.
+
+Every backend answers ask(user, question, deadline) with the counseling
+servers' /ask JSON ({'user', 'response', ...}). It raises BackendRejected when
+the backend refused the request itself (a 4xx other than 429, e.g. an unknown
+user), which no other backend would answer differently, and BackendOverloaded
+or BackendError otherwise. The base class keeps what the router needs to
+choose: recent latencies (a window for the median and percentiles), how many
+requests are in flight, and whether the backend is cooling off after
+failures or a 503/429.
+
+- HttpBackend: one of the servers (src/anthropic/server.py, src/transformer/local_server.py)
+- StubBackend: answers after a random delay; for tests and bench_router.py
+"""
+import asyncio
+import collections
+import math
+import random
+import time
+from typing import Dict, Optional
+
+import aiohttp
+
+from metrics import REGISTRY
+
+BACKEND_LATENCY = REGISTRY.histogram("router_backend_latency_seconds", "Time for a backend to answer", ["backend"])
+BACKEND_IN_FLIGHT = REGISTRY.gauge("router_backend_in_flight", "Requests in flight per backend", ["backend"])
+
+
+class BackendError(Exception):
+    """The backend failed to answer"""
+
+
+class BackendOverloaded(BackendError):
+    """The backend turned the request away (503/429); try elsewhere"""
+
+    def __init__(self, message: str, retry_after: float = 1.0):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class BackendRejected(Exception):
+    """The backend refused the request itself (4xx other than 429); the client gets the same answer"""
+
+    def __init__(self, status: int, body: Dict):
+        super().__init__(f"{status}: {body.get('error')}")
+        self.status = status
+        self.body = body
+
+
+class Backend:
+    def __init__(self, name: str, capacity: int = 8, initial_latency: float = 1.0, window: int = 200,
+                 failure_threshold: int = 3, cooldown: float = 5.0):
+        """
+        Args:
+            name: Label in responses, /health and metrics
+            capacity: Requests the backend serves at once; more in flight means queueing there
+            initial_latency: Latency assumed (seconds) before the first answer is timed
+            window: Recent latencies kept for percentiles
+            failure_threshold: Consecutive failures that take the backend out of rotation
+            cooldown: Seconds out of rotation after failing (a 503/429's Retry-After takes precedence)
+        """
+        self.name = name
+        self.capacity = capacity
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.latency = initial_latency  # Median of recent answers; a slow outlier doesn't move it
+        self.latencies = collections.deque(maxlen=window)
+        self.in_flight = 0
+        self.consecutive_failures = 0
+        self.unavailable_until = 0.0
+        self.last_answer_at = 0.0
+        self._counts = {"ok": 0, "error": 0, "overloaded": 0, "rejected": 0, "cancelled": 0}
+
+    async def _ask(self, user: str, question: str, deadline: Optional[float]) -> Dict:
+        raise NotImplementedError
+
+    async def ask(self, user: str, question: str, deadline: Optional[float] = None) -> Dict:
+        """
+        Args:
+            user: Counseling server user
+            question: The question
+            deadline: time.monotonic() by which the answer is needed
+        Returns:
+            The backend's /ask response
+        Raises:
+            BackendRejected: The request itself was refused; not held against the backend
+            BackendOverloaded: The backend is at capacity
+            BackendError: Anything else went wrong, including the deadline passing
+        """
+        self.in_flight += 1
+        BACKEND_IN_FLIGHT.set(self.in_flight, backend=self.name)
+        start = time.monotonic()
+        try:
+            result = await self._ask(user, question, deadline)
+        except asyncio.CancelledError:
+            self._counts["cancelled"] += 1
+            raise
+        except BackendRejected:
+            self._counts["rejected"] += 1
+            raise
+        except BackendOverloaded as e:
+            self._counts["overloaded"] += 1
+            self.unavailable_until = time.monotonic() + min(e.retry_after, 60.0)
+            raise
+        except Exception as e:
+            self._record_failure()
+            if isinstance(e, BackendError):
+                raise
+            raise BackendError(f"{type(e).__name__}: {e}") from e
+        finally:
+            self.in_flight -= 1
+            BACKEND_IN_FLIGHT.set(self.in_flight, backend=self.name)
+        self._record_success(time.monotonic() - start)
+        return result
+
+    def _record_success(self, elapsed: float):
+        self._counts["ok"] += 1
+        self.consecutive_failures = 0
+        self.latencies.append(elapsed)
+        self.latency = self.latency_quantile(0.5, 1)
+        self.last_answer_at = time.monotonic()
+        BACKEND_LATENCY.observe(elapsed, backend=self.name)
+
+    def _record_failure(self):
+        self._counts["error"] += 1
+        self.consecutive_failures += 1
+        if self.consecutive_failures >= self.failure_threshold:
+            # Out of rotation for a while; after that one more failure takes it out again
+            self.unavailable_until = time.monotonic() + self.cooldown
+            self.consecutive_failures = self.failure_threshold - 1
+
+    @property
+    def available(self) -> bool:
+        return time.monotonic() >= self.unavailable_until
+
+    def expected_latency(self) -> float:
+        """Seconds a request sent now should take: the median latency, plus its wait once the backend is full"""
+        queued = max(0, self.in_flight + 1 - self.capacity)
+        return self.latency * (1 + queued / self.capacity)
+
+    def latency_quantile(self, q: float, min_samples: int = 20) -> Optional[float]:
+        if len(self.latencies) < min_samples:
+            return None
+        values = sorted(self.latencies)
+        return values[min(len(values) - 1, int(math.ceil(q * len(values))) - 1)]
+
+    async def clear(self, user: str):
+        """Forget the user's conversation (each backend keeps its own history)"""
+
+    async def close(self):
+        pass
+
+    def stats(self) -> dict:
+        p50, p95 = self.latency_quantile(0.5, 1), self.latency_quantile(0.95, 1)
+        return {
+            "available": self.available,
+            "in_flight": self.in_flight,
+            "expected_latency": round(self.expected_latency(), 4),
+            "p50": round(p50, 4) if p50 is not None else None,
+            "p95": round(p95, 4) if p95 is not None else None,
+            **self._counts,
+        }
+
+
+class HttpBackend(Backend):
+    """A counseling server reached over HTTP"""
+
+    def __init__(self, name: str, url: str, **kwargs):
+        super().__init__(name, **kwargs)
+        self.url = url.rstrip("/")
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0))
+        return self._session
+
+    async def _ask(self, user: str, question: str, deadline: Optional[float]) -> Dict:
+        headers, timeout = {}, None
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise BackendError("Deadline passed before the request was sent")
+            # The servers drop a request they can't start in time instead of answering late
+            headers["X-Request-Timeout"] = f"{remaining:.3f}"
+            timeout = aiohttp.ClientTimeout(total=remaining)
+        try:
+            async with self._get_session().post(self.url + "/ask", json={"user": user, "question": question},
+                                                headers=headers, timeout=timeout) as resp:
+                if resp.status in (429, 503):
+                    retry_after = float(resp.headers.get("Retry-After", self.cooldown))
+                    raise BackendOverloaded(f"{self.name} answered {resp.status}", retry_after)
+                if 400 <= resp.status < 500:
+                    try:
+                        body = await resp.json(content_type=None)
+                    except ValueError:
+                        body = None
+                    raise BackendRejected(resp.status, body if isinstance(body, dict) else {'error': resp.reason})
+                data = await resp.json()
+                if resp.status != 200:
+                    raise BackendError(f"{self.name} answered {resp.status}: {data.get('error')}")
+                return data
+        except asyncio.TimeoutError:
+            raise BackendError(f"{self.name} did not answer before the deadline")
+
+    async def clear(self, user: str):
+        async with self._get_session().post(self.url + "/clear", json={"user": user}) as resp:
+            await resp.read()
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+
+class StubBackend(Backend):
+    """
+    Answers after a random delay: lognormal around median_ms (spread sigma), with a
+    tail_rate share of requests taking tail_ms instead. Requests beyond capacity
+    queue for a slot, as on a real server, unless reject_when_full.
+    """
+
+    def __init__(self, name: str, median_ms: float = 100.0, sigma: float = 0.3, tail_rate: float = 0.0,
+                 tail_ms: float = 0.0, failure_rate: float = 0.0, reject_when_full: bool = False,
+                 seed: Optional[int] = None, **kwargs):
+        super().__init__(name, **kwargs)
+        self.median_ms = median_ms
+        self.sigma = sigma
+        self.tail_rate = tail_rate
+        self.tail_ms = tail_ms
+        self.failure_rate = failure_rate
+        self.reject_when_full = reject_when_full
+        self.rng = random.Random(seed)
+        self._slots = None
+
+    def sample_delay(self) -> float:
+        if self.tail_rate and self.rng.random() < self.tail_rate:
+            return self.tail_ms / 1000
+        return self.median_ms / 1000 * math.exp(self.rng.gauss(0.0, self.sigma))
+
+    async def _ask(self, user: str, question: str, deadline: Optional[float]) -> Dict:
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.capacity)
+        if self.reject_when_full and self._slots.locked():
+            raise BackendOverloaded(f"{self.name} is full")
+        async with self._slots:
+            await asyncio.sleep(self.sample_delay())
+            if self.failure_rate and self.rng.random() < self.failure_rate:
+                raise BackendError(f"{self.name} failed")
+        return {"user": user, "response": f"[{self.name}] answer to: {question}"}
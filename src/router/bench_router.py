@@ -0,0 +1,112 @@
+"""
+Compare routing policies on stub backends with configurable latency distributions.
+
+Requests arrive open-loop (Poisson) and go through a Router in-process; no
+servers are needed. The default scenario is a fast backend with a slow tail
+and little capacity next to a slower backend with more capacity, which is
+roughly the local model next to the API.
+
+    python bench_router.py --rate 40 --requests 2000
+    python bench_router.py --fast median_ms=80,sigma=0.4,tail_rate=0.05,tail_ms=1500,capacity=4 \
+                           --slow median_ms=400,sigma=0.2,capacity=32
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+from typing import List, Optional
+
+# Modules shared by both servers and the router (metrics, clients, storage, ...) live in src/common
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "common"))
+
+from backends import Backend, StubBackend
+from router import Router, RoutingFailed
+
+
+class RandomRouter(Router):
+    """Baseline: a random available backend, ignoring latency"""
+
+    def rank(self) -> List[Backend]:
+        available = [b for b in self.backends if b.available]
+        random.shuffle(available)
+        return available
+
+
+def percentile(values: List[float], p: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(p / 100 * len(values))) - 1))
+    return values[index]
+
+
+def make_backend(name: str, spec: str, seed: int) -> StubBackend:
+    kwargs = {}
+    for option in filter(None, spec.split(',')):
+        key, value = option.split('=')
+        kwargs[key] = int(value) if value.isdigit() else float(value)
+    return StubBackend(name, seed=seed, **kwargs)
+
+
+async def run(policy: str, args) -> dict:
+    backends = [make_backend("fast", args.fast, args.seed), make_backend("slow", args.slow, args.seed + 1)]
+    if policy == "random":
+        router = RandomRouter(backends)
+    else:
+        router = Router(backends, hedge=policy == "hedged", hedge_quantile=args.hedge_quantile)
+
+    rng = random.Random(args.seed)
+    latencies, failures = [], 0
+
+    async def one(i: int):
+        nonlocal failures
+        start = time.perf_counter()
+        try:
+            await router.ask("bench", f"question {i}", time.monotonic() + args.timeout)
+            latencies.append(time.perf_counter() - start)
+        except RoutingFailed:
+            failures += 1
+
+    tasks = []
+    for i in range(args.requests):
+        tasks.append(asyncio.create_task(one(i)))
+        await asyncio.sleep(rng.expovariate(args.rate))
+    await asyncio.gather(*tasks)
+
+    stats = router.stats()
+    sent = sum(b["ok"] + b["error"] + b["overloaded"] + b["cancelled"] for b in stats["backends"].values())
+    return {
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        "failures": failures,
+        "backend_requests_per_answer": sent / max(1, len(latencies)),
+        "share_fast": stats["backends"]["fast"]["ok"] / max(1, len(latencies)),
+        "hedged": stats["hedged"],
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Benchmark routing policies on stub backends")
+    parser.add_argument("--fast", default="median_ms=80,sigma=0.3,tail_rate=0.05,tail_ms=1000,capacity=4",
+                        help="StubBackend options for the first backend")
+    parser.add_argument("--slow", default="median_ms=300,sigma=0.2,capacity=32",
+                        help="StubBackend options for the second backend")
+    parser.add_argument("--rate", type=float, default=30.0, help="Requests per second")
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--timeout", type=float, default=10.0, help="Per-request deadline (seconds)")
+    parser.add_argument("--hedge-quantile", type=float, default=0.95)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    print(f"{'policy':<10} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'fast':>6} {'hedged':>7} {'sent/ans':>9} {'failed':>7}")
+    for policy in ("random", "latency", "hedged"):
+        r = await run(policy, args)
+        print(f"{policy:<10} {r['p50'] * 1000:>8.0f} {r['p95'] * 1000:>8.0f} {r['p99'] * 1000:>8.0f} "
+              f"{r['share_fast']:>6.0%} {r['hedged']:>7} {r['backend_requests_per_answer']:>9.2f} {r['failures']:>7}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
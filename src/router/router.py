@@ -0,0 +1,167 @@
+"""
+Latency-aware routing across backends, with fallback and optional hedging.
+
+Each question goes to the available backend with the lowest expected latency:
+its recent median, stretched by the queue already waiting there. When
+that backend fails or turns the request away, the next best one gets it,
+until the deadline. A backend that fails repeatedly or answers 503/429 sits
+out for a while (see Backend). A request the backend refused as invalid (a
+4xx other than 429) goes back to the client as it is: another backend would
+refuse it too.
+
+With hedging, if the chosen backend has not answered after its recent
+p95 latency, the same question also goes to the next best backend; the first
+answer wins and the other request is cancelled. At most about 5% of requests
+are sent twice, and a slow outlier costs little more than a p95 wait.
+"""
+import asyncio
+import time
+from typing import Dict, List, Optional
+
+from backends import Backend, BackendError, BackendOverloaded, BackendRejected
+from metrics import REGISTRY
+
+ROUTED = REGISTRY.counter("router_requests_total", "Requests answered, by the backend that answered", ["backend"])
+FALLBACKS = REGISTRY.counter("router_fallbacks_total", "Requests moved on to another backend, by reason", ["reason"])
+HEDGES = REGISTRY.counter("router_hedges_total", "Hedge requests fired, by which request answered first", ["winner"])
+ROUTING_FAILURES = REGISTRY.counter("router_failures_total", "Requests no backend answered")
+
+
+class RoutingFailed(Exception):
+    """No backend answered before the deadline"""
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class Router:
+    def __init__(self, backends: List[Backend], hedge: bool = False, hedge_quantile: float = 0.95,
+                 min_hedge_delay: float = 0.05, probe_interval: float = 5.0):
+        """
+        Args:
+            backends: Backends to route between
+            hedge: Send a second request when the first is slower than its backend's hedge_quantile latency
+            hedge_quantile: Latency quantile after which a request is hedged
+            min_hedge_delay: Never hedge sooner than this (seconds)
+            probe_interval: Send one request to a backend that hasn't answered for this long, so a backend that
+                was slow (or hasn't been timed yet) gets measured again
+        """
+        self.backends = backends
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.min_hedge_delay = min_hedge_delay
+        self.probe_interval = probe_interval
+        self._counts = {"requests": 0, "fallbacks": 0, "hedged": 0, "hedge_wins": 0, "rejected": 0, "failures": 0}
+
+    def rank(self) -> List[Backend]:
+        """Available backends, best first"""
+        now = time.monotonic()
+        available = [b for b in self.backends if b.available]
+        stale = [b for b in available if b.in_flight == 0 and now - b.last_answer_at > self.probe_interval]
+        if stale:
+            # Probe: the backend is idle, and its estimate is too old to trust
+            stale[0].last_answer_at = now
+            return stale[:1] + sorted((b for b in available if b is not stale[0]), key=Backend.expected_latency)
+        return sorted(available, key=Backend.expected_latency)
+
+    def hedge_delay(self, backend: Backend) -> Optional[float]:
+        """Seconds to wait for backend before hedging; None until it has answered often enough to know its tail"""
+        quantile = backend.latency_quantile(self.hedge_quantile)
+        return None if quantile is None else max(quantile, self.min_hedge_delay)
+
+    async def ask(self, user: str, question: str, deadline: Optional[float] = None) -> Dict:
+        """
+        Args:
+            user: Counseling server user
+            question: The question
+            deadline: time.monotonic() by which an answer is needed
+        Returns:
+            The answering backend's response, plus 'backend' and 'hedged'
+        Raises:
+            BackendRejected: A backend refused the request itself (e.g. unknown user); pass its status on
+            RoutingFailed: Every backend failed or is out of rotation, or the deadline passed
+        """
+        self._counts["requests"] += 1
+        tried = set()
+        error = None
+        while deadline is None or time.monotonic() < deadline:
+            candidates = [b for b in self.rank() if b not in tried]
+            if not candidates:
+                break
+            primary = candidates[0]
+            hedge = candidates[1] if self.hedge and len(candidates) > 1 else None
+            try:
+                timeout = None if deadline is None else deadline - time.monotonic()
+                return await asyncio.wait_for(self._race(primary, hedge, user, question, deadline, tried), timeout)
+            except BackendRejected:
+                self._counts["rejected"] += 1
+                raise
+            except asyncio.TimeoutError:
+                error = BackendError("Deadline passed")
+                break
+            except BackendError as e:
+                error = e
+                reason = "overloaded" if isinstance(e, BackendOverloaded) else "error"
+                self._counts["fallbacks"] += 1
+                FALLBACKS.inc(reason=reason)
+
+        self._counts["failures"] += 1
+        ROUTING_FAILURES.inc()
+        waits = [b.unavailable_until - time.monotonic() for b in self.backends]
+        raise RoutingFailed(f"No backend answered: {error or 'all backends are out of rotation'}",
+                            max(1.0, min(waits)))
+
+    async def _race(self, primary: Backend, hedge: Optional[Backend], user: str, question: str,
+                    deadline: Optional[float], tried: set) -> Dict:
+        """Ask primary; past its hedge delay, ask hedge too and take whichever answers first"""
+        tried.add(primary)
+        tasks = {asyncio.create_task(primary.ask(user, question, deadline)): primary}
+        try:
+            delay = self.hedge_delay(primary) if hedge is not None else None
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done:
+                tried.add(hedge)
+                tasks[asyncio.create_task(hedge.ask(user, question, deadline))] = hedge
+                self._counts["hedged"] += 1
+
+            pending = set(tasks)
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if isinstance(task.exception(), BackendRejected):
+                        raise task.exception()
+                    if task.exception() is not None:
+                        error = task.exception()
+                        continue
+                    backend = tasks[task]
+                    if len(tasks) > 1:
+                        HEDGES.inc(winner="hedge" if backend is hedge else "primary")
+                        if backend is hedge:
+                            self._counts["hedge_wins"] += 1
+                    ROUTED.inc(backend=backend.name)
+                    return {**task.result(), "backend": backend.name, "hedged": len(tasks) > 1}
+            raise error
+        finally:
+            # The losing (or abandoned) request is cancelled; its backend stops waiting on it
+            unfinished = [task for task in tasks if not task.done()]
+            for task in unfinished:
+                task.cancel()
+            if unfinished:
+                await asyncio.gather(*unfinished, return_exceptions=True)
+
+    async def clear(self, user: str):
+        """Clear the user's history on every backend"""
+        await asyncio.gather(*(b.clear(user) for b in self.backends), return_exceptions=True)
+
+    async def close(self):
+        for backend in self.backends:
+            await backend.close()
+
+    def stats(self) -> dict:
+        return {
+            "hedge": self.hedge,
+            **self._counts,
+            "backends": {b.name: b.stats() for b in self.backends},
+        }
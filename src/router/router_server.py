@@ -0,0 +1,125 @@
+import argparse
+import os
+import sys
+import time
+
+# Modules shared by both servers and the router (metrics, clients, storage, ...) live in src/common
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "common"))
+
+from aiohttp import web
+from backends import BackendRejected, HttpBackend, StubBackend
+from router import Router, RoutingFailed
+from metrics import metrics_middleware, handle_metrics
+from datetime import datetime
+
+# One front port for both counseling servers
+DEFAULT_BACKENDS = ["anthropic=http://localhost:8080", "local=http://localhost:8081"]
+
+router = None
+request_timeout = 60.0  # Default deadline in seconds; clients may ask for less with X-Request-Timeout
+
+
+def request_deadline(request) -> float:
+    """time.monotonic() deadline from the X-Request-Timeout header (seconds), capped at --request-timeout"""
+    timeout = request_timeout
+    header = request.headers.get('X-Request-Timeout')
+    if header:
+        try:
+            timeout = min(timeout, max(0.0, float(header)))
+        except ValueError:
+            pass
+    return time.monotonic() + timeout
+
+async def handle_request(request):
+    try:
+        data = await request.json()
+        user = data['user']
+        question = data['question']
+    except Exception as e:
+        return web.json_response({'error': str(e)}, status=400)
+
+    try:
+        result = await router.ask(user, question, request_deadline(request))
+    except BackendRejected as e:
+        current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        print(f"[{current_time}] Backend refused {user}'s request with status code: {e}")
+        return web.json_response(e.body, status=e.status)
+    except RoutingFailed as e:
+        current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        print(f"[{current_time}] No backend answered {user} with status code: 503 - {e}")
+        return web.json_response({'error': str(e)}, status=503,
+                                 headers={'Retry-After': str(max(1, round(e.retry_after)))})
+
+    current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    print(f"[{current_time}] Routed {user} to {result['backend']}{' (hedged)' if result['hedged'] else ''}")
+    return web.json_response(result)
+
+async def clear_conversation(request):
+    try:
+        data = await request.json()
+        user = data['user']
+        await router.clear(user)
+
+        current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        print(f"[{current_time}] Cleared conversation history for {user} on every backend")
+
+        return web.json_response({'message': f'Conversation history cleared for {user}'})
+    except Exception as e:
+        return web.json_response({'error': str(e)}, status=400)
+
+async def health_check(request):
+    stats = router.stats()
+    healthy = any(backend['available'] for backend in stats['backends'].values())
+    return web.json_response({
+        'status': 'healthy' if healthy else 'degraded',
+        'router': stats,
+        'timestamp': datetime.now().isoformat()
+    })
+
+async def close_router(app):
+    await router.close()
+
+def parse_stub(spec: str) -> StubBackend:
+    """NAME[:key=value,...] with StubBackend's keyword arguments, e.g. fast:median_ms=80,sigma=0.5,tail_rate=0.02"""
+    name, _, options = spec.partition(':')
+    kwargs = {}
+    for option in filter(None, options.split(',')):
+        key, value = option.split('=')
+        kwargs[key] = int(value) if value.isdigit() else float(value)
+    return StubBackend(name, **kwargs)
+
+app = web.Application(middlewares=[metrics_middleware])
+app.router.add_post('/ask', handle_request)
+app.router.add_post('/clear', clear_conversation)
+app.router.add_get('/health', health_check)
+app.router.add_get('/metrics', handle_metrics)
+app.on_cleanup.append(close_router)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Front server routing /ask to the fastest counseling backend")
+    parser.add_argument("--backend", action="append", default=None, metavar="NAME=URL",
+                        help=f"Counseling server to route to; repeat for more (default: {' '.join(DEFAULT_BACKENDS)})")
+    parser.add_argument("--stub", action="append", default=[], metavar="NAME[:key=value,...]",
+                        help="Add a fake backend with StubBackend options, e.g. fast:median_ms=80,sigma=0.5")
+    parser.add_argument("--capacity", type=int, default=8, help="Requests each backend serves at once")
+    parser.add_argument("--hedge", action="store_true",
+                        help="Also ask the next best backend when the first is slower than its p95")
+    parser.add_argument("--hedge-quantile", type=float, default=0.95, help="Latency quantile that triggers a hedge")
+    parser.add_argument("--min-hedge-ms", type=float, default=50.0, help="Never hedge sooner than this")
+    parser.add_argument("--request-timeout", type=float, default=60.0,
+                        help="Seconds a request may take across all backends (clients can lower it with X-Request-Timeout)")
+    parser.add_argument("--port", type=int, default=8000)
+    args = parser.parse_args()
+
+    backends = []
+    for spec in args.backend or ([] if args.stub else DEFAULT_BACKENDS):
+        name, url = spec.split('=', 1)
+        backends.append(HttpBackend(name, url, capacity=args.capacity))
+    backends.extend(parse_stub(spec) for spec in args.stub)
+
+    router = Router(backends, hedge=args.hedge, hedge_quantile=args.hedge_quantile,
+                    min_hedge_delay=args.min_hedge_ms / 1000)
+    request_timeout = args.request_timeout
+
+    print(f"Routing between {', '.join(b.name for b in backends)}{' with hedging' if args.hedge else ''}")
+    web.run_app(app, port=args.port)
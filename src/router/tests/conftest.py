@@ -0,0 +1,8 @@
+import os
+import sys
+
+# The router modules import each other by bare name, as when run from src/router, and the
+# shared ones from src/common
+MODULE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, MODULE_DIR)
+sys.path.insert(0, os.path.join(MODULE_DIR, os.pardir, "common"))
@@ -0,0 +1,55 @@
+import asyncio
+
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+import router_server
+from backends import HttpBackend
+from router import Router
+
+USERS = {"Linda", "Mike", "Miguel"}
+
+
+def counseling_app(calls):
+    """A counseling server that knows USERS and answers 400 for anyone else, like the real ones"""
+
+    async def handle_ask(request):
+        data = await request.json()
+        calls.append(data["user"])
+        if data["user"] not in USERS:
+            return web.json_response({"error": f"Unknown user: {data['user']}"}, status=400)
+        return web.json_response({"user": data["user"], "response": "ok"})
+
+    app = web.Application()
+    app.router.add_post("/ask", handle_ask)
+    return app
+
+
+def test_client_errors_are_passed_through_without_failing_backends(monkeypatch):
+    async def run():
+        calls = [[], []]
+        servers = [TestServer(counseling_app(calls[0])), TestServer(counseling_app(calls[1]))]
+        for server in servers:
+            await server.start_server()
+        backends = [HttpBackend(f"b{i}", str(server.make_url(""))) for i, server in enumerate(servers)]
+        monkeypatch.setattr(router_server, "router", Router(backends))
+        client = TestClient(TestServer(router_server.app))
+        await client.start_server()
+        try:
+            for _ in range(2 * backends[0].failure_threshold):
+                resp = await client.post("/ask", json={"user": "Nobody", "question": "hi"})
+                assert resp.status == 400
+                assert (await resp.json()) == {"error": "Unknown user: Nobody"}
+            # Each bad request went to one backend only, and neither left the rotation
+            assert len(calls[0]) + len(calls[1]) == 2 * backends[0].failure_threshold
+            assert all(backend.available and backend.consecutive_failures == 0 for backend in backends)
+
+            resp = await client.post("/ask", json={"user": "Linda", "question": "hi"})
+            assert resp.status == 200
+            assert (await resp.json())["response"] == "ok"
+        finally:
+            await client.close()
+            for server in servers:
+                await server.close()
+
+    asyncio.run(run())
@@ -0,0 +1,198 @@
+"""
+Admission control for the model: bounded queue, deadlines and per-user rate limits.
+
+At most max_concurrency requests use the model at once and at most
+max_queue wait for a turn; anything beyond that is rejected immediately
+instead of piling up behind the model lock. Every request carries a
+deadline (time.monotonic() based, so it means the same in replica
+processes). A request whose deadline passes while it waits is dropped
+before it reaches the model, and one that could not start before its
+deadline even at the current service rate is rejected without queueing.
+"""
+import asyncio
+import collections
+import math
+import threading
+import time
+from typing import Dict, Optional
+
+from metrics import REGISTRY
+
+REJECTED = REGISTRY.counter("admission_rejected_total", "Requests rejected before reaching the model, by reason",
+                            ["reason"])
+ADMISSION_WAIT = REGISTRY.histogram("admission_wait_seconds", "Time a request waited for a model slot")
+ADMISSION_QUEUE_DEPTH = REGISTRY.gauge("admission_queue_depth", "Requests waiting for a model slot")
+ADMISSION_IN_FLIGHT = REGISTRY.gauge("admission_in_flight", "Requests holding a model slot")
+
+
+class DeadlineExceeded(Exception):
+    """The request's deadline passed before the model got to it"""
+
+
+class Overloaded(Exception):
+    """The queue is full, or the request could not start before its deadline"""
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    def __init__(self, max_concurrency: int = 8, max_queue: int = 64):
+        """
+        Args:
+            max_concurrency: Requests given to the model at once (match the batch size)
+            max_queue: Requests allowed to wait for a slot; more are rejected
+        """
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.in_flight = 0
+        self._waiters = collections.deque()  # Futures in arrival order
+        self._service_time = None  # Moving average of seconds a slot is held
+        self._counts = {"admitted": 0, "queue_full": 0, "deadline_unreachable": 0, "expired": 0}
+
+    def expected_wait(self) -> float:
+        """Seconds a request arriving now would wait for a slot, from the recent service time"""
+        if self.in_flight < self.max_concurrency and not self._waiters:
+            return 0.0
+        service_time = self._service_time or 1.0
+        return service_time * (len(self._waiters) + 1) / self.max_concurrency
+
+    def slot(self, deadline: Optional[float] = None) -> "_Slot":
+        """
+        Async context manager holding one model slot
+        Raises:
+            Overloaded: Queue full, or the expected wait already exceeds the deadline
+            DeadlineExceeded: The deadline passed while waiting
+        """
+        return _Slot(self, deadline)
+
+    async def _acquire(self, deadline: Optional[float]):
+        if deadline is not None and time.monotonic() >= deadline:
+            # Spent its time behind the same user's earlier turns
+            self._reject("expired")
+            raise DeadlineExceeded("Deadline passed before the request reached the model")
+        if self.in_flight < self.max_concurrency and not self._waiters:
+            self.in_flight += 1
+            self._counts["admitted"] += 1
+            ADMISSION_IN_FLIGHT.set(self.in_flight)
+            ADMISSION_WAIT.observe(0.0)
+            return
+
+        if len(self._waiters) >= self.max_queue:
+            self._reject("queue_full")
+            raise Overloaded("Server is at capacity, try again later", self.expected_wait())
+        wait = self.expected_wait()
+        if deadline is not None and time.monotonic() + wait > deadline:
+            self._reject("deadline_unreachable")
+            raise Overloaded(f"Expected wait of {wait:.1f}s exceeds the request deadline", wait)
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        ADMISSION_QUEUE_DEPTH.set(len(self._waiters))
+        start = time.monotonic()
+        timeout = None if deadline is None else max(0.0, deadline - start)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), timeout)
+        except asyncio.TimeoutError:
+            self._abandon(waiter)
+            self._reject("expired")
+            raise DeadlineExceeded("Deadline passed while waiting for the model")
+        except asyncio.CancelledError:
+            self._abandon(waiter)
+            raise
+        ADMISSION_WAIT.observe(time.monotonic() - start)
+
+    def _abandon(self, waiter: asyncio.Future):
+        if waiter.done() and not waiter.cancelled():
+            # The slot was handed over just as we gave up; pass it on
+            self._release(None)
+        else:
+            waiter.cancel()
+            try:
+                self._waiters.remove(waiter)
+            except ValueError:
+                pass
+        ADMISSION_QUEUE_DEPTH.set(len(self._waiters))
+
+    def _reject(self, reason: str):
+        self._counts[reason] += 1
+        REJECTED.inc(reason=reason)
+
+    def _release(self, held: Optional[float]):
+        """Free a slot (held: seconds it was held, for the service time estimate) and wake the next waiter"""
+        if held is not None:
+            self._service_time = held if self._service_time is None else 0.8 * self._service_time + 0.2 * held
+        self.in_flight -= 1
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self.in_flight += 1
+                self._counts["admitted"] += 1
+                waiter.set_result(None)
+                break
+        ADMISSION_IN_FLIGHT.set(self.in_flight)
+        ADMISSION_QUEUE_DEPTH.set(len(self._waiters))
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": self.in_flight,
+            "queued": len(self._waiters),
+            "max_concurrency": self.max_concurrency,
+            "max_queue": self.max_queue,
+            "service_time": round(self._service_time, 3) if self._service_time is not None else None,
+            **self._counts,
+        }
+
+
+class _Slot:
+    def __init__(self, controller: AdmissionController, deadline: Optional[float]):
+        self.controller = controller
+        self.deadline = deadline
+
+    async def __aenter__(self):
+        await self.controller._acquire(self.deadline)
+        self.acquired_at = time.monotonic()
+        return self
+
+    async def __aexit__(self, *exc):
+        self.controller._release(time.monotonic() - self.acquired_at)
+        return False
+
+
+class RateLimiter:
+    """Per-user token buckets: `rate` requests per second on average, bursts of up to `burst`"""
+
+    def __init__(self, rate: float, burst: float = 5.0, max_users: int = 100_000):
+        self.rate = rate
+        self.burst = burst
+        self.max_users = max_users
+        self._buckets: Dict[str, list] = collections.OrderedDict()  # user -> [tokens, last refill]
+        self._lock = threading.Lock()
+        self.limited = 0
+
+    def acquire(self, user: str) -> float:
+        """Take one token for user; returns 0 if allowed, otherwise the seconds until a token is available"""
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.pop(user, None) or [self.burst, now]
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            self._buckets[user] = bucket  # Most recently used last
+            if len(self._buckets) > self.max_users:
+                # The least recently seen user's bucket has most likely refilled; forgetting it costs nothing
+                self._buckets.popitem(last=False)
+            if bucket[0] >= 1.0:
+                bucket[0] -= 1.0
+                return 0.0
+            self.limited += 1
+        REJECTED.inc(reason="rate_limited")
+        return (1.0 - bucket[0]) / self.rate
+
+    def stats(self) -> dict:
+        return {"rate": self.rate, "burst": self.burst, "users": len(self._buckets), "limited": self.limited}
+
+
+def retry_after_header(seconds: float) -> Dict[str, str]:
+    """Retry-After takes whole seconds; never tell clients to retry immediately"""
+    return {"Retry-After": str(max(1, math.ceil(seconds)))}
@@ -0,0 +1,141 @@
+"""
+Startup time, first-access latency and memory of conversation histories with many users.
+
+Writes --users synthetic histories in the old whole-file layout, then compares:
+- the old startup, which parsed that whole file into memory, against
+- the per-user layout (the file is split into user files once, as a server does
+  on its first start), whose startup reads only the log tail and whose histories
+  load on first access into a hot set capped at --cache-mb.
+
+Memory is the Python heap measured with tracemalloc. Timings are taken in a
+separate run without tracing. First-access latencies come from the OS page
+cache, since the files were just written; on a cold disk add a seek each.
+
+    python bench_history_load.py --users 100000 --turns 4 --cache-mb 64
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# Modules shared by both servers and the router (metrics, clients, storage, ...) live in src/common
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "common"))
+
+from memory import LocalConversationMemory
+
+QUESTION = "How can I manage my time better during exam week when I also work part-time? (turn {turn})"
+ANSWER = ("Block out fixed study sessions of about 50 minutes with short breaks, and protect your sleep. "
+          "Talk to your manager about lighter shifts early. (turn {turn})")
+
+
+def synthetic_conversations(users: int, turns: int) -> dict:
+    conversations = {}
+    for u in range(users):
+        history = []
+        for turn in range(turns):
+            history.append({"role": "user", "content": QUESTION.format(turn=turn), "timestamp": "2025-01-01T00:00:00"})
+            history.append({"role": "assistant", "content": ANSWER.format(turn=turn), "timestamp": "2025-01-01T00:00:00"})
+        conversations[f"user{u}"] = history
+    return conversations
+
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return time.perf_counter() - start, result
+
+
+def heap(fn):
+    """(Python heap bytes still allocated after fn, result of fn)"""
+    tracemalloc.start()
+    try:
+        result = fn()
+        current, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return current, result
+
+
+def load_whole_file(path: str) -> dict:
+    """The old startup: the snapshot holds every user's history"""
+    with open(path, 'r') as f:
+        return json.load(f)["conversations"]
+
+
+def percentiles(samples):
+    ordered = sorted(samples)
+    return (statistics.median(ordered) * 1000, ordered[int(len(ordered) * 0.99)] * 1000)
+
+
+def mb(size: float) -> str:
+    return f"{size / 2 ** 20:.1f} MB"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark lazy per-user history loading against loading everything")
+    parser.add_argument("--users", type=int, default=100000)
+    parser.add_argument("--turns", type=int, default=4, help="Question/answer pairs per user")
+    parser.add_argument("--cache-mb", type=float, default=64.0, help="Hot set limit of the per-user layout")
+    parser.add_argument("--samples", type=int, default=5000, help="Users read for the latency percentiles")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench_history_")
+    try:
+        old_file = os.path.join(workdir, "old.json")
+        new_file = os.path.join(workdir, "new.json")
+        with open(old_file, 'w') as f:
+            json.dump({"seq": 0, "conversations": synthetic_conversations(args.users, args.turns)}, f)
+        shutil.copy(old_file, new_file)
+        print(f"{args.users} users, {2 * args.turns} messages each, {mb(os.path.getsize(old_file))} on disk")
+
+        old_time, _ = timed(lambda: load_whole_file(old_file))
+        old_heap, _ = heap(lambda: load_whole_file(old_file))
+        print(f"\nWhole file:  startup {old_time * 1000:9.1f} ms, resident {mb(old_heap)} (every history)")
+
+        cache_bytes = int(args.cache_mb * 2 ** 20)
+        migrate_time, _ = timed(lambda: LocalConversationMemory(new_file, max_cached_bytes=cache_bytes))
+        print(f"Split into user files once: {migrate_time:.1f} s")
+
+        start_time, memory = timed(lambda: LocalConversationMemory(new_file, max_cached_bytes=cache_bytes))
+        start_heap, _ = heap(lambda: LocalConversationMemory(new_file, max_cached_bytes=cache_bytes))
+        print(f"Per user:    startup {start_time * 1000:9.1f} ms, resident {mb(start_heap)} (no history yet)")
+
+        rng = random.Random(0)
+        users = [f"user{u}" for u in rng.sample(range(args.users), min(args.samples, args.users))]
+        cold = []
+        for user in users:
+            elapsed, _ = timed(lambda: memory.get_conversation_history(user))
+            cold.append(elapsed)
+        hot_users = list(memory.conversations)[-min(1000, len(memory.conversations)):]
+        hot = []
+        for user in hot_users:
+            elapsed, _ = timed(lambda: memory.get_conversation_history(user))
+            hot.append(elapsed)
+        print(f"First access p50 {percentiles(cold)[0]:.3f} ms, p99 {percentiles(cold)[1]:.3f} ms; "
+              f"cached p50 {percentiles(hot)[0] * 1000:.2f} us")
+
+        # Every user once, through a fresh instance, to fill the hot set up to its limit
+        def touch_all():
+            capped = LocalConversationMemory(new_file, max_cached_bytes=cache_bytes)
+            for u in range(args.users):
+                capped.get_conversation_history(f"user{u}")
+            return capped
+
+        touch_time, _ = timed(touch_all)
+        capped_heap, capped = heap(touch_all)
+        stats = capped.stats()
+        print(f"All users read once: {touch_time:.1f} s; {stats['cached_users']} histories kept, estimated "
+              f"{mb(stats['cached_bytes'])} of {mb(stats['max_cached_bytes'])}, resident {mb(capped_heap)}, "
+              f"{stats['evictions']} evicted")
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+# Modules shared by both servers and the router (metrics, clients, storage, ...) live in src/common
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "common"))
+
+from memory import LocalConversationMemory
+
+MESSAGE = "What are effective study techniques for finals? " * 4
+
+
+class RewriteMemory(LocalConversationMemory):
+    """The previous persistence scheme: rewrite the whole JSON file on every message"""
+
+    def add_message(self, user: str, role: str, content: str):
+        self.conversations.setdefault(user, []).append({"role": role, "content": content, "timestamp": ""})
+        with open(self.storage_file, 'w') as f:
+            json.dump(self.conversations, f, indent=2)
+
+
+def measure(memory, users: int, total: int, checkpoint: int):
+    """Add messages round-robin across users and time each block of `checkpoint` messages"""
+    rows = []
+    start = time.perf_counter()
+    for i in range(1, total + 1):
+        memory.add_message(f"user{i % users}", "user", MESSAGE)
+        if i % checkpoint == 0:
+            elapsed = time.perf_counter() - start
+            rows.append((i, elapsed / checkpoint * 1e6))
+            start = time.perf_counter()
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-message write cost of conversation memory as the store grows")
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--checkpoint", type=int, default=2000)
+    parser.add_argument("--rewrite-limit", type=int, default=4000,
+                        help="Stop the full-rewrite baseline here; it is quadratic")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench_memory_")
+    try:
+        log_memory = LocalConversationMemory(os.path.join(workdir, "log.json"))
+        log_rows = measure(log_memory, args.users, args.messages, args.checkpoint)
+        flush_start = time.perf_counter()
+        log_memory.store.flush()
+        flush_time = time.perf_counter() - flush_start
+
+        rewrite_memory = RewriteMemory(os.path.join(workdir, "rewrite.json"))
+        rewrite_rows = measure(rewrite_memory, args.users, min(args.messages, args.rewrite_limit), args.checkpoint)
+
+        print(f"{'messages':>10} {'append log (us/msg)':>20} {'full rewrite (us/msg)':>22}")
+        for index, (count, log_cost) in enumerate(log_rows):
+            rewrite_cost = f"{rewrite_rows[index][1]:.1f}" if index < len(rewrite_rows) else "-"
+            print(f"{count:>10} {log_cost:>20.1f} {rewrite_cost:>22}")
+
+        stats = log_memory.store.stats()
+        print(f"\nAppend log: {stats['group_commits']} group commits, {stats['compactions']} compactions, "
+              f"final flush {flush_time * 1000:.1f} ms")
+
+        # Recovery check: a fresh instance must see every message
+        restarted = LocalConversationMemory(os.path.join(workdir, "log.json"))
+        recovered = sum(len(restarted.get_conversation_history(f"user{u}")) for u in range(args.users))
+        print(f"Recovered {recovered}/{args.messages} messages from user files + log")
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+"""
+Compare load time, memory, speed and output quality of the model's precision modes.
+
+Each mode is measured in a fresh process so resident memory and torch's
+thread pools are not shared between modes. fp32 runs first and provides the
+reference continuation; the other modes are scored on it.
+
+    python bench_precision.py --modes fp32,bf16,int8,fp32+compile --threads 8
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import resource
+import sys
+import time
+
+# Modules shared by both servers and the router (metrics, clients, storage, ...) live in src/common
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "common"))
+
+PROMPT = ("You are an expert University counselor AI assistant helping a university Student. "
+          "User: I have three finals next week and I keep procrastinating. How should I plan my study time "
+          "so that I cover everything without burning out?\nAssistant:")
+
+
+def parse_mode(mode: str) -> dict:
+    """"bf16+compile" -> LocalLLMModel options"""
+    options = {"dtype": "fp32", "quantize": None, "compile_model": False}
+    for part in mode.split("+"):
+        if part in ("fp32", "bf16"):
+            options["dtype"] = part
+        elif part == "int8":
+            options["quantize"] = "int8"
+        elif part == "compile":
+            options["compile_model"] = True
+        else:
+            raise ValueError(f"Unknown mode part {part!r}")
+    return options
+
+
+def rss_mb() -> float:
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def measure(mode: str, args, reference: list) -> dict:
+    """Runs in a child process; returns the measurements for one mode"""
+    import torch
+    from local_llm import LocalLLMModel
+
+    llm = LocalLLMModel(args.model, device="cpu", batching=False, kv_cache_bytes=0, num_threads=args.threads,
+                        interop_threads=args.interop_threads, **parse_mode(mode))
+    start = time.perf_counter()
+    asyncio.run(llm.initialize())
+    load_seconds = time.perf_counter() - start
+    model = llm.model
+
+    prompt_ids = llm.tokenizer(PROMPT, return_tensors="pt")["input_ids"]
+    repeat = max(1, args.prompt_tokens // prompt_ids.shape[1])
+    prefill_ids = prompt_ids.repeat(1, repeat)[:, :args.prompt_tokens]
+
+    with torch.inference_mode():
+        # Warm-up (and, when compiling, the trace for these shapes)
+        for _ in range(args.warmup):
+            model(input_ids=prefill_ids, use_cache=True)
+
+        start = time.perf_counter()
+        for _ in range(args.runs):
+            outputs = model(input_ids=prefill_ids, use_cache=True)
+        prefill_seconds = (time.perf_counter() - start) / args.runs
+
+        # Greedy decode from the prompt, one token per forward pass
+        outputs = model(input_ids=prompt_ids, use_cache=True)
+        past, tokens = outputs.past_key_values, []
+        next_token = outputs.logits[:, -1].argmax(-1, keepdim=True)
+        start = time.perf_counter()
+        for _ in range(args.new_tokens):
+            tokens.append(next_token.item())
+            outputs = model(input_ids=next_token, past_key_values=past, use_cache=True)
+            past = outputs.past_key_values
+            next_token = outputs.logits[:, -1].argmax(-1, keepdim=True)
+        decode_seconds = time.perf_counter() - start
+
+        # Score against the fp32 continuation with teacher forcing, so one early divergence doesn't dominate
+        agreement = None
+        if reference:
+            sequence = torch.cat([prompt_ids, torch.tensor([reference])], dim=1)
+            logits = model(input_ids=sequence).logits[0, prompt_ids.shape[1] - 1:-1]
+            agreement = (logits.argmax(-1) == torch.tensor(reference)).float().mean().item()
+
+    matching = 0
+    for ours, theirs in zip(tokens, reference or tokens):
+        if ours != theirs:
+            break
+        matching += 1
+
+    return {
+        "mode": mode,
+        "load_seconds": load_seconds,
+        "rss_mb": rss_mb(),
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "prefill_tokens_per_second": args.prompt_tokens / prefill_seconds,
+        "decode_tokens_per_second": args.new_tokens / decode_seconds,
+        "tokens": tokens,
+        "greedy_match": matching / len(tokens),
+        "top1_agreement": agreement if agreement is not None else 1.0,
+    }
+
+
+def _child(mode, args, reference, results):
+    try:
+        results.put(measure(mode, args, reference))
+    except Exception as e:
+        results.put({"mode": mode, "error": f"{type(e).__name__}: {e}"})
+
+
+def run_isolated(mode: str, args, reference: list) -> dict:
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    process = context.Process(target=_child, args=(mode, args, reference, results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark CPU precision and compilation modes of the local model")
+    parser.add_argument("--model", default="meta-llama/Llama-3.2-1B")
+    parser.add_argument("--modes", default="fp32,bf16,int8,fp32+compile",
+                        help="Comma-separated modes; combine parts with + (fp32|bf16, int8, compile)")
+    parser.add_argument("--threads", type=int, default=None, help="Torch intra-op threads")
+    parser.add_argument("--interop-threads", type=int, default=None, help="Torch inter-op threads")
+    parser.add_argument("--prompt-tokens", type=int, default=512, help="Prompt length for the prefill measurement")
+    parser.add_argument("--new-tokens", type=int, default=64, help="Tokens decoded for the decode measurement")
+    parser.add_argument("--runs", type=int, default=3, help="Timed prefill passes")
+    parser.add_argument("--warmup", type=int, default=1, help="Untimed prefill passes first")
+    args = parser.parse_args()
+
+    modes = [mode.strip() for mode in args.modes.split(",") if mode.strip()]
+    for mode in modes:
+        parse_mode(mode)  # Fail on typos before loading anything
+    if "fp32" in modes:
+        modes.remove("fp32")
+    modes.insert(0, "fp32")
+
+    print(f"{'mode':<16} {'load s':>7} {'RSS MB':>8} {'peak MB':>8} {'prefill tok/s':>14} {'decode tok/s':>13} "
+          f"{'greedy match':>13} {'top-1 agree':>12}")
+    reference = []
+    for mode in modes:
+        result = run_isolated(mode, args, reference)
+        if "error" in result:
+            print(f"{mode:<16} failed: {result['error']}")
+            continue
+        if mode == "fp32":
+            reference = result["tokens"]
+        print(f"{mode:<16} {result['load_seconds']:>7.1f} {result['rss_mb']:>8.0f} {result['peak_rss_mb']:>8.0f} "
+              f"{result['prefill_tokens_per_second']:>14.1f} {result['decode_tokens_per_second']:>13.1f} "
+              f"{result['greedy_match']:>12.0%} {result['top1_agreement']:>11.0%}")
+    print(f"\nGreedy match: share of the {args.new_tokens} greedy tokens identical to fp32 before the first difference. "
+          f"Top-1 agree: share of positions on fp32's continuation where the mode picks the same next token.")
+
+
+if __name__ == "__main__":
+    main()
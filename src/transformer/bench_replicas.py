@@ -0,0 +1,102 @@
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+
+# Modules shared by both servers and the router (metrics, clients, storage, ...) live in src/common
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "common"))
+
+from replica_pool import ReplicaPool
+
+QUESTIONS = [
+    "What are effective study techniques for finals?",
+    "How can I manage my time better?",
+    "What's the best way to prepare for exams?",
+    "How do I deal with academic stress?",
+    "Can you suggest some productivity tips?",
+    "What's a good workout routine?",
+    "How to balance sports and studies?",
+    "What are good mental health practices?",
+]
+
+SYSTEM = "You are an expert University counselor AI assistant helping a university Student."
+
+
+def memory_mb(pid: int) -> dict:
+    """Resident and proportional (shared pages split between sharers) memory of a process, Linux only"""
+    values = {}
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            for line in f:
+                name, _, rest = line.partition(":")
+                if name in ("Rss", "Pss", "Shared_Clean"):
+                    values[name] = int(rest.split()[0]) / 1024
+    except OSError:
+        pass
+    return values
+
+
+async def run(replicas: int, args) -> dict:
+    pool = ReplicaPool(replicas, model_name=args.model, cores_per_replica=args.cores_per_replica,
+                       weights_dir=args.weights_dir, max_batch_size=args.batch_size)
+    start = time.perf_counter()
+    await pool.initialize()
+    startup = time.perf_counter() - start
+
+    rng = random.Random(0)
+
+    async def one(i):
+        question = rng.choice(QUESTIONS)
+        # Distinct users spread over the replicas; affinity keeps each on one replica
+        response = await pool.generate_response(SYSTEM, [{"role": "user", "content": question}],
+                                                max_tokens=args.max_tokens, user=f"user{i % args.users}")
+        return pool.count_tokens(response)
+
+    # Warm-up so lazy initialization doesn't count
+    await asyncio.gather(*[one(i) for i in range(replicas)])
+
+    start = time.perf_counter()
+    tokens = await asyncio.gather(*[one(i) for i in range(args.requests)])
+    elapsed = time.perf_counter() - start
+
+    memory = [memory_mb(pid) for pid in pool.pids]
+    await pool.close()
+    return {
+        "replicas": replicas,
+        "startup": startup,
+        "elapsed": elapsed,
+        "requests_per_second": args.requests / elapsed,
+        "tokens_per_second": sum(tokens) / elapsed,
+        "rss_mb": sum(m.get("Rss", 0) for m in memory),
+        "pss_mb": sum(m.get("Pss", 0) for m in memory),
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Throughput and memory of the replica pool vs. replica count")
+    parser.add_argument("--model", default="meta-llama/Llama-3.2-1B")
+    parser.add_argument("--replicas", default="1,2,4", help="Comma-separated replica counts to measure")
+    parser.add_argument("--cores-per-replica", type=int, default=None)
+    parser.add_argument("--weights-dir", default="model_cache")
+    parser.add_argument("--requests", type=int, default=64)
+    parser.add_argument("--users", type=int, default=16)
+    parser.add_argument("--max-tokens", type=int, default=64)
+    parser.add_argument("--batch-size", type=int, default=8, help="Continuous batch size inside each replica")
+    args = parser.parse_args()
+
+    print(f"{len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()} cores available")
+    print(f"{'replicas':>8} {'startup s':>10} {'req/s':>8} {'tokens/s':>9} {'speedup':>8} {'RSS MB':>8} {'PSS MB':>8}")
+    baseline = None
+    for replicas in [int(n) for n in args.replicas.split(",")]:
+        result = await run(replicas, args)
+        baseline = baseline or result["tokens_per_second"]
+        print(f"{result['replicas']:>8} {result['startup']:>10.1f} {result['requests_per_second']:>8.2f} "
+              f"{result['tokens_per_second']:>9.1f} {result['tokens_per_second'] / baseline:>7.2f}x "
+              f"{result['rss_mb']:>8.0f} {result['pss_mb']:>8.0f}")
+    print("\nRSS counts shared weight pages once per process; PSS splits them between the processes sharing them.")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,88 @@
+"""
+Compare plain decoding with speculative decoding (prompt lookup and/or a draft model).
+
+Conversations quote earlier turns the way counseling follow-ups do, which
+is where prompt lookup finds its guesses.
+
+    python bench_speculative.py --draft-model <small model with the Llama 3.2 tokenizer> --lookahead 4
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+# Modules shared by both servers and the router (metrics, clients, storage, ...) live in src/common
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "common"))
+
+from local_llm import LlamaLocalLLM
+
+SYSTEM = "You are an expert University counselor AI assistant helping a university Student."
+
+CONVERSATIONS = [
+    [
+        {"role": "user", "content": "What are effective study techniques for finals?"},
+        {"role": "assistant", "content": "Effective study techniques for finals include spaced repetition, "
+                                         "active recall with practice questions, and studying in 25-minute blocks."},
+        {"role": "user", "content": "Can you explain active recall with practice questions in more detail?"},
+    ],
+    [
+        {"role": "user", "content": "How can I manage my time better during exam week?"},
+        {"role": "assistant", "content": "Make a schedule that lists every exam, block study time for each "
+                                         "subject, and leave time for sleep, meals and short breaks."},
+        {"role": "user", "content": "What should the schedule look like for a day with two exams?"},
+    ],
+    [
+        {"role": "user", "content": "How do I deal with academic stress?"},
+        {"role": "assistant", "content": "Regular sleep, exercise, talking to friends and breaking large tasks "
+                                         "into small steps all reduce academic stress."},
+        {"role": "user", "content": "Which of these helps most with academic stress right before an exam?"},
+    ],
+]
+
+
+async def run(mode, args) -> dict:
+    llm = LlamaLocalLLM(model_name=args.model, batching=False, kv_cache_bytes=0, speculative=mode,
+                        draft_model_name=args.draft_model, lookahead=args.lookahead, ngram_size=args.ngram_size,
+                        num_threads=args.threads)
+    await llm.initialize()
+
+    # Warm-up
+    await llm.generate_response(SYSTEM, CONVERSATIONS[0], max_tokens=8)
+
+    tokens = 0
+    start = time.perf_counter()
+    for _ in range(args.rounds):
+        for conversation in CONVERSATIONS:
+            response = await llm.generate_response(SYSTEM, conversation, max_tokens=args.max_tokens)
+            tokens += llm.count_tokens(response)
+    elapsed = time.perf_counter() - start
+    return {"tokens_per_second": tokens / elapsed, "speculative": llm.cache_stats().get("speculative")}
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Benchmark speculative decoding against plain decoding")
+    parser.add_argument("--model", default="meta-llama/Llama-3.2-1B")
+    parser.add_argument("--draft-model", default=None, help="Also measure draft-model speculation with this model")
+    parser.add_argument("--lookahead", type=int, default=4, help="Tokens proposed per verification pass")
+    parser.add_argument("--ngram-size", type=int, default=3, help="Longest n-gram prompt lookup matches")
+    parser.add_argument("--max-tokens", type=int, default=128)
+    parser.add_argument("--rounds", type=int, default=2, help="Passes over the sample conversations")
+    parser.add_argument("--threads", type=int, default=None, help="Torch intra-op threads")
+    args = parser.parse_args()
+
+    modes = [None, "prompt_lookup"] + (["draft"] if args.draft_model else [])
+    print(f"{'mode':<14} {'tokens/s':>9} {'speedup':>8} {'accepted':>10} {'tokens/pass':>12}")
+    baseline = None
+    for mode in modes:
+        result = await run(mode, args)
+        baseline = baseline or result["tokens_per_second"]
+        stats = result["speculative"]
+        accepted = f"{stats['acceptance_rate']:.0%}" if stats else "-"
+        per_pass = f"{stats['tokens_per_pass']:.2f}" if stats else "1.00"
+        print(f"{mode or 'plain':<14} {result['tokens_per_second']:>9.1f} "
+              f"{result['tokens_per_second'] / baseline:>7.2f}x {accepted:>10} {per_pass:>12}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,92 @@
+"""
+Prompt tokenization time as a conversation grows: full prompt vs cached segments.
+
+Each turn adds a question and an answer, as in a live conversation. At each
+reported length the prompt is encoded both ways with a new final question
+(the part a real request has never seen), and the two id lists are compared.
+Only the tokenizer is loaded, not the model.
+
+    python bench_tokenize.py --model meta-llama/Llama-3.2-1B --turns 128
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+# Modules shared by both servers and the router (metrics, clients, storage, ...) live in src/common
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "common"))
+
+from transformers import AutoTokenizer
+
+from local_llm import LlamaLocalLLM
+
+SYSTEM = ("You are an expert University counselor AI assistant helping a university Student who name is Linda. "
+          "Provide detailed, thoughtful, and comprehensive responses.")
+
+QUESTIONS = [
+    "What are effective study techniques for finals?",
+    "How can I manage my time better during exam week when I also work part-time?",
+    "I keep procrastinating on my thesis. What can I do about it?",
+    "How do I deal with academic stress and still sleep at least seven hours?",
+]
+
+ANSWER = ("Start by listing everything that is due in the next two weeks, then block out fixed study sessions of "
+          "about 50 minutes with short breaks. Use active recall and practice problems rather than re-reading, "
+          "and protect your sleep: memory consolidation happens overnight. If the workload still feels "
+          "unmanageable, talk to your advisor about extensions early rather than late.")
+
+
+def timed(fn, repeats: int) -> tuple:
+    """(median seconds, last result) over repeats calls of fn(i)"""
+    times, result = [], None
+    for i in range(repeats):
+        start = time.perf_counter()
+        result = fn(i)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark incremental prompt tokenization against full tokenization")
+    parser.add_argument("--model", default="meta-llama/Llama-3.2-1B", help="Model whose tokenizer is used")
+    parser.add_argument("--turns", type=int, default=128, help="Conversation length (question/answer pairs)")
+    parser.add_argument("--repeats", type=int, default=5, help="Timings per reported length (median is shown)")
+    args = parser.parse_args()
+
+    # A context limit this large never truncates, so the whole history is encoded
+    llm = LlamaLocalLLM(model_name=args.model, batching=False, max_context_tokens=10 ** 9)
+    llm.setup_tokenizer(AutoTokenizer.from_pretrained(args.model))
+    if llm.segment_cache is None:
+        print("Incremental tokenization is not exact with this tokenizer; the model tokenizes whole prompts")
+        return
+
+    report = {2 ** i for i in range(args.turns.bit_length())} | {args.turns}
+    print(f"{'turns':>6} {'tokens':>8} {'full ms':>9} {'incremental ms':>15} {'speedup':>8} {'identical':>10}")
+    history = []
+    for turn in range(1, args.turns + 1):
+        question = f"{QUESTIONS[turn % len(QUESTIONS)]} (turn {turn})"
+        # The server encodes every turn's prompt, so earlier turns are in the cache by now
+        llm.encode_conversation(SYSTEM, history + [{"role": "user", "content": question}])
+
+        if turn in report:
+            def conversation(i):
+                return history + [{"role": "user", "content": f"{question} [{i}]"}]
+
+            full, full_ids = timed(lambda i: llm._encode(llm._format_conversation(SYSTEM, conversation(i))),
+                                   args.repeats)
+            incremental, ids = timed(lambda i: llm.encode_conversation(SYSTEM, conversation(i + args.repeats)),
+                                     args.repeats)
+            # Same final question for both paths
+            identical = llm._encode(llm._format_conversation(SYSTEM, conversation(-1))) == \
+                llm.encode_conversation(SYSTEM, conversation(-1))
+            print(f"{turn:>6} {len(full_ids):>8} {full * 1000:>9.3f} {incremental * 1000:>15.3f} "
+                  f"{full / incremental:>7.1f}x {str(identical):>10}")
+
+        history += [{"role": "user", "content": question}, {"role": "assistant", "content": ANSWER}]
+
+    print(f"Segment cache: {llm.segment_cache.stats()}")
+
+
+if __name__ == "__main__":
+    main()
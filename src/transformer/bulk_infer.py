@@ -0,0 +1,158 @@
+"""
+Offline bulk inference with the local model.
+
+Reads questions from a JSONL file, one object per line:
+    {"id": "q1", "question": "...", "role": "Student", "user": "Linda"}
+"id" defaults to the line number, "role" to Student and "user" to User; a
+"messages" list can be given instead of "question", and "system" overrides
+the system prompt. Results are appended to the output JSONL as each batch
+finishes, so an interrupted run resumes where it stopped.
+
+    python bulk_infer.py questions.jsonl answers.jsonl --batch-size 16
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from typing import Dict, List
+
+# Modules shared by both servers and the router (metrics, clients, storage, ...) live in src/common
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "common"))
+
+from memory import LocalConversationMemory
+
+
+def load_requests(path: str) -> List[Dict]:
+    requests = []
+    with open(path) as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            record.setdefault("id", line_number)
+            requests.append(record)
+    return requests
+
+
+def load_finished_ids(path: str) -> set:
+    """Ids already in the output file; a torn last line from a crash is cut off so its request is redone"""
+    finished = set()
+    if not os.path.exists(path):
+        return finished
+    valid_bytes = 0
+    with open(path, "rb") as f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            try:
+                finished.add(json.loads(line)["id"])
+            except (ValueError, KeyError):
+                break
+            valid_bytes += len(line)
+    if valid_bytes < os.path.getsize(path):
+        with open(path, "r+b") as f:
+            f.truncate(valid_bytes)
+    return finished
+
+
+def build_conversation(record: Dict):
+    role = record.get("role", "Student")
+    user = record.get("user", "User")
+    system_message = record.get("system") or LocalConversationMemory.SYSTEM_PROMPT_TEMPLATE.format(user_role=role, user=user)
+    messages = record.get("messages") or [{"role": "user", "content": record["question"]}]
+    return system_message, messages
+
+
+def make_batches(items: List[Dict], batch_size: int, max_batch_tokens: int) -> List[List[Dict]]:
+    """Bucket by prompt length: sort, then cut batches of neighbours so padding stays small"""
+    batches = []
+    batch = []
+    for item in sorted(items, key=lambda item: len(item["input_ids"])):
+        width = len(item["input_ids"])  # Sorted, so the newest item is the widest
+        if batch and (len(batch) >= batch_size or (len(batch) + 1) * width > max_batch_tokens):
+            batches.append(batch)
+            batch = []
+        batch.append(item)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def padding_efficiency(batches: List[List[Dict]]) -> float:
+    """Real prompt tokens over prompt slots computed (batch size x longest prompt)"""
+    real = sum(len(item["input_ids"]) for batch in batches for item in batch)
+    computed = sum(len(batch) * max(len(item["input_ids"]) for item in batch) for batch in batches)
+    return real / computed if computed else 1.0
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Run a JSONL file of questions through the local model")
+    parser.add_argument("input", help="JSONL file of questions")
+    parser.add_argument("output", help="JSONL file of answers (appended to; existing ids are skipped)")
+    parser.add_argument("--batch-size", type=int, default=16, help="Maximum prompts per model.generate call")
+    parser.add_argument("--max-batch-tokens", type=int, default=16384,
+                        help="Maximum batch size x longest prompt, bounds prefill memory")
+    parser.add_argument("--max-tokens", type=int, default=256, help="Maximum tokens generated per prompt")
+    parser.add_argument("--temperature", type=float, default=0.3, help="0 decodes greedily")
+    args = parser.parse_args()
+
+    requests = load_requests(args.input)
+    finished = load_finished_ids(args.output)
+    pending = [record for record in requests if record["id"] not in finished]
+    print(f"{len(requests)} requests, {len(requests) - len(pending)} already done, {len(pending)} to run")
+    if not pending:
+        return
+
+    # Imported here so --help and a resume with nothing left to do don't wait for torch
+    from local_llm import LlamaLocalLLM
+
+    llm_model = LlamaLocalLLM(batching=False)
+    await llm_model.initialize()
+
+    items = []
+    for record in pending:
+        system_message, messages = build_conversation(record)
+        items.append({"record": record, "input_ids": llm_model.encode_conversation(system_message, messages)})
+
+    batches = make_batches(items, args.batch_size, args.max_batch_tokens)
+    unsorted = [items[i:i + args.batch_size] for i in range(0, len(items), args.batch_size)]
+
+    prompt_tokens = 0
+    completion_tokens = 0
+    decode_slots = 0
+    start = time.perf_counter()
+
+    with open(args.output, "a") as out:
+        for number, batch in enumerate(batches, 1):
+            results = await llm_model.generate_batch([item["input_ids"] for item in batch],
+                                                     max_tokens=args.max_tokens, temperature=args.temperature)
+
+            for item, result in zip(batch, results):
+                record = item["record"]
+                out.write(json.dumps({"id": record["id"], "question": record.get("question"), **result}) + "\n")
+
+            # Checkpoint: a finished batch survives a crash
+            out.flush()
+            os.fsync(out.fileno())
+
+            prompt_tokens += sum(result["prompt_tokens"] for result in results)
+            completion_tokens += sum(result["completion_tokens"] for result in results)
+            decode_slots += len(results) * max(result["completion_tokens"] for result in results)
+
+            elapsed = time.perf_counter() - start
+            print(f"Batch {number}/{len(batches)}: {len(batch)} prompts of {len(batch[0]['input_ids'])}-"
+                  f"{len(batch[-1]['input_ids'])} tokens, {completion_tokens / elapsed:.1f} generated tokens/s so far")
+
+    elapsed = time.perf_counter() - start
+    print(f"\nFinished {len(items)} prompts in {elapsed:.1f}s")
+    print(f"Generated tokens/s:        {completion_tokens / elapsed:.1f}")
+    print(f"Total tokens/s:            {(prompt_tokens + completion_tokens) / elapsed:.1f}")
+    print(f"Prompt padding efficiency: {padding_efficiency(batches):.1%} "
+          f"(input order would be {padding_efficiency(unsorted):.1%})")
+    print(f"Decode slot efficiency:    {completion_tokens / decode_slots if decode_slots else 1.0:.1%}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,296 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, Hashable, List, Optional, Set, Tuple
+
+import torch
+
+
+def to_legacy(past_key_values):
+    """Convert a HuggingFace cache object to a tuple of (key, value) per layer.
+
+    Each key/value tensor has shape [batch, heads, seq_len, head_dim].
+    """
+    if past_key_values is None:
+        return None
+    if hasattr(past_key_values, "layers"):
+        return tuple((layer.keys, layer.values) for layer in past_key_values.layers)
+    if hasattr(past_key_values, "key_cache"):
+        return tuple(zip(past_key_values.key_cache, past_key_values.value_cache))
+    return tuple(past_key_values)
+
+
+def from_legacy(legacy):
+    """Wrap a legacy (key, value) tuple in a fresh cache object the model accepts.
+
+    The model appends to the returned cache with torch.cat, so the tensors in
+    `legacy` are never modified in place and can safely be reused afterwards.
+    """
+    if legacy is None:
+        return None
+    try:
+        from transformers import DynamicCache
+    except ImportError:
+        return legacy
+
+    cache = DynamicCache()
+    for layer_idx, (key, value) in enumerate(legacy):
+        cache.update(key, value, layer_idx)
+    return cache
+
+
+def seq_length(legacy) -> int:
+    """Number of cached positions"""
+    return 0 if not legacy else legacy[0][0].shape[2]
+
+
+def select_rows(legacy, indices: torch.Tensor):
+    """Keep only the batch rows in `indices`"""
+    return tuple((k.index_select(0, indices), v.index_select(0, indices)) for k, v in legacy)
+
+
+def crop(legacy, length: int):
+    """Keep only the first `length` positions"""
+    return tuple((k[:, :, :length], v[:, :, :length]) for k, v in legacy)
+
+
+def nbytes(legacy) -> int:
+    return sum(k.element_size() * k.nelement() + v.element_size() * v.nelement() for k, v in legacy)
+
+
+def drop_leading(legacy, n: int):
+    """Drop the first `n` positions from every row (used to trim shared left padding)"""
+    if n <= 0:
+        return legacy
+    return tuple((k[:, :, n:], v[:, :, n:]) for k, v in legacy)
+
+
+def left_pad(legacy, n: int):
+    """Prepend `n` zero positions to every row"""
+    if n <= 0:
+        return legacy
+    padded = []
+    for k, v in legacy:
+        shape = (k.shape[0], k.shape[1], n, k.shape[3])
+        padded.append((torch.cat([k.new_zeros(shape), k], dim=2),
+                       torch.cat([v.new_zeros(shape), v], dim=2)))
+    return tuple(padded)
+
+
+def concat_batches(first, first_mask: torch.Tensor, second, second_mask: torch.Tensor):
+    """Stack two left-padded batches into one, padding the shorter one on the left.
+
+    Returns:
+        (legacy cache, attention mask) for the combined batch
+    """
+    if first is None:
+        return second, second_mask
+    if second is None:
+        return first, first_mask
+
+    target = max(seq_length(first), seq_length(second))
+    pad_first = target - seq_length(first)
+    pad_second = target - seq_length(second)
+
+    first = left_pad(first, pad_first)
+    second = left_pad(second, pad_second)
+    first_mask = torch.cat([first_mask.new_zeros((first_mask.shape[0], pad_first)), first_mask], dim=1)
+    second_mask = torch.cat([second_mask.new_zeros((second_mask.shape[0], pad_second)), second_mask], dim=1)
+
+    merged = tuple((torch.cat([k1, k2], dim=0), torch.cat([v1, v2], dim=0))
+                   for (k1, v1), (k2, v2) in zip(first, second))
+    return merged, torch.cat([first_mask, second_mask], dim=0)
+
+
+def common_prefix_length(a: List[int], b: List[int]) -> int:
+    limit = min(len(a), len(b))
+    if a[:limit] == b[:limit]:
+        return limit
+    for i in range(limit):
+        if a[i] != b[i]:
+            return i
+    return limit
+
+
+def hash_tokens(token_ids: List[int]) -> str:
+    return hashlib.blake2b(repr(token_ids).encode(), digest_size=16).hexdigest()
+
+
+@dataclass
+class PrefixEntry:
+    owner: Hashable
+    token_ids: List[int]
+    past_key_values: tuple
+    size: int
+
+
+class PrefixKVCache:
+    """
+    LRU cache of KV states for token prefixes, bounded by a memory budget.
+
+    Entries are keyed by owner (e.g. the user) and a hash of the cached token
+    prefix. A lookup returns the longest cached prefix of the new prompt, so
+    only the remaining suffix has to be prefilled.
+    """
+
+    def __init__(self, max_bytes: int = 512 * 1024 ** 2):
+        self.max_bytes = max_bytes
+        self.entries: "OrderedDict[Tuple[Hashable, str], PrefixEntry]" = OrderedDict()
+        self.owner_keys: Dict[Hashable, Set[Tuple[Hashable, str]]] = {}
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.reused_tokens = 0
+        self.prefilled_tokens = 0
+
+    def lookup(self, owner: Hashable, token_ids: List[int]) -> Tuple[int, Optional[tuple]]:
+        """
+        Find the longest cached prefix of token_ids for this owner. The caller may still prefill
+        from elsewhere, so hits and misses are only counted by record()
+        Returns:
+            (number of reused tokens, legacy cache cropped to that length) or (0, None) on a miss
+        """
+        with self.lock:
+            best_key, best_length = None, 0
+            for key in self.owner_keys.get(owner, ()):
+                length = common_prefix_length(self.entries[key].token_ids, token_ids)
+                if length > best_length:
+                    best_key, best_length = key, length
+
+            # At least one prompt token must still be fed to get logits for the next token
+            best_length = min(best_length, len(token_ids) - 1)
+            if best_key is None or best_length <= 0:
+                return 0, None
+
+            self.entries.move_to_end(best_key)
+            return best_length, crop(self.entries[best_key].past_key_values, best_length)
+
+    def record(self, reused_tokens: int, prompt_tokens: int):
+        """Count a prompt that was prefilled from reused_tokens of this cache (0 for a miss)"""
+        with self.lock:
+            if reused_tokens > 0:
+                self.hits += 1
+            else:
+                self.misses += 1
+            self.reused_tokens += reused_tokens
+            self.prefilled_tokens += prompt_tokens - reused_tokens
+
+    def store(self, owner: Hashable, token_ids: List[int], past_key_values: tuple):
+        """Cache KV states covering exactly token_ids (batch size 1, no padding)"""
+        size = nbytes(past_key_values)
+        if size > self.max_bytes:
+            return
+
+        with self.lock:
+            # A conversation only moves forward, so the owner's older turns are superseded by this one
+            for key in list(self.owner_keys.get(owner, ())):
+                self._remove(key)
+
+            key = (owner, hash_tokens(token_ids))
+            self.entries[key] = PrefixEntry(owner, list(token_ids), past_key_values, size)
+            self.owner_keys.setdefault(owner, set()).add(key)
+            self.total_bytes += size
+
+            while self.total_bytes > self.max_bytes:
+                oldest = next(iter(self.entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def invalidate(self, owner: Hashable):
+        """Drop every entry for an owner (e.g. when the conversation is cleared)"""
+        with self.lock:
+            for key in list(self.owner_keys.get(owner, ())):
+                self._remove(key)
+
+    def _remove(self, key):
+        entry = self.entries.pop(key)
+        self.total_bytes -= entry.size
+        keys = self.owner_keys[entry.owner]
+        keys.discard(key)
+        if not keys:
+            del self.owner_keys[entry.owner]
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        total_tokens = self.reused_tokens + self.prefilled_tokens
+        return {
+            "entries": len(self.entries),
+            "bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "reused_tokens": self.reused_tokens,
+            "prefilled_tokens": self.prefilled_tokens,
+            "reused_token_ratio": self.reused_tokens / total_tokens if total_tokens else 0.0,
+        }
+
+
+class SharedPrefixCache:
+    """
+    Pinned KV states for prompt prefixes shared by many requests, e.g. the
+    system prompt of every user with the same role.
+
+    Entries live outside the per-user LRU budget. Each key holds one prefix;
+    when a request arrives with different prefix tokens for the same key (the
+    template changed) the old entry is dropped and recomputed.
+    """
+
+    def __init__(self, max_entries: int = 32):
+        self.max_entries = max_entries
+        self.entries: "OrderedDict[Hashable, PrefixEntry]" = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.reused_tokens = 0
+
+    def get(self, key: Hashable, token_ids: List[int]) -> Optional[tuple]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry.token_ids != token_ids:
+                del self.entries[key]
+                self.invalidations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            self.reused_tokens += len(token_ids)
+            return entry.past_key_values
+
+    def put(self, key: Hashable, token_ids: List[int], past_key_values: tuple):
+        with self.lock:
+            self.entries[key] = PrefixEntry(key, list(token_ids), past_key_values, nbytes(past_key_values))
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, key: Optional[Hashable] = None):
+        """Drop one pinned prefix, or all of them"""
+        with self.lock:
+            if key is None:
+                self.invalidations += len(self.entries)
+                self.entries.clear()
+            elif self.entries.pop(key, None) is not None:
+                self.invalidations += 1
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "bytes": sum(entry.size for entry in self.entries.values()),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "invalidations": self.invalidations,
+            "reused_tokens": self.reused_tokens,
+        }
@@ -1,6 +1,14 @@
+import argparse
 import asyncio
-import aiohttp
+import os
 import random
+import sys
+import time
+
+# Modules shared by both servers and the router (metrics, clients, storage, ...) live in src/common
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "common"))
+
+from counseling_client import LOCAL_URL, CounselingClient, RequestFailed
 
 # Same users and questions as Anthropic client
 USERS = ['Linda', 'Miguel', 'Mike']
@@ -16,25 +24,33 @@ SAMPLE_QUESTIONS = [
     "What are good mental health practices?",
 ]
 
-async def ask_question(session, user, question):
-    """Send a question to the local LLM server"""
-    async with session.post('http://localhost:8081/ask',
-                          json={'user': user, 'question': question}) as resp:
-        return await resp.json()
+async def ask_question(client, user, question):
+    """Send a question to the local LLM server and consume the streamed response"""
+    def on_token(token):
+        nonlocal first
+        if first:
+            first = False
+            print(f"   First token for {user} after {time.perf_counter() - start:.2f}s")
+
+    first = True
+    start = time.perf_counter()
+    try:
+        return await client.ask_stream(user, question, on_token)
+    except RequestFailed as e:
+        return {'user': user, 'error': str(e)}
 
-async def check_health(session):
+async def check_health(client):
     """Check if the local server is healthy"""
     try:
-        async with session.get('http://localhost:8081/health') as resp:
-            return await resp.json()
+        return await client.health()
     except Exception as e:
         return {'error': str(e)}
 
-async def main():
-    async with aiohttp.ClientSession() as session:
+async def main(url: str):
+    async with CounselingClient(url) as client:
         # First check if server is running
         print("Checking local LLM server health...")
-        health = await check_health(session)
+        health = await check_health(client)
         if 'error' in health:
             print(f"Error connecting to server: {health['error']}")
             print("Make sure to start the local server first: python local_server.py")
@@ -60,7 +76,7 @@ async def main():
                     user = random.choice(USERS)
                     question = random.choice(SAMPLE_QUESTIONS)
                     print(f"Queuing request as {user}: {question}")
-                    tasks.append(ask_question(session, user, question))
+                    tasks.append(ask_question(client, user, question))
 
                 # Execute all tasks concurrently and wait for results
                 responses = []
@@ -72,7 +88,9 @@ async def main():
                     if 'error' in response:
                         print(f"{i}. Error for request: {response['error']}")
                     else:
-                        print(f"{i}. Local LLM Response to {response['user']}: {response['response']}\n")
+                        ttft = f"{response['ttft']:.2f}s" if response['ttft'] is not None else "n/a"
+                        print(f"{i}. Local LLM Response to {response['user']} "
+                              f"(first token {ttft}, total {response['total']:.2f}s): {response['response']}\n")
                     i += 1
 
             except KeyboardInterrupt:
@@ -84,4 +102,7 @@ async def main():
                 print(f"Error: {e}")
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Send concurrent questions to the local LLM server")
+    parser.add_argument("--url", default=LOCAL_URL, help="Server address")
+    args = parser.parse_args()
+    asyncio.run(main(args.url))
\ No newline at end of file
@@ -1,37 +1,156 @@
 import torch
 import asyncio
-from transformers import AutoTokenizer, AutoModelForCausalLM, TextStreamer
+import time
+from transformers import AutoTokenizer, AutoModelForCausalLM, StoppingCriteriaList, TextStreamer
 from threading import Lock
 import logging
 
+from shared_weights import load_mmap_model
+from precision import configure_threads, prepare_model, validate_options
+from speculative import SPECULATION_MODES, SpeculativeDecoder
+from kv_cache import PrefixKVCache, SharedPrefixCache, common_prefix_length
+from prompt_tokens import ENCODE_SECONDS, SegmentTokenCache, matches_full_tokenization, special_prefix_ids
+from stopping import DEFAULT_STOP_STRINGS, BatchStopCriteria, StopConditions, cut_at_stop, held_back, record_stop
+from admission import DeadlineExceeded
+from scheduler import (ContinuousBatchScheduler, GenerationRequest, LOCK_WAIT, GENERATION_SECONDS, PROMPT_TOKENS,
+                       GENERATED_TOKENS)
+
+
+class TokenStreamer:
+    """
+    Hands token ids from the generating thread to an async consumer on the event loop.
+
+    Implements the put()/end() streamer interface of transformers, so the same
+    streamer works with the batch scheduler and with model.generate(streamer=...).
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self.queue = asyncio.Queue()
+        self._prompt_skipped = False
+
+    def put(self, value):
+        if isinstance(value, int):
+            token_ids = [value]
+        else:
+            # model.generate() first puts the whole prompt, then one tensor per new token
+            if not self._prompt_skipped:
+                self._prompt_skipped = True
+                return
+            token_ids = value.reshape(-1).tolist()
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, token_ids)
+
+    def end(self):
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, None)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> list:
+        token_ids = await self.queue.get()
+        if token_ids is None:
+            raise StopAsyncIteration
+        return token_ids
+
 class LocalLLMModel:
-    def __init__(self, model_name="meta-llama/Llama-3.2-1B", device=None):
+    def __init__(self, model_name="meta-llama/Llama-3.2-1B", device=None, batching=True, max_batch_size=8,
+                 kv_cache_bytes=512 * 1024 ** 2, max_context_tokens=2048, weights_file=None, dtype="fp32",
+                 quantize=None, compile_model=False, num_threads=None, interop_threads=None, speculative=None,
+                 draft_model_name=None, lookahead=4, ngram_size=3, incremental_tokenization=True,
+                 stop_strings=DEFAULT_STOP_STRINGS, loop_max_ngram=32):
         """
         Initialize the local LLM model
         Args:
             model_name: HuggingFace model name (default: DialoGPT for conversation)
             device: Device to run model on (auto-detects if None)
+            batching: Decode concurrent requests together with the continuous batch scheduler
+            max_batch_size: Maximum number of sequences decoded together when batching
+            kv_cache_bytes: Memory budget for reusing each user's KV cache across turns (0 disables)
+            max_context_tokens: Longest prompt the model is given; longer prompts lose their oldest tokens
+            weights_file: Memory-map weights from this safetensors export (shared between replica processes)
+            dtype: Weight precision, "fp32" or "bf16"
+            quantize: "int8" for dynamic int8 quantization of linear layers (CPU, fp32 only)
+            compile_model: Run the forward pass through torch.compile
+            num_threads: Torch intra-op threads (default: torch's choice)
+            interop_threads: Torch inter-op threads (default: torch's choice)
+            speculative: "draft" or "prompt_lookup" to decode each request speculatively (instead of batching)
+            draft_model_name: Small model sharing this model's tokenizer, for speculative="draft"
+            lookahead: Tokens proposed per verification pass
+            ngram_size: Longest n-gram matched against the conversation for speculative="prompt_lookup"
+            incremental_tokenization: Build prompts from cached token ids of each turn instead of tokenizing the
+                whole conversation (used only if it gives identical ids with this tokenizer)
+            stop_strings: Text that ends a response early, e.g. the model starting the next "User:" turn itself
+            loop_max_ngram: Longest n-gram whose back-to-back repetition ends a response (0 disables)
         """
         self.model_name = model_name
         self.device = device or ("cuda" if torch.cuda.is_available() else "cpu")
         self.model = None
         self.tokenizer = None
         self.model_lock = Lock()  # Ensure thread-safe model access
+        self.tokenizer_lock = Lock()  # Fast tokenizers must not be used from several threads at once
+        self.max_context_tokens = max_context_tokens
+        self.weights_file = weights_file
+        validate_options(dtype, quantize)
+        if quantize and self.device != "cpu":
+            raise ValueError("Dynamic int8 quantization is only supported on CPU")
+        self.dtype = dtype
+        self.quantize = quantize
+        self.compile_model = compile_model
+        self.num_threads = num_threads
+        self.interop_threads = interop_threads
+        if speculative is not None and speculative not in SPECULATION_MODES:
+            raise ValueError(f"Unknown speculation mode {speculative!r}, expected one of {', '.join(SPECULATION_MODES)}")
+        if speculative == "draft" and not draft_model_name:
+            raise ValueError("speculative='draft' needs draft_model_name")
+        self.speculative = speculative
+        self.draft_model_name = draft_model_name
+        self.lookahead = lookahead
+        self.ngram_size = ngram_size
+        self.speculator = None
+        self.batching = batching
+        self.max_batch_size = max_batch_size
+        self.scheduler = None
+        # Both caches live in the batch scheduler, which speculative decoding bypasses
+        scheduled = batching and speculative is None
+        self.prefix_cache = PrefixKVCache(kv_cache_bytes) if scheduled and kv_cache_bytes > 0 else None
+        self.shared_prefix_cache = SharedPrefixCache() if scheduled else None
+        self._system_prefix_ids = {}  # Tokenized shared system prefixes, keyed by formatted text
+        self.incremental_tokenization = incremental_tokenization
+        self.segment_cache = None  # Set by setup_tokenizer when incremental tokenization is safe
+        self._special_prefix = []
+        self.stop_strings = tuple(stop_strings or ())
+        self.loop_max_ngram = loop_max_ngram
+        self.stop_conditions = None  # Set once the tokenizer is loaded
 
         logging.basicConfig(level=logging.INFO)
         self.logger = logging.getLogger(__name__)
 
-    async def initialize(self):
-        """Load model and tokenizer asynchronously"""
-        self.logger.info(f"Loading model {self.model_name} on {self.device}")
+    async def initialize(self, progress=None):
+        """
+        Load model and tokenizer asynchronously
+        Args:
+            progress: Optional callback(stage, fraction) for startup reporting; called from a worker thread
+        """
+        report = progress or (lambda stage, fraction=0.0: None)
+        self.logger.info(f"Loading model {self.model_name} on {self.device} "
+                         f"({self.dtype}{', ' + self.quantize if self.quantize else ''}"
+                         f"{', compiled' if self.compile_model else ''})")
+        configure_threads(self.num_threads, self.interop_threads)
 
         # Load model and tokenizer in executor to prevent blocking
         loop = asyncio.get_event_loop()
 
         def load_model():
+            report("loading_tokenizer")
             tokenizer = AutoTokenizer.from_pretrained(self.model_name)
-            model = AutoModelForCausalLM.from_pretrained(self.model_name)
+            report("loading_weights")
+            if self.weights_file:
+                model = load_mmap_model(self.model_name, self.weights_file)
+            else:
+                model = AutoModelForCausalLM.from_pretrained(self.model_name)
+            report("preparing_model")
             model.to(self.device)
+            model = prepare_model(model, self.dtype, self.quantize, self.compile_model)
 
             # Set proper pad token for Llama - use a different token than EOS
             if tokenizer.pad_token is None:
@@ -43,101 +162,477 @@ class LocalLLMModel:
 
             return tokenizer, model
 
-        self.tokenizer, self.model = await loop.run_in_executor(None, load_model)
+        tokenizer, self.model = await loop.run_in_executor(None, load_model)
+        await loop.run_in_executor(None, self.setup_tokenizer, tokenizer)
+        stop_conditions = StopConditions(self._token_text, self.stop_strings, loop_max_ngram=self.loop_max_ngram)
+        self.stop_conditions = stop_conditions if stop_conditions.enabled else None
+
+        if self.speculative is not None:
+            draft_model = None
+            if self.speculative == "draft":
+                report("loading_weights", 0.5)
+                draft_model = await loop.run_in_executor(None, self._load_draft_model)
+            self.speculator = SpeculativeDecoder(
+                self.model,
+                eos_token_ids=self._eos_token_ids(),
+                device=self.device,
+                mode=self.speculative,
+                draft_model=draft_model,
+                lookahead=self.lookahead,
+                ngram_size=self.ngram_size,
+            )
+            self.logger.info(f"Speculative decoding: {self.speculative}, {self.lookahead} tokens per pass")
+        elif self.batching:
+            self.scheduler = ContinuousBatchScheduler(
+                self.model,
+                eos_token_ids=self._eos_token_ids(),
+                pad_token_id=self.tokenizer.pad_token_id,
+                device=self.device,
+                model_lock=self.model_lock,
+                max_batch_size=self.max_batch_size,
+                prefix_cache=self.prefix_cache,
+                shared_prefix_cache=self.shared_prefix_cache,
+            )
         self.logger.info("Model loaded successfully!")
 
-    async def generate_response(self, system_message: str, messages: list, max_tokens: int = 256) -> str:
+    def _load_draft_model(self):
+        """Draft model for speculation; its token ids must mean the same as the main model's"""
+        self.logger.info(f"Loading draft model {self.draft_model_name}")
+        draft_tokenizer = AutoTokenizer.from_pretrained(self.draft_model_name)
+        if draft_tokenizer.get_vocab() != self.tokenizer.get_vocab():
+            raise ValueError(f"Draft model {self.draft_model_name} does not share {self.model_name}'s tokenizer")
+        draft_model = AutoModelForCausalLM.from_pretrained(self.draft_model_name)
+        draft_model.to(self.device)
+        return prepare_model(draft_model.eval(), self.dtype)
+
+    def _eos_token_ids(self) -> list:
+        """All token ids that end a sequence (generation_config may list several)"""
+        eos_ids = {self.tokenizer.eos_token_id}
+        generation_eos = getattr(self.model.generation_config, "eos_token_id", None)
+        if isinstance(generation_eos, int):
+            eos_ids.add(generation_eos)
+        elif generation_eos:
+            eos_ids.update(generation_eos)
+        return [token_id for token_id in eos_ids if token_id is not None]
+
+    def setup_tokenizer(self, tokenizer):
+        """Use tokenizer, with incremental prompt tokenization if it reproduces full tokenization exactly"""
+        self.tokenizer = tokenizer
+        self.segment_cache = None
+        if not self.incremental_tokenization:
+            return
+        prefix = special_prefix_ids(tokenizer)
+        if prefix is not None:
+            self._special_prefix = prefix
+            self.segment_cache = SegmentTokenCache(self._encode_segment)
+            if matches_full_tokenization(self._encode, self._encode_segments, self._conversation_segments):
+                return
+            self.segment_cache = None
+        self.logger.warning("Incremental tokenization doesn't match full tokenization with this tokenizer; "
+                            "tokenizing whole prompts instead")
+
+    def _encode_segment(self, text: str) -> list:
+        with self.tokenizer_lock:
+            return self.tokenizer(text, add_special_tokens=False)["input_ids"]
+
+    def _encode_segments(self, segments: list) -> list:
+        return self._truncate_left(self._special_prefix + self.segment_cache.encode(segments))
+
+    def _encode(self, text: str) -> list:
+        with self.tokenizer_lock:
+            input_ids = self.tokenizer(text)["input_ids"]
+        return self._truncate_left(input_ids)
+
+    def _truncate_left(self, input_ids: list) -> list:
+        """Keep the end of an over-long prompt (with its trailing "Assistant:" cue) plus the leading BOS token"""
+        if len(input_ids) <= self.max_context_tokens:
+            return input_ids
+        keep = self.max_context_tokens - 1
+        return input_ids[:1] + input_ids[-keep:]
+
+    def count_tokens(self, text: str) -> int:
+        """Number of tokens text adds to a prompt (no special tokens); used for context budgeting"""
+        with self.tokenizer_lock:
+            return len(self.tokenizer(text, add_special_tokens=False)["input_ids"])
+
+    def _decode(self, token_ids: list) -> str:
+        with self.tokenizer_lock:
+            return self.tokenizer.decode(token_ids, skip_special_tokens=True).strip()
+
+    def _token_text(self, token_id: int) -> str:
+        with self.tokenizer_lock:
+            return self.tokenizer.decode([token_id])
+
+    def _finish_response(self, request: GenerationRequest, text: str, details: dict = None) -> str:
+        """Cut a stop string (and what follows it) from the response and report how the request ended"""
+        if request.finish_reason == "stop":
+            text = cut_at_stop(text, self.stop_strings)[0].rstrip()
+        tokens_saved = request.max_new_tokens - len(request.generated) if request.finish_reason in ("stop", "loop") \
+            else 0
+        record_stop(request.finish_reason, tokens_saved)
+        if details is not None:
+            details.update({
+                "finish_reason": request.finish_reason,
+                "completion_tokens": len(request.generated),
+                "tokens_saved": tokens_saved,
+            })
+            if request.speculation is not None:
+                stats = request.speculation
+                details["speculation"] = {
+                    "mode": stats["mode"],
+                    "drafted": stats["drafted"],
+                    "accepted": stats["accepted"],
+                    "acceptance_rate": round(stats["acceptance_rate"], 4),
+                    # Tokens per pass over the model's weights; plain decoding makes one
+                    "tokens_per_pass": round(stats["tokens_per_pass"], 4),
+                }
+        return text
+
+    def clear_user_cache(self, user: str):
+        """Forget cached KV states for a user (call when their conversation is cleared)"""
+        if self.prefix_cache is not None:
+            self.prefix_cache.invalidate(user)
+
+    def invalidate_system_prefixes(self):
+        """Drop pinned system-prompt KV states (call when the system prompt template changes)"""
+        self._system_prefix_ids.clear()
+        if self.shared_prefix_cache is not None:
+            self.shared_prefix_cache.invalidate()
+
+    def cache_stats(self) -> dict:
+        stats = self.prefix_cache.stats() if self.prefix_cache is not None else {}
+        if self.shared_prefix_cache is not None:
+            stats["system_prefix"] = self.shared_prefix_cache.stats()
+        if self.speculator is not None:
+            stats["speculative"] = self.speculator.stats()
+        if self.segment_cache is not None:
+            stats["prompt_segments"] = self.segment_cache.stats()
+        return stats
+
+    async def generate_response(self, system_message: str, messages: list, max_tokens: int = 256, user: str = None,
+                                system_prefix: str = None, system_prefix_key: str = None, deadline: float = None,
+                                details: dict = None) -> str:
         """
         Generate response from conversation history
         Args:
             system_message: System prompt
             messages: List of conversation messages
             max_tokens: Maximum tokens to generate
+            user: Conversation owner; when given, the KV cache of their previous turn is reused
+            system_prefix: Leading part of system_message shared with other users (its KV states are pinned)
+            system_prefix_key: Identifies the shared prefix, e.g. the user's role
+            deadline: time.monotonic() value; raises DeadlineExceeded if generation hasn't started by then
+            details: Filled with finish_reason ("eos", "length", "stop" or "loop"), completion_tokens,
+                tokens_saved (decode steps a stop string or loop left unused) and, for a speculative request,
+                speculation (its acceptance rate and tokens per model pass)
         Returns:
             Generated response string
         """
+        future = await self._start_generation(system_message, messages, max_tokens, user, system_prefix, system_prefix_key,
+                                              deadline=deadline)
+        request = await future
+        text = await asyncio.get_event_loop().run_in_executor(None, self._decode, request.generated)
+        return self._finish_response(request, text, details)
+
+    async def stream_response(self, system_message: str, messages: list, max_tokens: int = 256, user: str = None,
+                              system_prefix: str = None, system_prefix_key: str = None, deadline: float = None,
+                              details: dict = None):
+        """
+        Generate response from conversation history, yielding text as tokens are decoded
+        Args:
+            Same as generate_response
+        Yields:
+            Text chunks; joined together they equal the generate_response result
+        """
+        streamer = TokenStreamer(asyncio.get_event_loop())
+        future = await self._start_generation(system_message, messages, max_tokens, user, system_prefix,
+                                              system_prefix_key, streamer=streamer, deadline=deadline)
+        token_ids = []
+        text = ""
+        try:
+            async for new_ids in streamer:
+                token_ids.extend(new_ids)
+                decoded = self._decode(token_ids)
+                # Hold back incomplete multi-byte characters until the rest of their bytes arrive
+                if decoded.endswith("\ufffd") or not decoded.startswith(text):
+                    continue
+                # ...and text that may turn out to be the start of a stop string
+                decoded, stopped = cut_at_stop(decoded, self.stop_strings)
+                if not stopped:
+                    decoded = decoded[:len(decoded) - held_back(decoded, self.stop_strings)]
+                if decoded.startswith(text) and len(decoded) > len(text):
+                    yield decoded[len(text):]
+                    text = decoded
+
+            request = await future  # Surface generation errors
+            # The generated ids, not the streamed ones: model.generate() also streams the end-of-sequence token
+            decoded = self._finish_response(request, self._decode(request.generated), details)
+            if decoded.startswith(text) and len(decoded) > len(text):
+                yield decoded[len(text):]
+        finally:
+            if not future.done():
+                # The consumer went away; stop decoding for it
+                future.cancel()
+
+    def encode_conversation(self, system_message: str, messages: list) -> list:
+        """Prompt token ids for a conversation; only turns not seen before are tokenized when segments are cached"""
+        start = time.perf_counter()
+        segments = self._conversation_segments(system_message, messages)
+        if self.segment_cache is not None:
+            input_ids = self._encode_segments(segments)
+            ENCODE_SECONDS.observe(time.perf_counter() - start, path="incremental")
+        else:
+            input_ids = self._encode("".join(segments))
+            ENCODE_SECONDS.observe(time.perf_counter() - start, path="full")
+        return input_ids
+
+    async def generate_batch(self, prompts: list, max_tokens: int = 256, temperature: float = 0.3) -> list:
+        """
+        Generate for many prompts in one left-padded model.generate call (offline use; bypasses the scheduler)
+        Args:
+            prompts: Token id lists from encode_conversation; similar lengths waste the least padding
+            max_tokens: Maximum tokens to generate per prompt
+            temperature: Sampling temperature; 0 decodes greedily
+        Returns:
+            One dict per prompt with response, prompt_tokens, completion_tokens, finish_reason and tokens_saved
+        """
         if not self.model or not self.tokenizer:
             raise RuntimeError("Model not initialized. Call initialize() first.")
 
-        # Format conversation for model input
-        conversation_text = self._format_conversation(system_message, messages)
+        eos_token_ids = self._eos_token_ids()
+        pad_token_id = self.tokenizer.pad_token_id
+        sampling = {"do_sample": True, "temperature": temperature, "top_p": 0.95, "top_k": 50} if temperature > 0 \
+            else {"do_sample": False}
+
+        def generate():
+            width = max(len(ids) for ids in prompts)
+            input_ids = torch.tensor([[pad_token_id] * (width - len(ids)) + ids for ids in prompts], device=self.device)
+            attention_mask = torch.tensor([[0] * (width - len(ids)) + [1] * len(ids) for ids in prompts],
+                                          device=self.device)
+            # A row that stops early is padded while the others finish
+            trackers = [self.stop_conditions.tracker() for _ in prompts] if self.stop_conditions is not None else None
+            stopping_criteria = StoppingCriteriaList(
+                [BatchStopCriteria(trackers, eos_token_ids)] if trackers is not None else [])
+
+            wait_start = time.perf_counter()
+            with self.model_lock, torch.no_grad():
+                LOCK_WAIT.observe(time.perf_counter() - wait_start, path="batch")
+                start = time.perf_counter()
+                outputs = self.model.generate(
+                    input_ids,
+                    attention_mask=attention_mask,
+                    max_new_tokens=max_tokens,
+                    pad_token_id=pad_token_id,
+                    eos_token_id=eos_token_ids,
+                    stopping_criteria=stopping_criteria,
+                    **sampling,
+                )
+                GENERATION_SECONDS.observe(time.perf_counter() - start, path="batch")
+
+            results = []
+            for index, (ids, row) in enumerate(zip(prompts, outputs[:, width:].tolist())):
+                stop = trackers[index] if trackers is not None else None
+                if stop is not None and stop.reason is not None:
+                    end, finish_reason = len(stop.tokens), stop.reason
+                else:
+                    # Rows that finished early are padded up to the longest one
+                    end = next((i for i, token_id in enumerate(row) if token_id in eos_token_ids), None)
+                    finish_reason = "length" if end is None else "eos"
+                generated = row if end is None else row[:end]
+                PROMPT_TOKENS.inc(len(ids), source="prefilled")
+                GENERATED_TOKENS.inc(len(generated), path="batch")
+                request = GenerationRequest(input_ids=ids, max_new_tokens=max_tokens, generated=generated,
+                                            finish_reason=finish_reason)
+                details = {}
+                results.append({
+                    "response": self._finish_response(request, self._decode(generated), details),
+                    "prompt_tokens": len(ids),
+                    **details,
+                })
+            return results
+
+        return await asyncio.get_event_loop().run_in_executor(None, generate)
+
+    async def _start_generation(self, system_message: str, messages: list, max_tokens: int, user: str = None,
+                                system_prefix: str = None, system_prefix_key: str = None,
+                                streamer: "TokenStreamer" = None, deadline: float = None) -> asyncio.Future:
+        """Queue generation for a conversation; the future resolves to the finished GenerationRequest"""
+        if not self.model or not self.tokenizer:
+            raise RuntimeError("Model not initialized. Call initialize() first.")
 
         # Run generation in executor to prevent blocking
         loop = asyncio.get_event_loop()
 
+        # Tokenize off the event loop and outside the model lock
+        input_ids = await loop.run_in_executor(None, self.encode_conversation, system_message, messages)
+        stop = self.stop_conditions.tracker() if self.stop_conditions is not None else None
+
+        if self.scheduler is not None:
+            # Let the scheduler decode us together with other requests
+            shared_ids = None
+            if system_prefix:
+                shared_ids = await loop.run_in_executor(None, self._shared_prefix_ids, system_prefix, input_ids)
+            return self.scheduler.submit(
+                input_ids,
+                max_tokens,
+                cache_owner=user,
+                shared_prefix_key=system_prefix_key or system_prefix,
+                shared_prefix_ids=shared_ids,
+                streamer=streamer,
+                deadline=deadline,
+                stop=stop,
+            )
+
+        if self.speculator is not None:
+            return loop.run_in_executor(None, self._generate_speculative, input_ids, max_tokens, user, streamer,
+                                        deadline, stop)
+
         def generate():
+            wait_start = time.perf_counter()
             with self.model_lock:  # Ensure thread-safe access
-                # Tokenize input with attention mask
-                tokenized = self.tokenizer(
-                    conversation_text,
-                    return_tensors="pt",
-                    padding=True,
-                    truncation=True,
-                    max_length=2048
+                LOCK_WAIT.observe(time.perf_counter() - wait_start, path="generate")
+                if deadline is not None and time.monotonic() > deadline:
+                    if streamer is not None:
+                        streamer.end()
+                    raise DeadlineExceeded("Deadline passed while waiting for the model")
+                start = time.perf_counter()
+
+                input_tensor = torch.tensor([input_ids], device=self.device)
+                attention_mask = torch.ones_like(input_tensor)
+                # The same end-of-sequence ids as the scheduler, so batching on or off stops alike
+                eos_token_ids = self._eos_token_ids()
+                stopping_criteria = StoppingCriteriaList(
+                    [BatchStopCriteria([stop], eos_token_ids)] if stop is not None else [])
+
+                try:
+                    # Generate response with anti-repetition parameters
+                    with torch.no_grad():
+                        outputs = self.model.generate(
+                            input_tensor,
+                            attention_mask=attention_mask,
+                            max_new_tokens=max_tokens,
+                            # min_new_tokens=10,
+                            # num_return_sequences=1,
+                            temperature=0.3,
+                            do_sample=True,
+                            top_p=0.95,
+                            top_k=50,
+                            # repetition_penalty=1.3,  # Higher penalty to reduce repetition
+                            # no_repeat_ngram_size=3,  # Prevent 3-gram repetition
+                            pad_token_id=self.tokenizer.pad_token_id,
+                            eos_token_id=eos_token_ids,
+                            stopping_criteria=stopping_criteria,
+                            streamer=streamer,
+                        )
+                finally:
+                    if streamer is not None:
+                        streamer.end()
+
+                # Keep only the new tokens (response), without the end-of-sequence token, as the scheduler does
+                response_tokens = outputs[0][len(input_ids):].tolist()
+                if response_tokens and response_tokens[-1] in eos_token_ids:
+                    response_tokens.pop()
+                GENERATION_SECONDS.observe(time.perf_counter() - start, path="generate")
+                PROMPT_TOKENS.inc(len(input_ids), source="prefilled")
+                GENERATED_TOKENS.inc(len(response_tokens), path="generate")
+                if stop is not None and stop.reason is not None:
+                    finish_reason = stop.reason
+                else:
+                    finish_reason = "length" if len(response_tokens) >= max_tokens else "eos"
+                return GenerationRequest(
+                    input_ids=input_ids,
+                    max_new_tokens=max_tokens,
+                    generated=response_tokens,
+                    finish_reason=finish_reason,
+                    stop=stop,
                 )
-                input_ids = tokenized['input_ids'].to(self.device)
-                attention_mask = tokenized['attention_mask'].to(self.device)
-
-                # Generate response with anti-repetition parameters
-                with torch.no_grad():
-                    outputs = self.model.generate(
-                        input_ids,
-                        attention_mask=attention_mask,
-                        max_new_tokens=max_tokens,
-                        # min_new_tokens=10,
-                        # num_return_sequences=1,
-                        temperature=0.3,
-                        do_sample=True,
-                        top_p=0.95,
-                        top_k=50,
-                        # repetition_penalty=1.3,  # Higher penalty to reduce repetition
-                        # no_repeat_ngram_size=3,  # Prevent 3-gram repetition
-                        pad_token_id=self.tokenizer.pad_token_id,
-                        eos_token_id=self.tokenizer.eos_token_id,
-                    )
-
-                # Decode only the new tokens (response)
-                response_tokens = outputs[0][input_ids.shape[1]:]
-                response = self.tokenizer.decode(response_tokens, skip_special_tokens=True)
-
-                return response.strip()
-
-        return await loop.run_in_executor(None, generate)
+
+        return loop.run_in_executor(None, generate)
+
+    def _generate_speculative(self, input_ids: list, max_tokens: int, user: str = None,
+                              streamer: "TokenStreamer" = None, deadline: float = None,
+                              stop=None) -> GenerationRequest:
+        """One request through the speculative decoder (runs in an executor thread)"""
+        wait_start = time.perf_counter()
+        with self.model_lock, torch.no_grad():
+            LOCK_WAIT.observe(time.perf_counter() - wait_start, path="speculative")
+            if deadline is not None and time.monotonic() > deadline:
+                if streamer is not None:
+                    streamer.end()
+                raise DeadlineExceeded("Deadline passed while waiting for the model")
+            start = time.perf_counter()
+            generated, finish_reason, stats = self.speculator.generate(input_ids, max_tokens, streamer=streamer,
+                                                                       stop=stop)
+            GENERATION_SECONDS.observe(time.perf_counter() - start, path="speculative")
+        PROMPT_TOKENS.inc(len(input_ids), source="prefilled")
+        GENERATED_TOKENS.inc(len(generated), path="speculative")
+        self.logger.info(f"Speculative {stats['mode']} for {user or 'anonymous'}: {stats['generated']} tokens, "
+                         f"{stats['accepted']}/{stats['drafted']} guesses accepted, "
+                         f"{stats['tokens_per_pass']:.2f} tokens/pass, {stats['tokens_per_second']:.1f} tokens/s")
+        return GenerationRequest(
+            input_ids=input_ids,
+            max_new_tokens=max_tokens,
+            generated=generated,
+            finish_reason=finish_reason,
+            speculation=stats,
+            stop=stop,
+        )
+
+    def _shared_prefix_ids(self, system_prefix: str, input_ids: list) -> list:
+        """Token ids of the formatted system prefix, trimmed to where they match the prompt"""
+        text = self._format_system_prefix(system_prefix)
+        prefix_ids = self._system_prefix_ids.get(text)
+        if prefix_ids is None:
+            prefix_ids = self._encode(text)
+            self._system_prefix_ids[text] = prefix_ids
+
+        # The last prefix token may merge differently with the text that follows it in the full prompt
+        length = common_prefix_length(prefix_ids, input_ids)
+        return input_ids[:length] if length > 0 else None
+
+    def _format_system_prefix(self, system_prefix: str) -> str:
+        """How the start of the system message appears at the start of _format_conversation's output"""
+        return f"System: {system_prefix}"
 
     def _format_conversation(self, system_message: str, messages: list) -> str:
         """Format conversation for model input"""
+        return "".join(self._conversation_segments(system_message, messages))
+
+    def _conversation_segments(self, system_message: str, messages: list) -> list:
+        """
+        The formatted conversation in pieces that are tokenized (and cached) separately.
+        Each piece ends with a newline and the next starts with a role name, so tokens never span two pieces.
+        """
         # Start with system message
-        formatted = f"System: {system_message}\n\n"
+        segments = [f"System: {system_message}\n\n"]
 
         # Add conversation history
         for msg in messages:
             role = msg["role"].capitalize()
             content = msg["content"]
-            formatted += f"{role}: {content}\n"
+            segments.append(f"{role}: {content}\n")
 
         # Add Assistant prompt to encourage response
-        formatted += "Assistant:"
+        segments.append("Assistant:")
 
-        return formatted
+        return segments
 
 class LlamaLocalLLM(LocalLLMModel):
-    def __init__(self, device=None):
-        super().__init__("meta-llama/Llama-3.2-1B", device)
+    def __init__(self, device=None, model_name="meta-llama/Llama-3.2-1B", **kwargs):
+        super().__init__(model_name, device, **kwargs)
 
-    def _format_conversation(self, system_message: str, messages: list) -> str:
+    def _conversation_segments(self, system_message: str, messages: list) -> list:
         """Simple conversation format that works better with Llama 3.2"""
         # Start with system instruction
-        formatted = f"System: {system_message}\n\n"
+        segments = [f"System: {system_message}\n\n"]
 
-        # Add recent conversation history (only last 3 messages to avoid confusion)
-        recent_messages = messages[-3:] if len(messages) > 3 else messages
-
-        for msg in recent_messages:
+        # Conversation history (already fitted to the token budget by ContextBuilder)
+        for msg in messages:
             role = "User" if msg["role"] == "user" else "Assistant"
             content = msg["content"]
-            formatted += f"{role}: {content}\n\n"
+            segments.append(f"{role}: {content}\n\n")
 
         # Add prompt for assistant response
-        formatted += "Assistant:"
+        segments.append("Assistant:")
 
-        return formatted
\ No newline at end of file
+        return segments
@@ -1,7 +1,26 @@
+import argparse
 import asyncio
+import codecs
+import contextlib
+import json
+import math
+import os
+import sys
+import time
+
+# Modules shared by both servers and the router (metrics, clients, storage, ...) live in src/common
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "common"))
+
 from aiohttp import web
-from local_llm import LlamaLocalLLM
+from replica_pool import ReplicaPool
+from admission import AdmissionController, DeadlineExceeded, Overloaded, RateLimiter, retry_after_header
 from memory import LocalConversationMemory
+from context_builder import ContextBuilder
+from response_cache import ResponseCache
+from user_sequencer import UserSequencer
+from summarizer import HistorySummarizer
+from batch_stream import parse_batch, stream_batch
+from metrics import metrics_middleware, handle_metrics
 from datetime import datetime
 
 # Same user database as Anthropic version
@@ -9,20 +28,223 @@ UserDataBase = {'Linda': 'Student',
                 'Miguel': 'Counselor',
                 'Mike': 'Athlete'}
 
+# Tokens reserved for the response; the rest of the model's context window is the prompt budget
+MAX_NEW_TOKENS = 256
+SUMMARY_MAX_TOKENS = 200
+
 # Initialize global memory and model instances
 memory = LocalConversationMemory()
 llm_model = None
+context_builder = None
+response_cache = None  # Set with --response-cache
+mock_options = None  # Set with --mock: serve from MockLocalLLM instead of loading the model
+replica_options = None  # Set with --replicas: serve from a pool of model processes
+model_options = {}  # Precision, compilation and thread settings (--dtype, --quantize, --compile, --threads)
+admission = AdmissionController()  # Bounds requests using or waiting for the model (--max-concurrency, --max-queue)
+rate_limiter = None  # Set with --rate-limit: per-user token buckets
+request_timeout = 60.0  # Default deadline in seconds; clients may ask for less with X-Request-Timeout
+ADMITTED_ROUTES = ('/ask', '/ask_stream')
+sequencer = UserSequencer()  # One turn per user at a time; coalesces with --coalesce
+summary_options = None  # Set with --summarize-after: folds old turns into a summary in the background
+summarizer = None  # Created once the model (and its tokenizer) is loaded
+
+warmup_lengths = [128, 1024]  # Prompt lengths (tokens) generated once after loading; --warmup-lengths
+warmup_tokens = 16
+
+
+class StartupState:
+    """Progress of loading the model in the background, reported by /health and /ready"""
+
+    # Stage -> (overall progress when it starts, share of the total it covers)
+    STAGES = {
+        "starting": (0.0, 0.0),
+        "importing": (0.0, 0.05),
+        "loading_tokenizer": (0.05, 0.05),
+        "preparing_model": (0.1, 0.1),
+        "loading_weights": (0.2, 0.6),
+        "warming_up": (0.8, 0.2),
+        "ready": (1.0, 0.0),
+        "failed": (0.0, 0.0),
+    }
+
+    def __init__(self):
+        self.stage = "starting"
+        self.progress = 0.0
+        self.error = None
+        self.started_at = time.time()
+        self.stage_started_at = self.started_at
+        self.stage_seconds = {}
+
+    @property
+    def ready(self) -> bool:
+        return self.stage == "ready"
+
+    def advance(self, stage: str, fraction: float = 0.0):
+        """Record a stage (and how far into it loading is); safe to call from loader threads"""
+        now = time.time()
+        if stage != self.stage:
+            self.stage_seconds[self.stage] = round(now - self.stage_started_at, 3)
+            self.stage_started_at = now
+            self.stage = stage
+            current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            print(f"[{current_time}] Startup stage: {stage} ({now - self.started_at:.1f}s)")
+        start, share = self.STAGES[stage]
+        if stage != "failed":
+            # Stages can arrive out of order (replicas map weights after exporting them); never go backwards
+            self.progress = max(self.progress, min(1.0, start + share * fraction))
+
+    def fail(self, error: Exception):
+        self.error = str(error)
+        self.advance("failed")
+
+    def retry_after(self) -> int:
+        """Seconds a client should wait before retrying, extrapolated from progress so far"""
+        elapsed = time.time() - self.started_at
+        if self.progress < 0.05:
+            return 10
+        return max(1, min(60, math.ceil(elapsed * (1 - self.progress) / self.progress)))
+
+    def to_dict(self) -> dict:
+        return {
+            "stage": self.stage,
+            "progress": round(self.progress, 3),
+            "elapsed_seconds": round(time.time() - self.started_at, 1),
+            "stage_seconds": dict(self.stage_seconds),
+            "error": self.error,
+        }
+
+
+startup = StartupState()
+
+
+def import_model_classes():
+    """torch and transformers take seconds to import, so they are imported after the port is bound"""
+    from local_llm import LlamaLocalLLM
+    from mock_llm import MockLocalLLM
+    return LlamaLocalLLM, MockLocalLLM
+
 
 async def initialize_model():
     """Initialize the local LLM model"""
-    global llm_model
-    llm_model = LlamaLocalLLM()
-    await llm_model.initialize()
+    global llm_model, context_builder, summarizer
+    loop = asyncio.get_running_loop()
+    startup.advance("importing")
+    LlamaLocalLLM, MockLocalLLM = await loop.run_in_executor(None, import_model_classes)
+
+    if mock_options is not None:
+        model = MockLocalLLM(**mock_options)
+    elif replica_options is not None:
+        model = ReplicaPool(**replica_options, **model_options)
+    else:
+        model = LlamaLocalLLM(**model_options)
+    # Published before loading finishes so shutdown can close a half-started replica pool
+    llm_model = model
+    await model.initialize(progress=startup.advance)
+    context_builder = ContextBuilder(model.count_tokens, token_budget=model.max_context_tokens - MAX_NEW_TOKENS)
+    if summary_options is not None:
+        summarizer = HistorySummarizer(memory, context_builder, UserDataBase, summarize_with_model, **summary_options)
     print("Local LLM model initialized successfully!")
 
+    await warm_up_model()
+    startup.advance("ready")
+
+async def summarize_with_model(system_message: str, text: str) -> str:
+    return await llm_model.generate_response(system_message, [{"role": "user", "content": text}],
+                                             max_tokens=SUMMARY_MAX_TOKENS)
+
+async def warm_up_model():
+    """Generate once per configured prompt length so the first real requests don't pay one-time costs"""
+    lengths = [min(length, context_builder.token_budget) for length in warmup_lengths]
+    role = next(iter(UserDataBase.values()))
+    system_message = memory.SYSTEM_PROMPT_TEMPLATE.format(user_role=role, user="warmup")
+    filler = "I have a question about balancing my coursework, sleep and exercise during the semester. "
+    filler_tokens = max(1, llm_model.count_tokens(filler))
+    # Every replica of a pool pays its own one-time costs, so each one gets the warm-up requests
+    targets = [{"replica": index} for index in range(llm_model.num_replicas)] \
+        if isinstance(llm_model, ReplicaPool) else [{}]
+
+    for index, length in enumerate(lengths):
+        startup.advance("warming_up", index / len(lengths))
+        question = filler * max(1, length // filler_tokens)
+        start = time.perf_counter()
+        await asyncio.gather(*(llm_model.generate_response(
+            system_message,
+            [{"role": "user", "content": question}],
+            max_tokens=warmup_tokens,
+            system_prefix=memory.get_system_prefix(role),
+            system_prefix_key=role,
+            **target,
+        ) for target in targets))
+        current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        print(f"[{current_time}] Warm-up at ~{length} prompt tokens took {time.perf_counter() - start:.2f}s"
+              f"{f' on each of {len(targets)} replicas' if len(targets) > 1 else ''}")
+
+async def load_model_in_background():
+    try:
+        await initialize_model()
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        startup.fail(e)
+        current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        print(f"[{current_time}] Model failed to load: {e}")
+
+def request_deadline(request) -> float:
+    """time.monotonic() deadline from the X-Request-Timeout header (seconds), capped at --request-timeout"""
+    timeout = request_timeout
+    header = request.headers.get('X-Request-Timeout')
+    if header:
+        try:
+            timeout = min(timeout, max(0.0, float(header)))
+        except ValueError:
+            pass
+    return time.monotonic() + timeout
+
+@web.middleware
+async def admission_middleware(request, handler):
+    """Rate-limit per user, set the deadline and answer 503 when the request can't get a model slot in time"""
+    if request.path not in ADMITTED_ROUTES or not startup.ready:
+        return await handler(request)
+    try:
+        user = (await request.json()).get('user')
+    except Exception:
+        return await handler(request)  # The handler reports the bad request
+
+    if rate_limiter is not None and user is not None:
+        wait = rate_limiter.acquire(user)
+        if wait > 0:
+            return web.json_response({'error': f'Rate limit exceeded for {user}'}, status=429,
+                                     headers=retry_after_header(wait))
+
+    request['deadline'] = request_deadline(request)
+    try:
+        # Handlers take their slot once the user's earlier turns are done, so queued turns don't hold slots
+        return await handler(request)
+    except Overloaded as e:
+        current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        print(f"[{current_time}] Rejected request from {user} with status code: 503 - {e}")
+        return web.json_response({'error': str(e)}, status=503, headers=retry_after_header(e.retry_after))
+    except DeadlineExceeded as e:
+        current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        print(f"[{current_time}] Dropped request from {user} with status code: 503 - {e}")
+        return web.json_response({'error': str(e)}, status=503, headers=retry_after_header(admission.expected_wait()))
+
+def not_ready_response():
+    """503 until the model is loaded; Retry-After estimates the remaining load time"""
+    if startup.stage == "failed":
+        return web.json_response({'error': f'Model failed to load: {startup.error}'}, status=503)
+    return web.json_response(
+        {'error': 'Model is loading', 'startup': startup.to_dict()},
+        status=503,
+        headers={'Retry-After': str(startup.retry_after())},
+    )
+
 async def handle_request(request):
     global llm_model
 
+    if not startup.ready:
+        return not_ready_response()
+
     try:
         data = await request.json()
         user = data['user']
@@ -31,33 +253,220 @@ async def handle_request(request):
         if user not in UserDataBase:
             return web.json_response({'error': 'Unknown user'}, status=400)
 
-        # Add user's question to memory
-        memory.add_user_message(user, question)
+        result, merged = await sequencer.submit(
+            user, question, lambda text: answer_question(user, text, request.get('deadline')))
+        if summarizer is not None:
+            summarizer.note_turn(user)
+        if merged > 1:
+            result = {**result, 'coalesced': merged}
+        return web.json_response(result)
+    except (DeadlineExceeded, Overloaded):
+        raise  # Answered with 503 by admission_middleware
+    except Exception as e:
+        # Log error
+        current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        print(f"[{current_time}] Error occurred with status code: 400 - {str(e)}")
+        return web.json_response({'error': str(e)}, status=400)
 
-        # Get messages for API call (includes conversation history)
-        system_message, messages = memory.get_messages_for_api(user, UserDataBase[user])
+async def answer_question(user: str, question: str, deadline=None) -> dict:
+    """One turn of the conversation: runs once the user's earlier turns have finished"""
+    async with admission.slot(deadline):
+        # Get messages for API call (newest conversation history that fits the token budget). The question is
+        # stored only together with its answer, so a turn rejected with 503 leaves the history as it was
+        system_message, messages = memory.get_context_for_api(user, UserDataBase[user], context_builder,
+                                                              question=question)
 
         # Log received question
         current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         print(f"[{current_time}] User {user} asked: {question}")
 
         # Get response from local LLM using conversation history
-        response = await llm_model.generate_response(system_message, messages)
+        details = {}  # finish_reason and tokens_saved, unless the answer comes from the response cache
 
-        # Add LLM's response to memory
-        memory.add_assistant_message(user, response)
+        async def generate():
+            return await llm_model.generate_response(
+                system_message,
+                messages,
+                max_tokens=MAX_NEW_TOKENS,
+                user=user,
+                system_prefix=memory.get_system_prefix(UserDataBase[user]),
+                system_prefix_key=UserDataBase[user],
+                deadline=deadline,
+                details=details,
+            )
 
-        # Log response
-        current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        print(f"[{current_time}] Responded to {user} with status code: 200")
+        cached = False
+        if response_cache is not None:
+            key = ResponseCache.make_key(system_message, question, messages[:-1])
+            response, cached = await response_cache.get_or_generate(key, generate)
+        else:
+            response = await generate()
+
+        # Add the question and the LLM's response to memory
+        memory.add_turn(user, question, response)
+
+    # Log response
+    current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    print(f"[{current_time}] Responded to {user} with status code: 200{' (cached)' if cached else ''}"
+          f"{stop_note(details)}")
+
+    result = {'user': user, 'response': response}
+    if details:
+        result.update(finish_reason=details['finish_reason'], tokens_saved=details['tokens_saved'])
+        if 'speculation' in details:
+            result['speculation'] = details['speculation']
+    return result
+
+def stop_note(details: dict) -> str:
+    """Log suffix for responses ended by a stop string or a repetition loop"""
+    if details.get('finish_reason') not in ('stop', 'loop'):
+        return ''
+    return f" (stopped at {'a stop string' if details['finish_reason'] == 'stop' else 'a repetition loop'}, " \
+           f"{details['tokens_saved']} tokens saved)"
 
-        return web.json_response({'user': user, 'response': response})
+async def handle_stream_request(request):
+    """Like /ask, but streams the response as newline-delimited JSON while tokens are decoded"""
+    if not startup.ready:
+        return not_ready_response()
+
+    try:
+        data = await request.json()
+        user = data['user']
+        question = data['question']
+
+        if user not in UserDataBase:
+            return web.json_response({'error': 'Unknown user'}, status=400)
     except Exception as e:
-        # Log error
+        return web.json_response({'error': str(e)}, status=400)
+
+    async def turn(_):
+        async with admission.slot(request.get('deadline')):
+            return await stream_answer(request, user, question)
+
+    # A streamed answer goes to one client, so it is never merged with other questions
+    response, _ = await sequencer.submit(user, question, turn, mergeable=False)
+    if summarizer is not None:
+        summarizer.note_turn(user)
+    return response
+
+async def stream_answer(request, user: str, question: str):
+    # The question is stored with the answer once the stream ends; a failed or abandoned stream stores neither
+    system_message, messages = memory.get_context_for_api(user, UserDataBase[user], context_builder,
+                                                          question=question)
+
+    current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    print(f"[{current_time}] User {user} asked (streaming): {question}")
+
+    response = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+    await response.prepare(request)
+
+    # A cached answer (or one an identical request is generating right now) is sent as a single chunk
+    key = None
+    if response_cache is not None:
+        key = ResponseCache.make_key(system_message, question, messages[:-1])
+        cached = await response_cache.get(key)
+        if cached is not None:
+            memory.add_turn(user, question, cached)
+            await response.write((json.dumps({'token': cached}) + '\n').encode())
+            await response.write((json.dumps({'done': True, 'user': user, 'response': cached}) + '\n').encode())
+            await response.write_eof()
+
+            current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            print(f"[{current_time}] Streamed cached response to {user}")
+            return response
+
+    chunks = []
+    details = {}
+    start = time.perf_counter()
+    try:
+        # Closed as soon as the client goes away, so the model stops decoding for it
+        async with contextlib.aclosing(llm_model.stream_response(
+            system_message,
+            messages,
+            max_tokens=MAX_NEW_TOKENS,
+            user=user,
+            system_prefix=memory.get_system_prefix(UserDataBase[user]),
+            system_prefix_key=UserDataBase[user],
+            deadline=request.get('deadline'),
+            details=details,
+        )) as stream:
+            async for chunk in stream:
+                chunks.append(chunk)
+                await response.write((json.dumps({'token': chunk}) + '\n').encode())
+
+        # Commit the finished text to memory once the stream ends
+        text = ''.join(chunks).strip()
+        memory.add_turn(user, question, text)
+        if key is not None:
+            response_cache.put(key, text, time.perf_counter() - start)
+        done = {'done': True, 'user': user, 'response': text}
+        if details:
+            done.update(finish_reason=details['finish_reason'], tokens_saved=details['tokens_saved'])
+            if 'speculation' in details:
+                done['speculation'] = details['speculation']
+        await response.write((json.dumps(done) + '\n').encode())
+
         current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        print(f"[{current_time}] Error occurred with status code: 400 - {str(e)}")
+        print(f"[{current_time}] Streamed response to {user}{stop_note(details)}")
+    except ConnectionResetError:
+        current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        print(f"[{current_time}] Client disconnected while streaming to {user}")
+        return response
+    except Exception as e:
+        current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        print(f"[{current_time}] Error while streaming to {user}: {str(e)}")
+        await response.write((json.dumps({'error': str(e)}) + '\n').encode())
+
+    await response.write_eof()
+    return response
+
+async def handle_batch_request(request):
+    """Answer a list of {user, question} items together, streaming NDJSON results as they finish"""
+    if not startup.ready:
+        return not_ready_response()
+
+    try:
+        items = parse_batch(await request.json())
+    except Exception as e:
         return web.json_response({'error': str(e)}, status=400)
 
+    deadline = request_deadline(request)
+    # The batch's items take at most as many model slots as one client's requests could, so they never fill the queue
+    slots = asyncio.Semaphore(admission.max_concurrency)
+    limited = set()  # Users the rate limiter turned away for this batch
+
+    current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    print(f"[{current_time}] Batch of {len(items)} questions received")
+
+    async def answer(user: str, question: str) -> dict:
+        if user not in UserDataBase:
+            return {'user': user, 'error': 'Unknown user', 'status': 400}
+        # A batch counts as one request per user in it
+        if rate_limiter is not None and user not in limited and rate_limiter.acquire(user) > 0:
+            limited.add(user)
+        if user in limited:
+            return {'user': user, 'error': f'Rate limit exceeded for {user}', 'status': 429}
+
+        async def turn(text):
+            async with slots:
+                return await answer_question(user, text, deadline)
+
+        try:
+            # Never merged: every item gets its own answer
+            result, _ = await sequencer.submit(user, question, turn, mergeable=False)
+        except (DeadlineExceeded, Overloaded) as e:
+            return {'user': user, 'error': str(e), 'status': 503}
+        if summarizer is not None:
+            summarizer.note_turn(user)
+        return result
+
+    # Each turn is logged as it finishes; the log's writer group-commits whatever piles up meanwhile
+    response = await stream_batch(request, items, answer)
+
+    current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    print(f"[{current_time}] Finished batch of {len(items)} questions")
+    return response
+
 async def clear_conversation(request):
     try:
         data = await request.json()
@@ -67,6 +476,8 @@ async def clear_conversation(request):
             return web.json_response({'error': 'Unknown user'}, status=400)
 
         memory.clear_conversation(user)
+        if llm_model is not None:
+            llm_model.clear_user_cache(user)
 
         current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         print(f"[{current_time}] Cleared conversation history for {user}")
@@ -78,26 +489,160 @@ async def clear_conversation(request):
         return web.json_response({'error': str(e)}, status=400)
 
 async def health_check(request):
-    """Health check endpoint"""
+    """Health check endpoint; the process is healthy while the model is still loading"""
+    status = {'ready': 'healthy', 'failed': 'failed'}.get(startup.stage, 'loading')
     return web.json_response({
-        'status': 'healthy',
-        'model_loaded': llm_model is not None,
+        'status': status,
+        'model_loaded': startup.ready,
+        'startup': startup.to_dict(),
+        'kv_cache': llm_model.cache_stats() if startup.ready else {},
+        'response_cache': response_cache.stats() if response_cache is not None else None,
+        'admission': admission.stats(),
+        'rate_limit': rate_limiter.stats() if rate_limiter is not None else None,
+        'sequencer': sequencer.stats(),
+        'summarizer': summarizer.stats() if summarizer is not None else None,
+        'memory': memory.stats(),
         'timestamp': datetime.now().isoformat()
-    })
+    }, status=503 if status == 'failed' else 200)
 
-async def init_app():
-    """Initialize the web application"""
-    # Initialize the model first
-    await initialize_model()
+async def readiness_check(request):
+    """200 once the model is loaded and warmed up, otherwise 503 with Retry-After"""
+    if not startup.ready:
+        return not_ready_response()
+    return web.json_response({'ready': True, 'startup': startup.to_dict()})
 
-    app = web.Application()
+async def init_app():
+    """Initialize the web application; the model loads in the background once the server is listening"""
+    app = web.Application(middlewares=[metrics_middleware, admission_middleware])
     app.router.add_post('/ask', handle_request)
+    app.router.add_post('/ask_stream', handle_stream_request)
+    app.router.add_post('/ask_batch', handle_batch_request)
     app.router.add_post('/clear', clear_conversation)
     app.router.add_get('/health', health_check)
+    app.router.add_get('/ready', readiness_check)
+    app.router.add_get('/metrics', handle_metrics)
+    app.on_startup.append(start_loading)
+    app.on_cleanup.append(stop_model)
 
     return app
 
+async def start_loading(app):
+    app['model_loader'] = asyncio.create_task(load_model_in_background())
+
+async def stop_model(app):
+    loader = app['model_loader']
+    if not loader.done():
+        loader.cancel()
+        await asyncio.gather(loader, return_exceptions=True)
+    if summarizer is not None:
+        await summarizer.close()
+    if isinstance(llm_model, ReplicaPool) and llm_model.processes:
+        await llm_model.close()
+
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Local LLM counseling server")
+    parser.add_argument("--response-cache", action="store_true",
+                        help="Reuse answers to repeated questions from users with the same role and history")
+    parser.add_argument("--cache-size", type=int, default=1024, help="Maximum cached responses")
+    parser.add_argument("--cache-ttl", type=float, default=600.0, help="Seconds a cached response stays valid")
+    parser.add_argument("--mock", action="store_true", help="Benchmark the server offline with a fake model")
+    parser.add_argument("--mock-prefill-ms", type=float, default=50.0, help="Mock delay before the first token")
+    parser.add_argument("--mock-token-ms", type=float, default=20.0, help="Mock delay per generated token")
+    parser.add_argument("--mock-tokens", type=int, default=32, help="Tokens per mock response")
+    parser.add_argument("--mock-concurrency", type=int, default=8, help="Mock requests generated at once")
+    parser.add_argument("--replicas", type=int, default=0,
+                        help="Run this many model worker processes (0 = one model in the server process)")
+    parser.add_argument("--cores-per-replica", type=int, default=None,
+                        help="Cores pinned to each replica (default: split available cores evenly)")
+    parser.add_argument("--weights-dir", default="model_cache", help="Where replicas' shared weights file is kept")
+    parser.add_argument("--dtype", choices=["fp32", "bf16"], default="fp32", help="Weight precision")
+    parser.add_argument("--quantize", choices=["int8"], default=None,
+                        help="Dynamic int8 quantization of linear layers (fp32 only)")
+    parser.add_argument("--compile", action="store_true", help="Compile the model's MLP and norm blocks with torch.compile")
+    parser.add_argument("--threads", type=int, default=None,
+                        help="Torch intra-op threads (per replica with --replicas; default: torch's choice)")
+    parser.add_argument("--interop-threads", type=int, default=None, help="Torch inter-op threads")
+    parser.add_argument("--speculative", choices=["draft", "prompt_lookup"], default=None,
+                        help="Decode each request speculatively instead of in the continuous batch")
+    parser.add_argument("--draft-model", default=None, help="Draft model for --speculative draft (same tokenizer)")
+    parser.add_argument("--lookahead", type=int, default=4, help="Tokens proposed per speculative verification pass")
+    parser.add_argument("--ngram-size", type=int, default=3, help="Longest n-gram matched by prompt lookup")
+    parser.add_argument("--warmup-lengths", default="128,1024",
+                        help="Comma-separated prompt lengths (tokens) to generate once after loading; empty disables")
+    parser.add_argument("--warmup-tokens", type=int, default=16, help="Tokens generated per warm-up prompt")
+    parser.add_argument("--max-concurrency", type=int, default=8,
+                        help="Requests given to the model at once (match the batch size)")
+    parser.add_argument("--max-queue", type=int, default=64, help="Requests allowed to wait for the model; more get 503")
+    parser.add_argument("--request-timeout", type=float, default=60.0,
+                        help="Seconds a request may wait before it is dropped (clients can lower it with X-Request-Timeout)")
+    parser.add_argument("--rate-limit", type=float, default=0.0,
+                        help="Requests per second allowed per user (0 = unlimited); excess gets 429")
+    parser.add_argument("--rate-burst", type=float, default=5.0, help="Requests a user may send at once before limiting")
+    parser.add_argument("--coalesce", action="store_true",
+                        help="Answer questions a user sends while their previous one is running with one generation")
+    parser.add_argument("--summarize-after", type=int, default=0,
+                        help="Summarize a user's oldest turns once their history reaches this many tokens (0 = never)")
+    parser.add_argument("--summary-keep-tokens", type=int, default=512,
+                        help="Newest part of a summarized history kept word for word")
+    parser.add_argument("--summary-interval", type=float, default=10.0, help="Seconds between summarization jobs")
+    parser.add_argument("--stop", action="append", default=None,
+                        help="Text that ends a response, with backslash escapes (repeatable; default: "
+                             "\\nUser: \\nAssistant: \\nSystem:; --stop '' disables)")
+    parser.add_argument("--loop-max-ngram", type=int, default=32,
+                        help="Longest n-gram whose back-to-back repetition ends a response (0 = no loop detection)")
+    parser.add_argument("--history-cache-mb", type=float, default=256.0,
+                        help="Memory for conversation histories; the least recently used are read from disk again")
+    args = parser.parse_args()
+
+    memory.max_cached_bytes = int(args.history_cache_mb * 2 ** 20)
+    admission = AdmissionController(max_concurrency=args.max_concurrency, max_queue=args.max_queue)
+    request_timeout = args.request_timeout
+    if args.rate_limit > 0:
+        rate_limiter = RateLimiter(args.rate_limit, burst=args.rate_burst)
+    if args.coalesce:
+        sequencer = UserSequencer(coalesce=True)
+    if args.summarize_after > 0:
+        summary_options = {
+            "threshold_tokens": args.summarize_after,
+            "keep_tokens": args.summary_keep_tokens,
+            "min_interval": args.summary_interval,
+        }
+
+    warmup_lengths = [int(length) for length in args.warmup_lengths.split(",") if length.strip()]
+    warmup_tokens = args.warmup_tokens
+
+    model_options = {
+        "dtype": args.dtype,
+        "quantize": args.quantize,
+        "compile_model": args.compile,
+        "num_threads": args.threads,
+        "interop_threads": args.interop_threads,
+        "speculative": args.speculative,
+        "draft_model_name": args.draft_model,
+        "lookahead": args.lookahead,
+        "ngram_size": args.ngram_size,
+        "loop_max_ngram": args.loop_max_ngram,
+    }
+    if args.stop is not None:
+        model_options["stop_strings"] = [codecs.decode(stop, "unicode_escape") for stop in args.stop if stop]
+    if args.replicas > 0:
+        replica_options = {
+            "num_replicas": args.replicas,
+            "cores_per_replica": args.cores_per_replica,
+            "weights_dir": args.weights_dir,
+        }
+
+    if args.mock:
+        mock_options = {
+            "prefill_delay": args.mock_prefill_ms / 1000,
+            "token_delay": args.mock_token_ms / 1000,
+            "response_tokens": args.mock_tokens,
+            "max_concurrency": args.mock_concurrency,
+        }
+
+    if args.response_cache:
+        response_cache = ResponseCache(max_entries=args.cache_size, ttl=args.cache_ttl)
+
     print("Starting Local LLM Server...")
     print("This may take a few minutes to download and load the model...")
 
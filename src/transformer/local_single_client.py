@@ -1,18 +1,23 @@
-import asyncio
-import aiohttp
+import argparse
+import os
 import sys
+import time
+
+# Modules shared by both servers and the router (metrics, clients, storage, ...) live in src/common
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "common"))
+
+from counseling_client import LOCAL_URL, SyncCounselingClient
 
 USERS = ['Linda', 'Miguel', 'Mike']
 
-async def check_health(session):
+def check_health(client):
     """Check if the local server is healthy"""
     try:
-        async with session.get('http://localhost:8081/health') as resp:
-            return await resp.json()
+        return client.health()
     except Exception as e:
         return {'error': str(e)}
 
-async def chat_session(session, selected_user):
+def chat_session(client, selected_user):
     print(f"\nStarting chat as {selected_user}. Type 'quit' to exit.")
     print("Ask your question:")
 
@@ -26,22 +31,28 @@ async def chat_session(session, selected_user):
             if not question.strip():
                 continue
 
-            async with session.post('http://localhost:8081/ask',
-                                  json={'user': selected_user, 'question': question}) as resp:
-                response = await resp.json()
-                if 'error' in response:
-                    print(f"Error: {response['error']}")
-                else:
-                    print(f"\nResponse: {response['response']}\n")
+            start = time.perf_counter()
+            first_token_at = None
+            print("\nResponse: ", end="", flush=True)
+            # Render tokens as the server streams them
+            for event in client.stream(selected_user, question):
+                if 'token' in event:
+                    if first_token_at is None:
+                        first_token_at = time.perf_counter()
+                    print(event['token'], end="", flush=True)
+
+            total = time.perf_counter() - start
+            ttft = f"{first_token_at - start:.2f}s" if first_token_at else "n/a"
+            print(f"\n\n(time to first token: {ttft}, total: {total:.2f}s)\n")
 
         except Exception as e:
-            print(f"Error: {e}")
+            print(f"\nError: {e}")
 
-async def main():
-    async with aiohttp.ClientSession() as session:
+def main(url: str):
+    with SyncCounselingClient(url) as client:
         # First check if server is running
         print("Checking local LLM server health...")
-        health = await check_health(session)
+        health = check_health(client)
         if 'error' in health:
             print(f"Error connecting to server: {health['error']}")
             print("Make sure to start the local server first: python local_server.py")
@@ -52,30 +63,32 @@ async def main():
             print("Model is still loading, please wait...")
             return
 
-    # User selection
-    print("\nWelcome to the Local AI Assistant! Please select your user:")
-    for idx, user in enumerate(USERS, 1):
-        print(f"{idx}. {user}")
+        # User selection
+        print("\nWelcome to the Local AI Assistant! Please select your user:")
+        for idx, user in enumerate(USERS, 1):
+            print(f"{idx}. {user}")
 
-    while True:
-        try:
-            choice = int(input("Enter your choice (1-3): "))
-            if 1 <= choice <= len(USERS):
-                selected_user = USERS[choice-1]
-                break
-            print("Please enter a valid number between 1 and 3")
-        except ValueError:
-            print("Please enter a valid number")
-        except KeyboardInterrupt:
-            print("\nGoodbye!")
-            sys.exit(0)
+        while True:
+            try:
+                choice = int(input("Enter your choice (1-3): "))
+                if 1 <= choice <= len(USERS):
+                    selected_user = USERS[choice-1]
+                    break
+                print("Please enter a valid number between 1 and 3")
+            except ValueError:
+                print("Please enter a valid number")
+            except KeyboardInterrupt:
+                print("\nGoodbye!")
+                sys.exit(0)
 
-    # Start chat session
-    async with aiohttp.ClientSession() as session:
-        await chat_session(session, selected_user)
+        # Start chat session
+        chat_session(client, selected_user)
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Chat with the local LLM server as one user")
+    parser.add_argument("--url", default=LOCAL_URL, help="Server address")
+    args = parser.parse_args()
     try:
-        asyncio.run(main())
+        main(args.url)
     except KeyboardInterrupt:
-        print("\nGoodbye!")
\ No newline at end of file
+        print("\nGoodbye!")
@@ -0,0 +1,71 @@
+import asyncio
+import random
+import time
+
+from admission import DeadlineExceeded
+from context_builder import estimate_tokens
+from local_llm import LocalLLMModel
+
+
+class MockLocalLLM(LocalLLMModel):
+    """
+    Drop-in LocalLLMModel that loads no weights and answers after fixed delays.
+
+    Used to benchmark the server itself (routing, memory, context building,
+    streaming) offline: `python local_server.py --mock`. At most
+    max_concurrency requests "decode" at once, like the batch slots of the
+    real scheduler; the rest wait their turn.
+    """
+
+    def __init__(self, prefill_delay: float = 0.05, token_delay: float = 0.02, response_tokens: int = 32,
+                 max_concurrency: int = 8, jitter: float = 0.0, max_context_tokens: int = 2048):
+        """
+        Args:
+            prefill_delay: Seconds before the first token
+            token_delay: Seconds per generated token
+            response_tokens: Tokens per response (capped by max_tokens)
+            max_concurrency: Requests generated at once
+            jitter: Relative random variation of both delays
+            max_context_tokens: Prompt budget reported to the context builder
+        """
+        super().__init__("mock", device="cpu", batching=False, kv_cache_bytes=0, max_context_tokens=max_context_tokens)
+        self.prefill_delay = prefill_delay
+        self.token_delay = token_delay
+        self.response_tokens = response_tokens
+        self.max_concurrency = max_concurrency
+        self.jitter = jitter
+        self._slots = None
+
+    async def initialize(self, progress=None):
+        self._slots = asyncio.Semaphore(self.max_concurrency)
+        self.logger.info(f"Mock model ready: {self.prefill_delay * 1000:.0f} ms prefill, "
+                         f"{self.token_delay * 1000:.0f} ms/token, {self.response_tokens} tokens")
+
+    def count_tokens(self, text: str) -> int:
+        return estimate_tokens(text)
+
+    def _delay(self, seconds: float) -> float:
+        return max(0.0, seconds * (1 + random.uniform(-self.jitter, self.jitter)))
+
+    async def generate_response(self, system_message: str, messages: list, max_tokens: int = 256, user: str = None,
+                                system_prefix: str = None, system_prefix_key: str = None, deadline: float = None,
+                                details: dict = None) -> str:
+        chunks = [chunk async for chunk in self.stream_response(system_message, messages, max_tokens, deadline=deadline,
+                                                                details=details)]
+        return "".join(chunks).strip()
+
+    async def stream_response(self, system_message: str, messages: list, max_tokens: int = 256, user: str = None,
+                              system_prefix: str = None, system_prefix_key: str = None, deadline: float = None,
+                              details: dict = None):
+        async with self._slots:
+            if deadline is not None and time.monotonic() > deadline:
+                raise DeadlineExceeded("Deadline passed while waiting for the model")
+            await asyncio.sleep(self._delay(self.prefill_delay))
+            tokens = min(self.response_tokens, max_tokens)
+            for i in range(tokens):
+                if i:
+                    await asyncio.sleep(self._delay(self.token_delay))
+                yield f" token{i}"
+            if details is not None:
+                details.update({"finish_reason": "length" if tokens == max_tokens else "eos",
+                                "completion_tokens": tokens, "tokens_saved": 0})
@@ -0,0 +1,74 @@
+"""
+CPU precision, quantization, compilation and threading options for a loaded model.
+
+Applied by LocalLLMModel.initialize after the weights are loaded:
+
+- dtype "bf16" halves weight memory and uses bf16 matmuls where the CPU has them
+- quantize "int8" replaces every nn.Linear with a dynamically quantized one
+  (int8 weights, activations quantized per batch); fp32 only
+- compile runs each layer's MLP and norms through torch.compile. The whole
+  forward pass is not compiled: the KV cache the scheduler grows every step
+  makes dynamo recompile until it gives up and falls back to eager
+"""
+import logging
+from typing import Optional
+
+import torch
+
+DTYPES = {"fp32": torch.float32, "bf16": torch.bfloat16}
+QUANTIZATIONS = ("int8",)
+
+logger = logging.getLogger(__name__)
+
+
+def validate_options(dtype: str = "fp32", quantize: Optional[str] = None):
+    """Raise ValueError for unknown or incompatible options before any weights are loaded"""
+    if dtype not in DTYPES:
+        raise ValueError(f"Unknown dtype {dtype!r}, expected one of {', '.join(DTYPES)}")
+    if quantize is not None and quantize not in QUANTIZATIONS:
+        raise ValueError(f"Unknown quantization {quantize!r}, expected one of {', '.join(QUANTIZATIONS)}")
+    if quantize == "int8" and dtype != "fp32":
+        raise ValueError("Dynamic int8 quantization needs fp32 weights")
+
+
+def configure_threads(num_threads: Optional[int] = None, interop_threads: Optional[int] = None):
+    """
+    Set torch's intra-op (per matmul) and inter-op thread pools
+    Args:
+        num_threads: Threads per operation (default: torch's choice, usually the physical cores)
+        interop_threads: Threads running independent operations; can only be set before torch does any parallel work
+    """
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    if interop_threads:
+        try:
+            torch.set_num_interop_threads(interop_threads)
+        except RuntimeError:
+            logger.warning(f"Inter-op threads already started, keeping {torch.get_num_interop_threads()}")
+
+
+def prepare_model(model, dtype: str = "fp32", quantize: Optional[str] = None, compile_model: bool = False):
+    """
+    Convert a loaded eval-mode model in place for CPU inference
+    Args:
+        model: Model returned by from_pretrained (fp32)
+        dtype: "fp32" or "bf16"
+        quantize: None or "int8"
+        compile_model: Compile the cache-free blocks (MLPs and norms) with torch.compile
+    Returns:
+        The prepared model (quantization returns a new module tree)
+    """
+    validate_options(dtype, quantize)
+    if DTYPES[dtype] != model.dtype:
+        model = model.to(DTYPES[dtype])
+    if quantize == "int8":
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    if compile_model:
+        compiled = 0
+        for module in model.modules():
+            if type(module).__name__.endswith(("MLP", "RMSNorm")):
+                # Sequence length changes every call; dynamic shapes avoid a recompile per length
+                module.compile(dynamic=True)
+                compiled += 1
+        logger.info(f"Compiled {compiled} modules")
+    return model
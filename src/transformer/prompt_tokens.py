@@ -0,0 +1,122 @@
+"""
+Incremental prompt tokenization.
+
+A prompt is the system line, one line per turn and the "Assistant:" cue, and
+between two turns of a conversation only the last line or two are new.
+Tokenizing the whole formatted conversation again for every turn costs time
+that grows with the history. SegmentTokenCache keeps the token ids of each
+formatted segment, so a prompt is assembled by concatenating cached ids and
+only new segments are tokenized.
+
+Concatenated ids equal the ids of the concatenated text as long as the
+tokenizer's pre-tokenizer always splits at segment boundaries. Every segment
+ends with a newline and the next one starts with a letter ("User:",
+"Assistant:"), and byte-level BPE tokenizers (GPT-2, Llama 3) never merge
+across that. matches_full_tokenization() confirms it for a loaded tokenizer
+on awkward samples; the model falls back to full tokenization if it does not.
+"""
+import collections
+import threading
+from typing import Callable, List, Optional
+
+from metrics import REGISTRY
+
+SEGMENT_LOOKUPS = REGISTRY.counter("llm_prompt_segments_total", "Prompt segments looked up in the token cache",
+                                   ["result"])
+ENCODE_SECONDS = REGISTRY.histogram("llm_prompt_encode_seconds", "Time to turn a conversation into prompt token ids",
+                                    ["path"], buckets=(0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                                                       0.25, 0.5))
+
+# Conversations whose segment boundaries are hard on a pre-tokenizer: whitespace and punctuation on both sides
+CHECK_CONVERSATIONS = [
+    [{"role": "user", "content": "What are effective study techniques for finals?"}],
+    [
+        {"role": "user", "content": "  leading spaces, trailing spaces   "},
+        {"role": "assistant", "content": "Ends with newlines\n\n"},
+        {"role": "user", "content": "\nstarts with a newline and ends with punctuation..."},
+        {"role": "assistant", "content": ""},
+        {"role": "user", "content": "'s 's 'll contractions, numbers 12345 and symbols #@!"},
+        {"role": "assistant", "content": "Unicode: café, naïve, 東京, emoji 🎓\t\r\n"},
+        {"role": "user", "content": "...trimmed start of an old turn"},
+    ],
+]
+
+
+class SegmentTokenCache:
+    """Token ids of prompt segments (keyed by their text), least recently used evicted first"""
+
+    def __init__(self, encode: Callable[[str], List[int]], max_entries: int = 50_000):
+        """
+        Args:
+            encode: Tokenizes a segment without special tokens
+            max_entries: Segments kept; a turn is one segment
+        """
+        self.encode_segment = encode
+        self.max_entries = max_entries
+        self._ids = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, segment: str) -> List[int]:
+        with self._lock:
+            ids = self._ids.get(segment)
+            if ids is not None:
+                self._ids.move_to_end(segment)
+                self.hits += 1
+        if ids is not None:
+            SEGMENT_LOOKUPS.inc(result="hit")
+            return ids
+
+        ids = self.encode_segment(segment)
+        with self._lock:
+            self._ids[segment] = ids
+            if len(self._ids) > self.max_entries:
+                self._ids.popitem(last=False)
+            self.misses += 1
+        SEGMENT_LOOKUPS.inc(result="miss")
+        return ids
+
+    def encode(self, segments: List[str]) -> List[int]:
+        """Token ids of "".join(segments), without special tokens"""
+        ids = []
+        for segment in segments:
+            ids.extend(self.get(segment))
+        return ids
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "segments": len(self._ids),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+def special_prefix_ids(tokenizer) -> Optional[List[int]]:
+    """Ids the tokenizer puts before a text (e.g. BOS); None if it also adds tokens after it"""
+    plain = tokenizer("Hello", add_special_tokens=False)["input_ids"]
+    full = tokenizer("Hello")["input_ids"]
+    if len(full) < len(plain) or full[len(full) - len(plain):] != plain:
+        return None
+    return full[:len(full) - len(plain)]
+
+
+def matches_full_tokenization(encode_full: Callable[[str], List[int]],
+                              encode_incremental: Callable[[List[str]], List[int]],
+                              segments_for: Callable[[str, list], List[str]]) -> bool:
+    """
+    True if incremental encoding gives the same ids as tokenizing the joined text, for CHECK_CONVERSATIONS
+    Args:
+        encode_full: Text -> ids (special tokens included)
+        encode_incremental: Segments -> ids (special tokens included)
+        segments_for: (system_message, messages) -> segments
+    """
+    system_message = "You are an expert University counselor AI assistant helping a university Student."
+    for messages in CHECK_CONVERSATIONS:
+        for end in range(1, len(messages) + 1):
+            segments = segments_for(system_message, messages[:end])
+            if encode_full("".join(segments)) != encode_incremental(segments):
+                return False
+    return True
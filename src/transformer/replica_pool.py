@@ -0,0 +1,405 @@
+"""
+Multi-process model replicas for CPU serving.
+
+One model in one process behind one lock cannot use a many-core machine,
+and generation threads compete with the aiohttp loop for the GIL.
+ReplicaPool starts N worker processes, each pinned to its own slice of
+cores with a matching torch thread count, and each running a
+LlamaLocalLLM (with its own continuous batch scheduler). Weights are
+exported once to a safetensors file and memory-mapped by every worker, so
+they share one copy in the page cache.
+
+The pool exposes the LocalLLMModel interface the server uses
+(generate_response, stream_response, count_tokens, ...). Requests are
+routed to the least-loaded replica, but a user stays on the replica that
+served them before (where their KV cache lives) unless it is noticeably
+busier than the others.
+"""
+import asyncio
+import itertools
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+from typing import Dict, List, Optional
+
+from admission import DeadlineExceeded
+from metrics import REGISTRY
+
+REPLICA_IN_FLIGHT = REGISTRY.gauge("replica_in_flight", "Requests in flight per model replica", ["replica"])
+REPLICA_ROUTED = REGISTRY.counter("replica_routed_total", "Requests routed to a replica, by reason", ["reason"])
+
+
+def replica_cores(num_replicas: int, cores_per_replica: Optional[int] = None) -> List[List[int]]:
+    """Split the cores this process may use into one contiguous slice per replica"""
+    available = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count() or 1))
+    per_replica = cores_per_replica or max(1, len(available) // num_replicas)
+    slices = []
+    for index in range(num_replicas):
+        start = (index * per_replica) % len(available)
+        cores = available[start:start + per_replica]
+        slices.append(cores or available[:per_replica])
+    return slices
+
+
+def _worker_main(index: int, cores: List[int], model_name: str, weights_file: str, model_kwargs: Dict,
+                 requests: multiprocessing.Queue, results: multiprocessing.Queue):
+    # Pin before torch creates its thread pools
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+
+    import torch
+    torch.set_num_threads(len(cores))
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        pass
+
+    try:
+        asyncio.run(_serve(index, model_name, weights_file, model_kwargs, requests, results))
+    except Exception as e:
+        results.put(("failed", index, str(e)))
+
+
+async def _serve(index: int, model_name: str, weights_file: str, model_kwargs: Dict,
+                 requests: multiprocessing.Queue, results: multiprocessing.Queue):
+    from local_llm import LlamaLocalLLM
+
+    llm = LlamaLocalLLM(model_name=model_name, weights_file=weights_file, **model_kwargs)
+    await llm.initialize()
+    results.put(("ready", index, os.getpid()))
+
+    loop = asyncio.get_running_loop()
+    tasks: Dict[int, asyncio.Task] = {}  # request id -> generation
+    while True:
+        message = await loop.run_in_executor(None, requests.get)
+        kind = message[0]
+        if kind == "stop":
+            break
+        elif kind == "generate":
+            _, request_id, kwargs, stream = message
+            task = asyncio.create_task(_generate(llm, request_id, kwargs, stream, results))
+            tasks[request_id] = task
+            task.add_done_callback(lambda _, request_id=request_id: tasks.pop(request_id, None))
+        elif kind == "cancel":
+            # Nobody reads this answer anymore; the scheduler drops the request at its next decode step
+            task = tasks.get(message[1])
+            if task is not None:
+                task.cancel()
+        elif kind == "clear":
+            llm.clear_user_cache(message[1])
+        elif kind == "invalidate":
+            llm.invalidate_system_prefixes()
+
+    if tasks:
+        await asyncio.gather(*tasks.values(), return_exceptions=True)
+    if llm.scheduler is not None:
+        llm.scheduler.stop()
+
+
+async def _generate(llm, request_id: int, kwargs: Dict, stream: bool, results: multiprocessing.Queue):
+    details = {}  # How generation ended, sent back with the response
+    try:
+        if stream:
+            chunks = []
+            async for chunk in llm.stream_response(**kwargs, details=details):
+                chunks.append(chunk)
+                results.put(("token", request_id, chunk))
+            results.put(("done", request_id, ("".join(chunks).strip(), details)))
+        else:
+            results.put(("done", request_id, (await llm.generate_response(**kwargs, details=details), details)))
+    except DeadlineExceeded as e:
+        results.put(("expired", request_id, str(e)))
+    except asyncio.CancelledError:
+        pass  # Cancelled by the pool, which no longer waits for a result
+    except Exception as e:
+        results.put(("error", request_id, str(e)))
+
+
+class ReplicaPool:
+    def __init__(self, num_replicas: int, model_name: str = "meta-llama/Llama-3.2-1B",
+                 cores_per_replica: Optional[int] = None, weights_dir: str = "model_cache",
+                 affinity_slack: int = 2, max_context_tokens: int = 2048, **model_kwargs):
+        """
+        Args:
+            num_replicas: Worker processes, each with a full model
+            model_name: HuggingFace model name or local path
+            cores_per_replica: Cores pinned to each worker (default: split the available cores evenly)
+            weights_dir: Where the shared safetensors export is written
+            affinity_slack: Keep a user on their replica unless it has this many more requests in flight than the least-loaded one
+            max_context_tokens: Passed to each replica; also the context budget the server builds prompts for
+            model_kwargs: Other LlamaLocalLLM options for every replica (max_batch_size, dtype, quantize, ...)
+        """
+        self.num_replicas = num_replicas
+        self.model_name = model_name
+        self.cores = replica_cores(num_replicas, cores_per_replica)
+        # Exported in the replicas' dtype so converting after loading doesn't copy the shared weights
+        self.dtype = model_kwargs.get("dtype", "fp32")
+        suffix = "" if self.dtype == "fp32" else f"-{self.dtype}"
+        self.weights_file = os.path.join(weights_dir, model_name.strip("/").replace("/", "--") + suffix + ".safetensors")
+        self.affinity_slack = affinity_slack
+        self.max_context_tokens = max_context_tokens
+        self.model_kwargs = dict(model_kwargs, max_context_tokens=max_context_tokens)
+
+        self.tokenizer = None
+        self.tokenizer_lock = threading.Lock()
+        self.processes = []
+        self.pids = [None] * num_replicas
+        self._requests = []
+        self._results = None
+        self._reader = None
+        self._loop = None
+        self._closing = False
+
+        self._ids = itertools.count()
+        self._pending: Dict[int, tuple] = {}  # request id -> (replica, future or token queue)
+        self._ready: Dict[int, asyncio.Future] = {}
+        self.in_flight = [0] * num_replicas
+        self.completed = [0] * num_replicas
+        self.affinity: Dict[str, int] = {}
+        self.routed = {"affinity": 0, "least_loaded": 0}
+
+        self.logger = logging.getLogger(__name__)
+
+    async def initialize(self, progress=None):
+        """
+        Export the weights if needed and start every replica
+        Args:
+            progress: Optional callback(stage, fraction) for startup reporting
+        """
+        from transformers import AutoTokenizer
+
+        report = progress or (lambda stage, fraction=0.0: None)
+        self._loop = asyncio.get_running_loop()
+        report("loading_tokenizer")
+        self.tokenizer = await self._loop.run_in_executor(None, AutoTokenizer.from_pretrained, self.model_name)
+        report("preparing_model")
+        await self._loop.run_in_executor(None, self._ensure_weights)
+
+        # Spawn, not fork: torch thread pools and the event loop don't survive a fork
+        context = multiprocessing.get_context("spawn")
+        self._results = context.Queue()
+        self._ready = {index: self._loop.create_future() for index in range(self.num_replicas)}
+        for index, cores in enumerate(self.cores):
+            requests = context.Queue()
+            process = context.Process(
+                target=_worker_main,
+                args=(index, cores, self.model_name, self.weights_file, self.model_kwargs, requests, self._results),
+                name=f"model-replica-{index}",
+                daemon=True,
+            )
+            process.start()
+            self._requests.append(requests)
+            self.processes.append(process)
+
+        self._reader = threading.Thread(target=self._read_results, name="replica-results", daemon=True)
+        self._reader.start()
+
+        report("loading_weights")
+        try:
+            for ready, started in enumerate(asyncio.as_completed(list(self._ready.values())), start=1):
+                await started
+                report("loading_weights", ready / self.num_replicas)
+        except Exception:
+            await self.close()
+            raise
+        self.logger.info(f"{self.num_replicas} replicas ready on cores {self.cores}")
+
+    def _ensure_weights(self):
+        """Export the weights once; later starts (and every replica) map the same file"""
+        if os.path.exists(self.weights_file):
+            return
+        from transformers import AutoModelForCausalLM
+        from precision import DTYPES
+        from shared_weights import export_safetensors
+
+        self.logger.info(f"Exporting {self.model_name} weights to {self.weights_file}")
+        os.makedirs(os.path.dirname(self.weights_file) or ".", exist_ok=True)
+        model = AutoModelForCausalLM.from_pretrained(self.model_name).to(DTYPES[self.dtype])
+        export_safetensors(model, self.weights_file)
+        del model
+
+    def _read_results(self):
+        """Forward worker messages to the event loop; fail requests of replicas that died"""
+        while not self._closing:
+            try:
+                message = self._results.get(timeout=1.0)
+            except queue.Empty:
+                for index, process in enumerate(self.processes):
+                    if not process.is_alive():
+                        self._call_in_loop(self._replica_died, index)
+                continue
+            except (EOFError, OSError):
+                return
+            self._call_in_loop(self._dispatch, message)
+
+    def _call_in_loop(self, callback, *args):
+        try:
+            self._loop.call_soon_threadsafe(callback, *args)
+        except RuntimeError:
+            # The event loop is already closed: the pool is being torn down
+            self._closing = True
+
+    def _dispatch(self, message: tuple):
+        kind = message[0]
+        if kind == "ready":
+            _, index, pid = message
+            self.pids[index] = pid
+            self._ready[index].set_result(pid)
+            return
+        if kind == "failed":
+            _, index, error = message
+            if not self._ready[index].done():
+                self._ready[index].set_exception(RuntimeError(f"Replica {index} failed to start: {error}"))
+            return
+
+        request_id = message[1]
+        entry = self._pending.get(request_id)
+        if entry is None:
+            return
+        replica, target = entry
+
+        if kind == "token":
+            target.put_nowait(("token", message[2]))
+            return
+
+        del self._pending[request_id]
+        self.in_flight[replica] -= 1
+        self.completed[replica] += 1
+        REPLICA_IN_FLIGHT.set(self.in_flight[replica], replica=str(replica))
+        if isinstance(target, asyncio.Queue):
+            target.put_nowait((kind, message[2]))
+        elif kind == "done":
+            target.set_result(message[2])
+        elif kind == "expired":
+            target.set_exception(DeadlineExceeded(message[2]))
+        else:
+            target.set_exception(RuntimeError(message[2]))
+
+    def _replica_died(self, index: int):
+        if self._closing:
+            return
+        if not self._ready[index].done():
+            self._ready[index].set_exception(RuntimeError(f"Replica {index} exited during startup"))
+        for request_id, (replica, _) in list(self._pending.items()):
+            if replica == index:
+                self._dispatch(("error", request_id, f"Replica {index} exited"))
+
+    def _pick(self, user: Optional[str]) -> int:
+        """Least-loaded replica, unless the user's previous replica is nearly as idle"""
+        alive = [i for i, process in enumerate(self.processes) if process.is_alive()] or list(range(self.num_replicas))
+        least = min(alive, key=lambda i: self.in_flight[i])
+        pinned = self.affinity.get(user) if user is not None else None
+        if pinned in alive and self.in_flight[pinned] <= self.in_flight[least] + self.affinity_slack:
+            self.routed["affinity"] += 1
+            REPLICA_ROUTED.inc(reason="affinity")
+            return pinned
+
+        self.routed["least_loaded"] += 1
+        REPLICA_ROUTED.inc(reason="least_loaded")
+        if user is not None:
+            self.affinity[user] = least
+        return least
+
+    def _cancel(self, request_id: int):
+        """Stop a request nobody waits for anymore, so its replica doesn't decode it to the end"""
+        entry = self._pending.pop(request_id, None)
+        if entry is None:
+            return  # Already finished
+        replica, _ = entry
+        self.in_flight[replica] -= 1
+        REPLICA_IN_FLIGHT.set(self.in_flight[replica], replica=str(replica))
+        self._requests[replica].put(("cancel", request_id))
+
+    def _submit(self, target, user: Optional[str], kwargs: Dict, stream: bool, replica: Optional[int] = None) -> int:
+        if replica is None:
+            replica = self._pick(user)
+        request_id = next(self._ids)
+        self._pending[request_id] = (replica, target)
+        self.in_flight[replica] += 1
+        REPLICA_IN_FLIGHT.set(self.in_flight[replica], replica=str(replica))
+        self._requests[replica].put(("generate", request_id, kwargs, stream))
+        return request_id
+
+    async def generate_response(self, system_message: str, messages: list, max_tokens: int = 256, user: str = None,
+                                system_prefix: str = None, system_prefix_key: str = None, deadline: float = None,
+                                details: dict = None, replica: Optional[int] = None) -> str:
+        """LlamaLocalLLM.generate_response on one replica: the given one (e.g. to warm it up), or one chosen by _pick"""
+        future = self._loop.create_future()
+        # time.monotonic() deadlines mean the same in every process on the machine
+        request_id = self._submit(future, user, dict(system_message=system_message, messages=messages, max_tokens=max_tokens,
+                                        user=user, system_prefix=system_prefix, system_prefix_key=system_prefix_key,
+                                        deadline=deadline),
+                     stream=False, replica=replica)
+        try:
+            text, replica_details = await future
+        except asyncio.CancelledError:
+            self._cancel(request_id)
+            raise
+        if details is not None:
+            details.update(replica_details)
+        return text
+
+    async def stream_response(self, system_message: str, messages: list, max_tokens: int = 256, user: str = None,
+                              system_prefix: str = None, system_prefix_key: str = None, deadline: float = None,
+                              details: dict = None):
+        tokens = asyncio.Queue()
+        request_id = self._submit(tokens, user, dict(system_message=system_message, messages=messages, max_tokens=max_tokens,
+                                        user=user, system_prefix=system_prefix, system_prefix_key=system_prefix_key,
+                                        deadline=deadline),
+                     stream=True)
+        try:
+            while True:
+                kind, value = await tokens.get()
+                if kind == "token":
+                    yield value
+                elif kind == "expired":
+                    raise DeadlineExceeded(value)
+                elif kind == "error":
+                    raise RuntimeError(value)
+                else:
+                    if details is not None:
+                        details.update(value[1])
+                    return
+        finally:
+            # The consumer stopped early (disconnect or cancellation); a finished request is no longer pending
+            self._cancel(request_id)
+
+    def count_tokens(self, text: str) -> int:
+        with self.tokenizer_lock:
+            return len(self.tokenizer(text, add_special_tokens=False)["input_ids"])
+
+    def clear_user_cache(self, user: str):
+        # The user may have been served by more than one replica
+        for requests in self._requests:
+            requests.put(("clear", user))
+
+    def invalidate_system_prefixes(self):
+        for requests in self._requests:
+            requests.put(("invalidate",))
+
+    def cache_stats(self) -> dict:
+        return {
+            "replicas": [
+                {"pid": self.pids[i], "cores": self.cores[i], "alive": self.processes[i].is_alive(),
+                 "in_flight": self.in_flight[i], "completed": self.completed[i]}
+                for i in range(len(self.processes))
+            ],
+            "routed": dict(self.routed),
+            "users_pinned": len(self.affinity),
+        }
+
+    async def close(self):
+        self._closing = True
+        for requests in self._requests:
+            requests.put(("stop",))
+        await self._loop.run_in_executor(None, self._join)
+
+    def _join(self):
+        for process in self.processes:
+            process.join(timeout=30)
+            if process.is_alive():
+                process.terminate()
+        if self._reader is not None:
+            self._reader.join()
@@ -0,0 +1,472 @@
+import asyncio
+import inspect
+import logging
+import queue
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Any, Hashable, List, Optional
+
+import torch
+
+import kv_cache
+from admission import DeadlineExceeded
+from metrics import REGISTRY
+
+QUEUE_WAIT = REGISTRY.histogram("llm_queue_wait_seconds", "Time a request waited in the scheduler queue before prefill")
+LOCK_WAIT = REGISTRY.histogram("llm_model_lock_wait_seconds", "Time spent waiting to acquire model_lock", ["path"])
+PREFILL_SECONDS = REGISTRY.histogram("llm_prefill_seconds", "Time to prefill newly admitted requests", ["path"])
+DECODE_STEP_SECONDS = REGISTRY.histogram("llm_decode_step_seconds", "Time for one decode step of the running batch")
+GENERATION_SECONDS = REGISTRY.histogram("llm_generation_seconds", "Time from admission to the last token of a request",
+                                        ["path"])
+PROMPT_TOKENS = REGISTRY.counter("llm_prompt_tokens_total", "Prompt tokens, prefilled or reused from a KV cache",
+                                 ["source"])
+GENERATED_TOKENS = REGISTRY.counter("llm_generated_tokens_total", "Generated tokens", ["path"])
+TOKENS_PER_SECOND = REGISTRY.gauge("llm_decode_tokens_per_second", "Tokens produced by the most recent decode step")
+QUEUE_DEPTH = REGISTRY.gauge("llm_queue_depth", "Requests waiting for a batch slot")
+BATCH_SIZE = REGISTRY.gauge("llm_batch_size", "Sequences in the running batch")
+
+
+@dataclass
+class GenerationRequest:
+    """One prompt waiting for, or being decoded by, the batch scheduler"""
+    input_ids: List[int]
+    max_new_tokens: int
+    loop: Optional[asyncio.AbstractEventLoop] = None
+    future: Optional[asyncio.Future] = None
+    streamer: Optional[Any] = None  # Receives put(token_id) for every generated token and end() when finished
+    cache_owner: Optional[Hashable] = None
+    shared_prefix_key: Optional[Hashable] = None
+    shared_prefix_ids: Optional[List[int]] = None
+    generated: List[int] = field(default_factory=list)
+    cached_tokens: int = 0
+    finish_reason: Optional[str] = None
+    submitted_at: float = field(default_factory=time.perf_counter)
+    admitted_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    speculation: Optional[dict] = None  # Per-request statistics when decoded speculatively
+    deadline: Optional[float] = None  # time.monotonic() after which the request is dropped if not yet admitted
+    stop: Optional[Any] = None  # StopTracker; ends decoding at a stop string or a repetition loop
+
+
+def sampling_probs(logits: torch.Tensor, temperature: float, top_k: int, top_p: float) -> torch.Tensor:
+    """Next-token distribution per row after temperature/top-k/top-p (one-hot on the argmax when temperature <= 0)"""
+    if temperature <= 0:
+        return torch.zeros_like(logits, dtype=torch.float).scatter_(-1, logits.argmax(dim=-1, keepdim=True), 1.0)
+
+    logits = logits.float() / temperature
+
+    if top_k and top_k > 0:
+        kth_best = torch.topk(logits, min(top_k, logits.shape[-1]), dim=-1).values[..., -1, None]
+        logits = logits.masked_fill(logits < kth_best, float("-inf"))
+
+    if top_p < 1.0:
+        sorted_logits, sorted_indices = torch.sort(logits, descending=True, dim=-1)
+        sorted_probs = torch.softmax(sorted_logits, dim=-1)
+        # Remove tokens once the cumulative probability before them already exceeds top_p
+        remove = (sorted_probs.cumsum(dim=-1) - sorted_probs) > top_p
+        sorted_logits = sorted_logits.masked_fill(remove, float("-inf"))
+        logits = torch.full_like(logits, float("-inf")).scatter(-1, sorted_indices, sorted_logits)
+
+    return torch.softmax(logits, dim=-1)
+
+
+def sample_next_tokens(logits: torch.Tensor, temperature: float, top_k: int, top_p: float) -> torch.Tensor:
+    """Sample one token per row with the same temperature/top-k/top-p rules as model.generate"""
+    if temperature <= 0:
+        return logits.argmax(dim=-1)
+    probs = sampling_probs(logits, temperature, top_k, top_p)
+    return torch.multinomial(probs, num_samples=1).squeeze(1)
+
+
+class ContinuousBatchScheduler:
+    """
+    Decodes many requests together in one batch on a dedicated worker thread.
+
+    Requests are queued with submit(). Between decode steps the worker admits
+    queued requests (prefilled together as one left-padded batch and merged
+    into the running batch) and retires finished sequences, so a new request
+    never has to wait for the whole running batch to finish.
+
+    With a prefix_cache, a request that names a cache_owner only prefills the
+    part of its prompt that is not already cached for that owner, and the KV
+    states of its finished prompt + response are cached for the next turn.
+    With a shared_prefix_cache, requests that carry the token ids of a common
+    prefix (e.g. their role's system prompt) start from pinned KV states for
+    it, and requests sharing one prefix are prefilled together.
+    """
+
+    def __init__(self, model, eos_token_ids, pad_token_id: int, device: str, model_lock: threading.Lock,
+                 max_batch_size: int = 8, temperature: float = 0.3, top_k: int = 50, top_p: float = 0.95,
+                 prefix_cache: Optional[kv_cache.PrefixKVCache] = None,
+                 shared_prefix_cache: Optional[kv_cache.SharedPrefixCache] = None):
+        self.model = model
+        self.eos_token_ids = set(eos_token_ids)
+        self.pad_token_id = pad_token_id
+        self.device = device
+        self.model_lock = model_lock
+        self.max_batch_size = max_batch_size
+        self.temperature = temperature
+        self.top_k = top_k
+        self.top_p = top_p
+        self.prefix_cache = prefix_cache
+        self.shared_prefix_cache = shared_prefix_cache
+
+        self.pending: "queue.Queue[Optional[GenerationRequest]]" = queue.Queue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._running = False
+
+        # Running batch, only touched by the worker thread
+        self._active: List[GenerationRequest] = []
+        self._cache = None
+        self._attention_mask = None
+        self._next_tokens = None
+
+        # Only compute logits for the last position during prefill when the model supports it
+        forward_params = inspect.signature(model.forward).parameters
+        self._prefill_kwargs = {}
+        if "logits_to_keep" in forward_params:
+            self._prefill_kwargs["logits_to_keep"] = 1
+        elif "num_logits_to_keep" in forward_params:
+            self._prefill_kwargs["num_logits_to_keep"] = 1
+
+        self.logger = logging.getLogger(__name__)
+
+    def submit(self, input_ids: List[int], max_new_tokens: int, cache_owner: Optional[Hashable] = None,
+               shared_prefix_key: Optional[Hashable] = None, shared_prefix_ids: Optional[List[int]] = None,
+               streamer=None, deadline: Optional[float] = None, stop=None) -> asyncio.Future:
+        """
+        Queue a prompt; the returned future resolves to the finished GenerationRequest
+        Args:
+            input_ids: Prompt token ids
+            max_new_tokens: Maximum tokens to generate
+            cache_owner: Key for reusing this owner's KV cache from earlier turns
+            shared_prefix_key: Key of a prefix shared with other requests (e.g. the user's role)
+            shared_prefix_ids: Leading token ids of input_ids that make up that shared prefix
+            streamer: Object with put(token_id)/end(), called from the worker thread as tokens are generated
+            deadline: time.monotonic() value; if the request is still queued then, it fails with DeadlineExceeded
+            stop: StopTracker fed every generated token; the request finishes when it reports a stop
+        """
+        loop = asyncio.get_running_loop()
+        request = GenerationRequest(
+            input_ids=list(input_ids),
+            max_new_tokens=max_new_tokens,
+            loop=loop,
+            future=loop.create_future(),
+            cache_owner=cache_owner,
+            shared_prefix_key=shared_prefix_key,
+            shared_prefix_ids=list(shared_prefix_ids) if shared_prefix_ids else None,
+            streamer=streamer,
+            deadline=deadline,
+            stop=stop,
+        )
+        self.start()
+        self.pending.put(request)
+        return request.future
+
+    def start(self):
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._running = True
+                self._thread = threading.Thread(target=self._run, name="batch-scheduler", daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        self._running = False
+        self.pending.put(None)  # Wake the worker if it is waiting for work
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    @property
+    def active_count(self) -> int:
+        return len(self._active)
+
+    def _run(self):
+        while self._running:
+            new_requests = self._collect()
+            if not new_requests and not self._active:
+                continue
+
+            try:
+                wait_start = time.perf_counter()
+                with self.model_lock, torch.no_grad():
+                    LOCK_WAIT.observe(time.perf_counter() - wait_start, path="scheduler")
+                    if new_requests:
+                        with PREFILL_SECONDS.time(path="scheduler"):
+                            self._admit(new_requests)
+                    if self._active:
+                        self._decode_step()
+                    BATCH_SIZE.set(len(self._active))
+            except Exception as e:
+                self.logger.exception("Batch step failed")
+                for request in self._active + new_requests:
+                    if request.finished_at is None:
+                        request.finish_reason = "error"
+                        self._resolve(request, error=e)
+                self._reset()
+
+    def _collect(self) -> List[GenerationRequest]:
+        """Take as many queued requests as the batch has room for (block only when idle)"""
+        requests = []
+        capacity = self.max_batch_size - len(self._active)
+        while len(requests) < capacity:
+            try:
+                if self._active or requests:
+                    request = self.pending.get_nowait()
+                else:
+                    request = self.pending.get()
+            except queue.Empty:
+                break
+            if request is None:  # Stop sentinel
+                break
+            if request.future.cancelled():
+                continue
+            if request.deadline is not None and time.monotonic() > request.deadline:
+                # Nobody is waiting for this answer anymore; don't spend a prefill on it
+                request.finish_reason = "expired"
+                self._resolve(request, error=DeadlineExceeded("Deadline passed while queued for the model"))
+                continue
+            requests.append(request)
+        QUEUE_DEPTH.set(self.pending.qsize())
+        return requests
+
+    def _admit(self, requests: List[GenerationRequest]):
+        """Prefill new requests and merge them into the running batch"""
+        fresh = []
+        shared_groups = {}
+        resumed = []
+        for request in requests:
+            request.admitted_at = time.perf_counter()
+            QUEUE_WAIT.observe(request.admitted_at - request.submitted_at)
+
+            prefix = None
+            if self.prefix_cache is not None and request.cache_owner is not None:
+                request.cached_tokens, prefix = self.prefix_cache.lookup(request.cache_owner, request.input_ids)
+
+            shared_ids = request.shared_prefix_ids
+            if (self.shared_prefix_cache is not None and request.shared_prefix_key is not None and shared_ids
+                    and request.cached_tokens < len(shared_ids) < len(request.input_ids)):
+                # The owner's own cache (if any) covers less than the shared prefix does
+                request.cached_tokens = len(shared_ids)
+                group = (request.shared_prefix_key, kv_cache.hash_tokens(shared_ids))
+                shared_groups.setdefault(group, []).append(request)
+                prefix = None
+            elif prefix is not None:
+                resumed.append((request, prefix))
+            else:
+                fresh.append(request)
+            if self.prefix_cache is not None and request.cache_owner is not None:
+                # Only a prompt that resumes from the owner's own KV states is a hit for that cache
+                self.prefix_cache.record(request.cached_tokens if prefix is not None else 0, len(request.input_ids))
+            PROMPT_TOKENS.inc(request.cached_tokens, source="cached")
+            PROMPT_TOKENS.inc(len(request.input_ids) - request.cached_tokens, source="prefilled")
+
+        if fresh:
+            self._merge(fresh, *self._prefill(fresh))
+        for group in shared_groups.values():
+            prefix = self._shared_prefix(group[0].shared_prefix_key, group[0].shared_prefix_ids)
+            self._merge(group, *self._prefill_from_prefix(group, prefix))
+        for request, prefix in resumed:
+            self._merge([request], *self._prefill_from_prefix([request], prefix))
+
+        self._retire_finished()
+
+    def _shared_prefix(self, key: Hashable, token_ids: List[int]) -> tuple:
+        """Pinned KV states for a shared prefix, computed on first use"""
+        prefix = self.shared_prefix_cache.get(key, token_ids)
+        if prefix is None:
+            outputs = self.model(
+                input_ids=torch.tensor([token_ids], dtype=torch.long, device=self.device),
+                use_cache=True,
+                **self._prefill_kwargs,
+            )
+            prefix = kv_cache.to_legacy(outputs.past_key_values)
+            self.shared_prefix_cache.put(key, token_ids, prefix)
+        return prefix
+
+    def _prefill(self, requests: List[GenerationRequest]):
+        """Prefill full prompts together as one left-padded batch"""
+        width = max(len(r.input_ids) for r in requests)
+        input_ids = torch.full((len(requests), width), self.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(requests), width), dtype=torch.long)
+        for row, request in enumerate(requests):
+            start = width - len(request.input_ids)
+            input_ids[row, start:] = torch.tensor(request.input_ids, dtype=torch.long)
+            attention_mask[row, start:] = 1
+
+        input_ids = input_ids.to(self.device)
+        attention_mask = attention_mask.to(self.device)
+        position_ids = (attention_mask.cumsum(dim=-1) - 1).clamp(min=0)
+
+        outputs = self.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            use_cache=True,
+            **self._prefill_kwargs,
+        )
+        return kv_cache.to_legacy(outputs.past_key_values), attention_mask, self._sample(outputs.logits[:, -1, :])
+
+    def _prefill_from_prefix(self, requests: List[GenerationRequest], prefix: tuple):
+        """
+        Prefill only the uncached suffixes of prompts that all start with the same cached prefix.
+        Suffixes are right-aligned, so padding sits between the prefix and each suffix.
+        """
+        cached = requests[0].cached_tokens
+        width = max(len(r.input_ids) - cached for r in requests)
+        input_ids = torch.full((len(requests), width), self.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(requests), cached + width), dtype=torch.long)
+        attention_mask[:, :cached] = 1
+        for row, request in enumerate(requests):
+            suffix = request.input_ids[cached:]
+            start = width - len(suffix)
+            input_ids[row, start:] = torch.tensor(suffix, dtype=torch.long)
+            attention_mask[row, cached + start:] = 1
+
+        input_ids = input_ids.to(self.device)
+        attention_mask = attention_mask.to(self.device)
+        position_ids = (attention_mask.cumsum(dim=-1) - 1).clamp(min=0)[:, cached:]
+        batch_prefix = tuple((k.expand(len(requests), -1, -1, -1), v.expand(len(requests), -1, -1, -1))
+                             for k, v in prefix)
+
+        outputs = self.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=kv_cache.from_legacy(batch_prefix),
+            use_cache=True,
+            **self._prefill_kwargs,
+        )
+        return kv_cache.to_legacy(outputs.past_key_values), attention_mask, self._sample(outputs.logits[:, -1, :])
+
+    def _merge(self, requests: List[GenerationRequest], legacy, attention_mask: torch.Tensor, next_tokens: torch.Tensor):
+        """Append freshly prefilled rows to the running batch"""
+        legacy, self._attention_mask = kv_cache.concat_batches(
+            kv_cache.to_legacy(self._cache), self._attention_mask, legacy, attention_mask,
+        )
+        self._cache = kv_cache.from_legacy(legacy)
+        self._next_tokens = next_tokens if self._next_tokens is None else torch.cat([self._next_tokens, next_tokens])
+        self._active.extend(requests)
+        self._record_tokens(requests, next_tokens)
+
+    def _decode_step(self):
+        """Feed the last sampled token of every active sequence through the model once"""
+        start = time.perf_counter()
+        batch_size = len(self._active)
+        attention_mask = torch.cat([self._attention_mask, self._attention_mask.new_ones((batch_size, 1))], dim=1)
+        # Position of the new token is the number of real (non-padding) tokens before it
+        position_ids = self._attention_mask.sum(dim=1, keepdim=True)
+
+        outputs = self.model(
+            input_ids=self._next_tokens[:, None],
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=self._cache,
+            use_cache=True,
+        )
+        self._cache = outputs.past_key_values
+        self._attention_mask = attention_mask
+        self._next_tokens = self._sample(outputs.logits[:, -1, :])
+
+        self._record_tokens(self._active, self._next_tokens)  # Reads tokens back, so the step has finished
+        elapsed = time.perf_counter() - start
+        DECODE_STEP_SECONDS.observe(elapsed)
+        TOKENS_PER_SECOND.set(batch_size / elapsed if elapsed > 0 else 0.0)
+        self._retire_finished()
+
+    def _sample(self, logits: torch.Tensor) -> torch.Tensor:
+        return sample_next_tokens(logits, self.temperature, self.top_k, self.top_p)
+
+    def _record_tokens(self, requests: List[GenerationRequest], tokens: torch.Tensor):
+        generated = 0
+        for request, token in zip(requests, tokens.tolist()):
+            if token in self.eos_token_ids:
+                request.finish_reason = "eos"
+                continue
+            request.generated.append(token)
+            generated += 1
+            if request.streamer is not None:
+                request.streamer.put(token)
+            if request.stop is not None and request.stop.add(token) is not None:
+                request.finish_reason = request.stop.reason
+            elif len(request.generated) >= request.max_new_tokens:
+                request.finish_reason = "length"
+        GENERATED_TOKENS.inc(generated, path="scheduler")
+
+    def _retire_finished(self):
+        """Resolve finished (or abandoned) requests and drop their rows from the batch"""
+        keep = []
+        finished = []
+        for row, request in enumerate(self._active):
+            if request.finish_reason is None and request.future.cancelled():
+                request.finish_reason = "cancelled"
+            if request.finish_reason is None:
+                keep.append(row)
+            else:
+                finished.append(row)
+
+        if not finished:
+            return
+
+        legacy = kv_cache.to_legacy(self._cache)
+        for row in finished:
+            request = self._active[row]
+            if request.finish_reason in ("eos", "length", "stop", "loop"):
+                self._store_prefix(row, request, legacy)
+            self._resolve(request)
+
+        if not keep:
+            self._reset()
+            return
+
+        index = torch.tensor(keep, device=self._next_tokens.device)
+        legacy = kv_cache.select_rows(legacy, index)
+        attention_mask = self._attention_mask.index_select(0, index)
+
+        # Columns that are padding for every remaining row no longer need to be attended over
+        leading = int((attention_mask.sum(dim=0) == 0).long().cumprod(dim=0).sum())
+        self._cache = kv_cache.from_legacy(kv_cache.drop_leading(legacy, leading))
+        self._attention_mask = attention_mask[:, leading:]
+        self._next_tokens = self._next_tokens.index_select(0, index)
+        self._active = [self._active[row] for row in keep]
+
+    def _store_prefix(self, row: int, request: GenerationRequest, legacy):
+        """Cache the KV states of a finished prompt + response for the owner's next turn"""
+        if self.prefix_cache is None or request.cache_owner is None:
+            return
+        # Everything fed through the model so far; the last sampled token never was.
+        # Padding can sit anywhere in the row (e.g. after a shared prefix), so select by mask.
+        positions = self._attention_mask[row].bool()
+        fed = int(positions.sum())
+        token_ids = (request.input_ids + request.generated)[:fed]
+        row_cache = tuple((k[row:row + 1, :, positions].clone(), v[row:row + 1, :, positions].clone()) for k, v in legacy)
+        self.prefix_cache.store(request.cache_owner, token_ids, row_cache)
+
+    def _reset(self):
+        self._active = []
+        self._cache = None
+        self._attention_mask = None
+        self._next_tokens = None
+
+    def _resolve(self, request: GenerationRequest, error: Optional[Exception] = None):
+        request.finished_at = time.perf_counter()
+        if request.admitted_at is not None:
+            GENERATION_SECONDS.observe(request.finished_at - request.admitted_at, path="scheduler")
+        if request.streamer is not None:
+            request.streamer.end()
+
+        def set_result():
+            if request.future.done():
+                return
+            if error is not None:
+                request.future.set_exception(error)
+            else:
+                request.future.set_result(request)
+
+        try:
+            request.loop.call_soon_threadsafe(set_result)
+        except RuntimeError:
+            # The caller's event loop is already closed; nobody is waiting anymore
+            pass
@@ -0,0 +1,97 @@
+"""
+Memory-mapped model weights shared between processes.
+
+The parent exports the model once to a .safetensors file. Each replica
+process maps that file read-only and builds its model with the mapped
+tensors as parameters (no copy), so every replica reads the same pages from
+the OS page cache and resident memory does not grow with the replica count.
+"""
+import json
+import mmap
+import os
+import struct
+from typing import Dict
+
+import torch
+from transformers import AutoConfig, AutoModelForCausalLM
+
+# safetensors dtype names -> torch dtypes
+_DTYPES = {
+    "F64": torch.float64, "F32": torch.float32, "F16": torch.float16, "BF16": torch.bfloat16,
+    "I64": torch.int64, "I32": torch.int32, "I16": torch.int16, "I8": torch.int8, "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+
+
+def export_safetensors(model, path: str):
+    """Write the model's weights once (tied weights are stored once); atomic so replicas never see half a file"""
+    from safetensors.torch import save_model
+
+    tmp_path = path + ".tmp"
+    save_model(model, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def mmap_safetensors(path: str) -> Dict[str, torch.Tensor]:
+    """
+    Tensors that view a memory-mapped .safetensors file without copying it
+    Args:
+        path: File written by export_safetensors (or any safetensors file)
+    Returns:
+        Parameter name -> tensor backed by the shared mapping
+    """
+    with open(path, "rb") as f:
+        header_size = struct.unpack("<Q", f.read(8))[0]
+        header = json.loads(f.read(header_size))
+        # Copy-on-write mapping: pages stay shared between processes as long as nobody writes to them
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+    data_start = 8 + header_size
+    tensors = {}
+    for name, info in header.items():
+        if name == "__metadata__":
+            continue
+        dtype = _DTYPES[info["dtype"]]
+        start, end = info["data_offsets"]
+        if end == start:
+            tensors[name] = torch.empty(info["shape"], dtype=dtype)
+            continue
+        flat = torch.frombuffer(mapped, dtype=dtype, count=(end - start) // dtype.itemsize, offset=data_start + start)
+        tensors[name] = flat.view(info["shape"])
+    return tensors
+
+
+def load_mmap_model(model_name: str, weights_file: str):
+    """
+    Build model_name's architecture without allocating weights, then adopt the mapped tensors as parameters
+    Args:
+        model_name: HuggingFace model name or local path (for the config)
+        weights_file: File written by export_safetensors
+    """
+    from accelerate import init_empty_weights
+
+    config = AutoConfig.from_pretrained(model_name)
+    state_dict = mmap_safetensors(weights_file)
+
+    # Parameters start on the meta device; buffers (e.g. rotary frequencies) are still computed normally
+    with init_empty_weights(include_buffers=False):
+        model = AutoModelForCausalLM.from_config(config)
+    model.tie_weights()
+
+    # Tied weights (e.g. lm_head and embed_tokens) are stored under only one of their names
+    aliases = {}
+    for name, param in model.named_parameters(remove_duplicate=False):
+        aliases.setdefault(id(param), []).append(name)
+    for names in aliases.values():
+        stored = next((name for name in names if name in state_dict), None)
+        if stored is not None:
+            for name in names:
+                state_dict.setdefault(name, state_dict[stored])
+
+    model.load_state_dict(state_dict, assign=True, strict=False)
+    model.tie_weights()
+
+    missing = [name for name, param in model.named_parameters() if param.is_meta]
+    if missing:
+        raise RuntimeError(f"{weights_file} is missing weights: {', '.join(missing[:5])}")
+    return model.eval()
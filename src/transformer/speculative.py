@@ -0,0 +1,255 @@
+"""
+Speculative decoding for single-sequence generation.
+
+CPU decoding is bound by memory bandwidth: every generated token reads all
+of the model's weights once. Here cheap guesses for the next few tokens are
+checked by the main model in a single forward pass, and every guess it
+agrees with is a token produced without an extra pass over the weights.
+
+Guesses come from either:
+- a small draft model sharing the main model's tokenizer ("draft"), or
+- prompt lookup ("prompt_lookup"): the tokens that followed the most recent
+  earlier occurrence of the last n-gram in the prompt or the response. No
+  second model is needed; it does well when answers quote the conversation.
+
+Guesses are accepted with the speculative sampling rule (accept with
+probability min(1, p/q), otherwise resample from the leftover mass), so the
+output follows the same distribution as sampling from the main model alone.
+"""
+import threading
+import time
+from typing import List, Optional, Tuple
+
+import torch
+
+import kv_cache
+from metrics import REGISTRY
+from scheduler import sampling_probs
+
+SPECULATION_MODES = ("draft", "prompt_lookup")
+
+DRAFTED_TOKENS = REGISTRY.counter("llm_speculative_drafted_tokens_total", "Tokens proposed for verification", ["mode"])
+ACCEPTED_TOKENS = REGISTRY.counter("llm_speculative_accepted_tokens_total", "Proposed tokens the main model accepted",
+                                   ["mode"])
+ACCEPTANCE_RATE = REGISTRY.histogram("llm_speculative_acceptance_rate", "Share of proposed tokens accepted per request",
+                                     ["mode"], buckets=(0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0))
+TOKENS_PER_PASS = REGISTRY.histogram("llm_speculative_tokens_per_pass",
+                                     "Tokens generated per main-model forward pass per request",
+                                     ["mode"], buckets=(1.0, 1.25, 1.5, 2.0, 2.5, 3.0, 4.0, 6.0, 8.0))
+
+
+def prompt_lookup(token_ids: List[int], ngram_size: int, max_tokens: int) -> List[int]:
+    """
+    Tokens that followed the most recent earlier occurrence of the trailing n-gram (longest n first)
+    Args:
+        token_ids: Prompt and response so far
+        ngram_size: Longest n-gram to match; shorter ones are tried down to 1
+        max_tokens: Proposal length
+    """
+    for n in range(min(ngram_size, len(token_ids) - 1), 0, -1):
+        tail = token_ids[-n:]
+        for start in range(len(token_ids) - n - 1, -1, -1):
+            if token_ids[start:start + n] == tail:
+                return token_ids[start + n:start + n + max_tokens]
+    return []
+
+
+class SpeculativeDecoder:
+    """
+    Generates one sequence at a time with speculation; callers hold the model lock.
+
+    Per request it reports how many tokens were proposed and accepted and how
+    many main-model forward passes were needed; tokens per pass is the
+    speedup over plain decoding when a verify pass costs about one decode step.
+    """
+
+    def __init__(self, model, eos_token_ids, device: str, mode: str = "prompt_lookup", draft_model=None,
+                 lookahead: int = 4, ngram_size: int = 3, temperature: float = 0.3, top_k: int = 50,
+                 top_p: float = 0.95):
+        """
+        Args:
+            model: Main model
+            eos_token_ids: Token ids that end a sequence
+            device: Device of both models
+            mode: "draft" or "prompt_lookup"
+            draft_model: Small model with the main model's tokenizer (mode "draft")
+            lookahead: Tokens proposed per verification pass
+            ngram_size: Longest n-gram matched by prompt lookup
+            temperature, top_k, top_p: Sampling settings, as for the batch scheduler
+        """
+        if mode not in SPECULATION_MODES:
+            raise ValueError(f"Unknown speculation mode {mode!r}, expected one of {', '.join(SPECULATION_MODES)}")
+        if mode == "draft" and draft_model is None:
+            raise ValueError("Draft speculation needs a draft model")
+        self.model = model
+        self.draft_model = draft_model
+        self.eos_token_ids = set(eos_token_ids)
+        self.device = device
+        self.mode = mode
+        self.lookahead = lookahead
+        self.ngram_size = ngram_size
+        self.temperature = temperature
+        self.top_k = top_k
+        self.top_p = top_p
+
+        self._lock = threading.Lock()
+        self._totals = {"requests": 0, "generated": 0, "drafted": 0, "accepted": 0, "target_passes": 0}
+
+    def _probs(self, logits: torch.Tensor) -> torch.Tensor:
+        return sampling_probs(logits, self.temperature, self.top_k, self.top_p)
+
+    def _forward(self, model, token_ids: List[int], cache):
+        outputs = model(input_ids=torch.tensor([token_ids], dtype=torch.long, device=self.device),
+                        past_key_values=cache, use_cache=True)
+        return outputs.logits[0], outputs.past_key_values
+
+    def generate(self, input_ids: List[int], max_new_tokens: int, streamer=None,
+                 stop=None) -> Tuple[List[int], str, dict]:
+        """
+        Args:
+            input_ids: Prompt token ids
+            max_new_tokens: Maximum tokens to generate
+            streamer: Object with put(token_id)/end(), called as tokens are accepted
+            stop: StopTracker fed every accepted token; generation ends when it reports a stop
+        Returns:
+            (generated token ids, finish reason "eos", "length", "stop" or "loop", per-request statistics)
+        """
+        start = time.perf_counter()
+        stats = {"mode": self.mode, "drafted": 0, "accepted": 0, "target_passes": 1}
+        generated: List[int] = []
+        finish_reason = "length"
+
+        try:
+            logits, cache = self._forward(self.model, input_ids, None)
+            pending = int(torch.multinomial(self._probs(logits[-1:]), 1))
+            tokens = list(input_ids)  # Fed to the main model; `pending` is sampled but not yet fed
+            draft_cache, draft_fed = None, 0
+
+            while True:
+                if pending in self.eos_token_ids:
+                    finish_reason = "eos"
+                    break
+                generated.append(pending)
+                if streamer is not None:
+                    streamer.put(pending)
+                if stop is not None and stop.add(pending) is not None:
+                    finish_reason = stop.reason
+                    break
+                if len(generated) >= max_new_tokens:
+                    break
+
+                budget = min(self.lookahead, max_new_tokens - len(generated))
+                if self.mode == "draft":
+                    # The draft cache may hold rejected guesses from the last round
+                    draft_fed = min(draft_fed, len(tokens))
+                    draft_cache = kv_cache.from_legacy(kv_cache.crop(kv_cache.to_legacy(draft_cache), draft_fed)) \
+                        if draft_cache is not None else None
+                    proposal, draft_probs, draft_cache = self._draft(tokens[draft_fed:] + [pending], draft_cache,
+                                                                     budget)
+                    draft_fed = len(tokens) + len(proposal)  # The last guess is sampled, never fed
+                else:
+                    proposal = prompt_lookup(tokens + [pending], self.ngram_size, budget)
+                    draft_probs = None
+
+                # One main-model pass scores the pending token and every guess
+                logits, cache = self._forward(self.model, [pending] + proposal, cache)
+                stats["target_passes"] += 1
+                stats["drafted"] += len(proposal)
+                target_probs = self._probs(logits)
+                tokens.append(pending)
+
+                accepted, pending = self._verify(proposal, target_probs, draft_probs)
+                stats["accepted"] += len(accepted)
+                if len(accepted) < len(proposal):
+                    cache = kv_cache.from_legacy(kv_cache.crop(kv_cache.to_legacy(cache), len(tokens) + len(accepted)))
+
+                for token in accepted:
+                    if token in self.eos_token_ids:
+                        finish_reason = "eos"
+                        break
+                    generated.append(token)
+                    if streamer is not None:
+                        streamer.put(token)
+                    if stop is not None and stop.add(token) is not None:
+                        finish_reason = stop.reason
+                        break
+                    if len(generated) >= max_new_tokens:
+                        break
+                else:
+                    tokens.extend(accepted)
+                    continue
+                break
+        finally:
+            if streamer is not None:
+                streamer.end()
+
+        elapsed = time.perf_counter() - start
+        stats.update({
+            "generated": len(generated),
+            "acceptance_rate": stats["accepted"] / stats["drafted"] if stats["drafted"] else 0.0,
+            "tokens_per_pass": len(generated) / stats["target_passes"],
+            "tokens_per_second": len(generated) / elapsed if elapsed > 0 else 0.0,
+        })
+        self._record(stats)
+        return generated, finish_reason, stats
+
+    def _draft(self, new_tokens: List[int], cache, count: int):
+        """Sample `count` guesses from the draft model, keeping its distribution for each"""
+        proposal, probs = [], []
+        logits, cache = self._forward(self.draft_model, new_tokens, cache)
+        for i in range(count):
+            q = self._probs(logits[-1:])[0]
+            token = int(torch.multinomial(q, 1))
+            proposal.append(token)
+            probs.append(q)
+            if token in self.eos_token_ids or i == count - 1:
+                break
+            logits, cache = self._forward(self.draft_model, [token], cache)
+        return proposal, probs, cache
+
+    def _verify(self, proposal: List[int], target_probs: torch.Tensor, draft_probs: Optional[List[torch.Tensor]]):
+        """
+        Accept guesses left to right; returns (accepted guesses, next token sampled from the main model)
+        Prompt-lookup guesses are deterministic (q is one-hot on the guess).
+        """
+        vocab = target_probs.shape[-1]
+        accepted = []
+        for i, token in enumerate(proposal):
+            p = target_probs[i]
+            if draft_probs is None:
+                q = torch.zeros_like(p)
+                q[token] = 1.0
+            else:
+                q = draft_probs[i][:vocab]
+                if q.shape[0] < vocab:
+                    q = torch.nn.functional.pad(q, (0, vocab - q.shape[0]))
+            if token < vocab and torch.rand(()) * q[token] <= p[token] and p[token] > 0:
+                accepted.append(token)
+                continue
+            # Rejected: sample from where the main model puts more mass than the draft did
+            residual = (p - q).clamp(min=0)
+            if residual.sum() <= 0:
+                residual = p
+            return accepted, int(torch.multinomial(residual / residual.sum(), 1))
+        # Every guess accepted: the same pass already gives the distribution after the last one
+        return accepted, int(torch.multinomial(target_probs[len(proposal)], 1))
+
+    def _record(self, stats: dict):
+        DRAFTED_TOKENS.inc(stats["drafted"], mode=self.mode)
+        ACCEPTED_TOKENS.inc(stats["accepted"], mode=self.mode)
+        if stats["drafted"]:
+            ACCEPTANCE_RATE.observe(stats["acceptance_rate"], mode=self.mode)
+        TOKENS_PER_PASS.observe(stats["tokens_per_pass"], mode=self.mode)
+        with self._lock:
+            self._totals["requests"] += 1
+            for key in ("generated", "drafted", "accepted", "target_passes"):
+                self._totals[key] += stats[key]
+
+    def stats(self) -> dict:
+        with self._lock:
+            totals = dict(self._totals)
+        totals["mode"] = self.mode
+        totals["lookahead"] = self.lookahead
+        totals["acceptance_rate"] = totals["accepted"] / totals["drafted"] if totals["drafted"] else 0.0
+        totals["tokens_per_pass"] = totals["generated"] / totals["target_passes"] if totals["target_passes"] else 0.0
+        return totals
@@ -0,0 +1,146 @@
+"""
+Early stopping for local generation: stop strings and repetition loops.
+
+Prompted with "User:/Assistant:" text, a base model rarely emits EOS after
+its answer. It goes on to write the next "User:" turn itself, and every one
+of those tokens costs a decode step until max_new_tokens. A StopTracker is
+fed each generated token and ends the request as soon as the text contains
+a stop string (reason "stop") or the newest tokens repeat one n-gram back to
+back (reason "loop"). The stop string and whatever followed it are cut from
+the response; a loop is kept as generated up to the point it was noticed.
+
+Both checks take a few comparisons per token (at most loop_max_ngram for
+loops), and each token id is decoded once and its text cached, so they
+also run inside the batch scheduler's decode loop.
+"""
+import threading
+from typing import Callable, Dict, Optional, Sequence, Tuple
+
+import torch
+from transformers import StoppingCriteria
+
+from metrics import REGISTRY
+
+# Role names of the prompt format: the model has started writing the next turn itself
+DEFAULT_STOP_STRINGS = ("\nUser:", "\nAssistant:", "\nSystem:")
+
+EARLY_STOPS = REGISTRY.counter("llm_early_stops_total", "Requests ended before max_new_tokens without EOS",
+                               ["reason"])
+TOKENS_SAVED = REGISTRY.counter("llm_early_stop_tokens_saved_total",
+                                "Decode steps left unused by requests that stopped early", ["reason"])
+
+
+def cut_at_stop(text: str, stop_strings: Sequence[str]) -> Tuple[str, bool]:
+    """(text up to the first stop string, whether there was one)"""
+    cut = min((index for index in (text.find(s) for s in stop_strings) if index >= 0), default=-1)
+    return (text, False) if cut < 0 else (text[:cut], True)
+
+
+def held_back(text: str, stop_strings: Sequence[str]) -> int:
+    """Length of the longest end of text that could be the start of a stop string (not yet safe to stream)"""
+    longest = 0
+    for stop in stop_strings:
+        for length in range(min(len(stop) - 1, len(text)), longest, -1):
+            if text.endswith(stop[:length]):
+                longest = length
+                break
+    return longest
+
+
+def record_stop(reason: Optional[str], tokens_saved: int):
+    if reason in ("stop", "loop"):
+        EARLY_STOPS.inc(reason=reason)
+        TOKENS_SAVED.inc(tokens_saved, reason=reason)
+
+
+class StopConditions:
+    """Stop strings and loop limits shared by every request of a model"""
+
+    def __init__(self, token_text: Callable[[int], str], stop_strings: Sequence[str] = DEFAULT_STOP_STRINGS,
+                 loop_max_ngram: int = 32, loop_min_repeats: int = 3, loop_min_tokens: int = 24):
+        """
+        Args:
+            token_text: Decodes a single token id
+            stop_strings: Text that ends generation; it is not part of the response
+            loop_max_ngram: Longest repeated n-gram looked for (0 disables loop detection)
+            loop_min_repeats: Back-to-back copies of an n-gram that make a loop
+            loop_min_tokens: ...and the fewest tokens those copies must cover (so "!!!" or "----" is no loop)
+        """
+        self.token_text = token_text
+        self.stop_strings = tuple(s for s in stop_strings if s)
+        self.loop_max_ngram = loop_max_ngram
+        self.loop_min_repeats = loop_min_repeats
+        self.loop_min_tokens = loop_min_tokens
+        self._texts: Dict[int, str] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.stop_strings) or self.loop_max_ngram > 0
+
+    def text_of(self, token: int) -> str:
+        text = self._texts.get(token)
+        if text is None:
+            text = self.token_text(token)
+            with self._lock:
+                self._texts[token] = text
+        return text
+
+    def tracker(self) -> "StopTracker":
+        return StopTracker(self)
+
+
+class StopTracker:
+    """Stop state of one request; add() every generated token in order"""
+
+    def __init__(self, conditions: StopConditions):
+        self.conditions = conditions
+        self.tokens = []
+        self.reason: Optional[str] = None
+        self._tail = ""  # Enough recent text to find a stop string that spans several tokens
+        self._keep = max((len(s) for s in conditions.stop_strings), default=1) - 1
+        # _runs[n - 1]: trailing tokens equal to the token n positions before them
+        self._runs = [0] * conditions.loop_max_ngram
+
+    def add(self, token: int) -> Optional[str]:
+        """Record a generated token; returns "stop" or "loop" once generation should end"""
+        self.tokens.append(token)
+        conditions = self.conditions
+        if conditions.stop_strings:
+            self._tail += conditions.text_of(token)
+            if any(stop in self._tail for stop in conditions.stop_strings):
+                self.reason = "stop"
+                return self.reason
+            self._tail = self._tail[-self._keep:] if self._keep else ""
+
+        position = len(self.tokens) - 1
+        for n in range(1, min(conditions.loop_max_ngram, position) + 1):
+            if self.tokens[position - n] != token:
+                self._runs[n - 1] = 0
+                continue
+            self._runs[n - 1] += 1
+            covered = self._runs[n - 1] + n
+            if covered >= max(n * conditions.loop_min_repeats, conditions.loop_min_tokens):
+                self.reason = "loop"
+                return self.reason
+        return None
+
+
+class BatchStopCriteria(StoppingCriteria):
+    """model.generate() stopping criterion with one StopTracker per row"""
+
+    def __init__(self, trackers, eos_token_ids):
+        self.trackers = trackers
+        self.eos_token_ids = set(eos_token_ids)
+        self._ended = [False] * len(trackers)  # Rows past their EOS only receive padding
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        for row, token in enumerate(input_ids[:, -1].tolist()):
+            tracker = self.trackers[row]
+            if self._ended[row] or tracker.reason is not None:
+                continue
+            if token in self.eos_token_ids:
+                self._ended[row] = True
+            else:
+                tracker.add(token)
+        return torch.tensor([t.reason is not None for t in self.trackers], dtype=torch.bool, device=input_ids.device)
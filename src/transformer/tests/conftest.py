@@ -0,0 +1,44 @@
+import os
+import sys
+
+import pytest
+
+# The server modules import each other by bare name, as when run from src/transformer, and the
+# shared ones from src/common
+MODULE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, MODULE_DIR)
+sys.path.insert(0, os.path.join(MODULE_DIR, os.pardir, "common"))
+
+PAD_ID, BOS_ID, EOS_ID = 0, 1, 2
+
+
+@pytest.fixture(scope="session")
+def tiny_model():
+    """A randomly initialized two-layer Llama, small enough to run token by token in tests"""
+    import torch
+    from transformers import LlamaConfig, LlamaForCausalLM
+
+    torch.manual_seed(0)
+    config = LlamaConfig(vocab_size=300, hidden_size=64, intermediate_size=128, num_hidden_layers=2,
+                         num_attention_heads=4, num_key_value_heads=2, max_position_embeddings=512,
+                         bos_token_id=BOS_ID, eos_token_id=EOS_ID, pad_token_id=PAD_ID)
+    return LlamaForCausalLM(config).eval()
+
+
+@pytest.fixture(scope="session")
+def tiny_tokenizer():
+    """A byte-level BPE tokenizer that adds a BOS token, like Llama 3's, trained on counseling prompts"""
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers, processors, trainers
+    from transformers import PreTrainedTokenizerFast
+
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(vocab_size=300, special_tokens=["<pad>", "<s>", "</s>"],
+                                  initial_alphabet=pre_tokenizers.ByteLevel.alphabet())
+    text = ["System: You are an expert University counselor AI assistant helping a university Student "
+            "who name is Linda.",
+            "User: What are effective study techniques for finals?\n\nAssistant: Try spaced repetition.\n\n"] * 50
+    tokenizer.train_from_iterator(text, trainer)
+    tokenizer.post_processor = processors.TemplateProcessing(single="<s> $A", special_tokens=[("<s>", BOS_ID)])
+    return PreTrainedTokenizerFast(tokenizer_object=tokenizer, bos_token="<s>", eos_token="</s>", pad_token="<pad>")
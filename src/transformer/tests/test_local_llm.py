@@ -0,0 +1,50 @@
+"""LocalLLMModel with a tiny model in place of Llama"""
+import asyncio
+import copy
+
+from conftest import EOS_ID
+from local_llm import LlamaLocalLLM
+from speculative import SpeculativeDecoder
+
+SYSTEM = "You are an expert University counselor AI assistant helping a university Student who name is Linda."
+MESSAGES = [{"role": "user", "content": "What are effective study techniques for finals?"}]
+
+
+def make_llm(model, tokenizer, **kwargs):
+    llm = LlamaLocalLLM(device="cpu", **kwargs)
+    llm.model = model
+    llm.setup_tokenizer(tokenizer)
+    return llm
+
+
+def test_generation_stops_at_every_eos_id_without_batching(tiny_model, tiny_tokenizer):
+    model = copy.deepcopy(tiny_model)
+    # As with Llama 3 instruct models, the generation config ends on more ids than the tokenizer's EOS token;
+    # here every id does, so generation must stop after the first token
+    model.generation_config.eos_token_id = [EOS_ID] + [i for i in range(model.config.vocab_size) if i != EOS_ID]
+    llm = make_llm(model, tiny_tokenizer, batching=False)
+
+    async def run():
+        details = {}
+        text = await llm.generate_response(SYSTEM, MESSAGES, max_tokens=20, details=details)
+        chunks = [chunk async for chunk in llm.stream_response(SYSTEM, MESSAGES, max_tokens=20)]
+        return text, details, chunks
+
+    text, details, chunks = asyncio.run(run())
+    assert details["finish_reason"] == "eos"
+    assert details["completion_tokens"] == 0
+    assert text == ""
+    assert chunks == []
+
+
+def test_speculative_request_reports_its_acceptance(tiny_model, tiny_tokenizer):
+    llm = make_llm(tiny_model, tiny_tokenizer, speculative="prompt_lookup", stop_strings=())
+    llm.speculator = SpeculativeDecoder(tiny_model, eos_token_ids=llm._eos_token_ids(), device="cpu",
+                                        mode="prompt_lookup", lookahead=4, ngram_size=2)
+
+    details = {}
+    asyncio.run(llm.generate_response(SYSTEM, MESSAGES, max_tokens=20, details=details))
+    speculation = details["speculation"]
+    assert speculation["mode"] == "prompt_lookup"
+    assert 0 <= speculation["accepted"] <= speculation["drafted"]
+    assert speculation["tokens_per_pass"] >= 1
@@ -0,0 +1,93 @@
+import asyncio
+
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+
+import local_server
+from admission import AdmissionController
+from memory import LocalConversationMemory
+from user_sequencer import UserSequencer
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    """local_server with a fresh memory and the mock model (one request at a time)"""
+    monkeypatch.setattr(local_server, "memory", LocalConversationMemory(str(tmp_path / "conversations.json")))
+    monkeypatch.setattr(local_server, "mock_options", {"prefill_delay": 0.05, "token_delay": 0.05,
+                                                       "response_tokens": 40, "max_concurrency": 1})
+    monkeypatch.setattr(local_server, "startup", local_server.StartupState())
+    monkeypatch.setattr(local_server, "admission", AdmissionController())
+    monkeypatch.setattr(local_server, "sequencer", UserSequencer())
+    monkeypatch.setattr(local_server, "warmup_lengths", [])
+    return local_server
+
+
+async def started_client(server) -> TestClient:
+    client = TestClient(TestServer(await server.init_app()))
+    await client.start_server()
+    while not server.startup.ready:
+        await asyncio.sleep(0.05)
+    return client
+
+
+def test_rejected_turn_leaves_history_unchanged(server):
+    async def run():
+        client = await started_client(server)
+        try:
+            await client.post('/ask', json={'user': 'Linda', 'question': 'first'})
+            before = [dict(msg) for msg in server.memory.get_conversation_history('Linda')]
+
+            # Mike holds the only model slot; Linda's deadline passes while she waits for it
+            busy = asyncio.create_task(client.post('/ask', json={'user': 'Mike', 'question': 'long'}))
+            await asyncio.sleep(0.1)
+            stream = asyncio.create_task(client.post('/ask_stream', json={'user': 'Miguel', 'question': 'late'},
+                                                     headers={'X-Request-Timeout': '0.3'}))
+            rejected = await client.post('/ask', json={'user': 'Linda', 'question': 'late'},
+                                         headers={'X-Request-Timeout': '0.3'})
+            streamed = await (await stream).text()
+            assert (await busy).status == 200
+            assert '"error"' in streamed
+            return rejected.status, before
+        finally:
+            await client.close()
+
+    status, before = asyncio.run(run())
+    assert status == 503
+    history = server.memory.get_conversation_history('Linda')
+    assert [(msg['role'], msg['content']) for msg in history] == [(msg['role'], msg['content']) for msg in before]
+    assert server.memory.get_conversation_history('Miguel') == []
+    assert [msg['role'] for msg in server.memory.get_conversation_history('Mike')] == ['user', 'assistant']
+
+
+def test_answered_turn_stores_question_and_answer(server):
+    async def run():
+        client = await started_client(server)
+        try:
+            response = await client.post('/ask', json={'user': 'Linda', 'question': 'hello'})
+            return await response.json()
+        finally:
+            await client.close()
+
+    result = asyncio.run(run())
+    history = server.memory.get_conversation_history('Linda')
+    assert [(msg['role'], msg['content']) for msg in history] == [('user', 'hello'),
+                                                                  ('assistant', result['response'])]
+
+
+def test_response_cache_is_not_shared_between_users(server, monkeypatch):
+    """The local system prompt names the user, so two users' first answers are generated separately"""
+    monkeypatch.setitem(server.UserDataBase, 'Lena', server.UserDataBase['Linda'])
+    monkeypatch.setattr(server, "response_cache", server.ResponseCache())
+
+    async def run():
+        client = await started_client(server)
+        try:
+            for user in ('Linda', 'Lena', 'Linda'):
+                server.memory.clear_conversation(user)  # Same (empty) history every time
+                await client.post('/ask', json={'user': user, 'question': 'How do I study?'})
+        finally:
+            await client.close()
+
+    asyncio.run(run())
+    stats = server.response_cache.stats()
+    assert stats['hits'] == 1  # Linda's repeat only
@@ -0,0 +1,61 @@
+"""Prompts assembled from cached segment ids must equal tokenizing the whole conversation"""
+import pytest
+
+from context_builder import SUMMARY_PREFIX, ContextBuilder
+from local_llm import LlamaLocalLLM
+
+SYSTEM = "You are an expert University counselor AI assistant helping a university Student who name is Linda."
+
+# LlamaLocalLLM's prompt format as a chat template, so the reference ids come from the tokenizer alone
+CHAT_TEMPLATE = (
+    "{{ bos_token }}"
+    "{% for message in messages %}"
+    "{% if message['role'] == 'system' %}System: {{ message['content'] }}\n\n"
+    "{% elif message['role'] == 'user' %}User: {{ message['content'] }}\n\n"
+    "{% else %}Assistant: {{ message['content'] }}\n\n{% endif %}"
+    "{% endfor %}"
+    "{% if add_generation_prompt %}Assistant:{% endif %}"
+)
+
+SUMMARY = {"role": "summary", "content": "Linda is stressed about finals and works part-time. We agreed on a "
+                                         "study plan with 50 minute blocks.", "replaced_tokens": 900}
+TURNS = [
+    ("What are effective study techniques for finals?", "Try spaced repetition and practice tests."),
+    ("  I keep procrastinating... any tips?  ", "Start with a two minute task.\n\nThen keep going!"),
+    ("\nMy roommate's music is loud — 東京 café naïve 🎓", ""),
+    ("'s 'll numbers 12345 and symbols #@! ", "Ends with a tab\t"),
+    ("How do I talk to my professor about an extension?", "Email early, explain briefly and propose a date."),
+    ("Thanks! Anything else?", "Sleep well the night before the exam."),
+]
+
+
+def reference_ids(tokenizer, system_message, messages):
+    return tokenizer.apply_chat_template([{"role": "system", "content": system_message}] + messages,
+                                         chat_template=CHAT_TEMPLATE, add_generation_prompt=True,
+                                         tokenize=True, return_dict=False)
+
+
+# Budgets small enough that old turns are dropped and, on some turns, the oldest kept one is trimmed
+@pytest.mark.parametrize("token_budget", [310, 370])
+def test_segment_ids_match_full_tokenization(tiny_model, tiny_tokenizer, token_budget):
+    llm = LlamaLocalLLM(device="cpu", batching=False, max_context_tokens=10 ** 6)
+    llm.model = tiny_model
+    llm.setup_tokenizer(tiny_tokenizer)
+    assert llm.segment_cache is not None, "the tokenizer should pass matches_full_tokenization"
+    builder = ContextBuilder(llm.count_tokens, token_budget=token_budget, min_trimmed_tokens=8)
+
+    history = [dict(SUMMARY)]
+    saw_summary = saw_trimmed = False
+    for question, answer in TURNS:
+        messages = builder.build(SYSTEM, history) + [{"role": "user", "content": question}]
+        saw_summary |= messages[0]["content"].startswith(SUMMARY_PREFIX)
+        saw_trimmed |= any(message["content"].startswith("...") for message in messages)
+
+        expected = reference_ids(tiny_tokenizer, SYSTEM, messages)
+        assert llm.encode_conversation(SYSTEM, messages) == expected
+        assert llm._encode(llm._format_conversation(SYSTEM, messages)) == expected
+
+        history += [{"role": "user", "content": question}, {"role": "assistant", "content": answer}]
+
+    assert saw_summary and saw_trimmed
+    assert llm.segment_cache.hits > 0
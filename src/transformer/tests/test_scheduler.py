@@ -0,0 +1,107 @@
+"""Batched decoding must produce what decoding each prompt on its own would"""
+import asyncio
+import threading
+
+import pytest
+import torch
+
+import kv_cache
+from conftest import EOS_ID, PAD_ID
+from scheduler import ContinuousBatchScheduler
+
+# Prompts of different lengths, so the batch is left-padded and rows finish at different steps
+PROMPTS = [
+    [1, 17, 42],
+    [1, 5, 9, 33, 71, 120, 8, 250, 64, 3, 77],
+    [1, 200],
+    [1, 11, 12, 13, 14, 15, 16],
+    [1, 99, 98, 97, 96, 95, 94, 93, 92, 91, 90, 89, 88, 87, 86, 85, 84, 83, 82],
+    [1, 60, 61, 62, 63],
+]
+MAX_NEW_TOKENS = [12, 20, 5, 16, 9, 20]
+
+
+def greedy(model, input_ids, max_new_tokens):
+    """Sequential greedy decoding of one prompt, recomputing the whole sequence every step"""
+    generated = []
+    ids = torch.tensor([input_ids])
+    with torch.no_grad():
+        for _ in range(max_new_tokens):
+            token = int(model(input_ids=ids).logits[0, -1].argmax())
+            if token == EOS_ID:
+                break
+            generated.append(token)
+            ids = torch.cat([ids, torch.tensor([[token]])], dim=1)
+    return generated
+
+
+def make_scheduler(model, max_batch_size, **kwargs):
+    return ContinuousBatchScheduler(model, eos_token_ids=[EOS_ID], pad_token_id=PAD_ID, device="cpu",
+                                    model_lock=threading.Lock(), max_batch_size=max_batch_size, temperature=0,
+                                    **kwargs)
+
+
+@pytest.fixture(scope="module")
+def expected(tiny_model):
+    return [greedy(tiny_model, prompt, n) for prompt, n in zip(PROMPTS, MAX_NEW_TOKENS)]
+
+
+@pytest.mark.parametrize("max_batch_size", [1, 3, 8])
+def test_batched_greedy_matches_sequential(tiny_model, expected, max_batch_size):
+    scheduler = make_scheduler(tiny_model, max_batch_size)
+
+    async def run():
+        futures = [scheduler.submit(prompt, n) for prompt, n in zip(PROMPTS, MAX_NEW_TOKENS)]
+        return await asyncio.gather(*futures)
+
+    try:
+        results = asyncio.run(run())
+    finally:
+        scheduler.stop()
+    assert [request.generated for request in results] == expected
+
+
+def test_requests_joining_a_running_batch_match_sequential(tiny_model, expected):
+    scheduler = make_scheduler(tiny_model, max_batch_size=8)
+
+    async def run():
+        # Half the prompts start decoding before the rest are admitted into the running batch
+        first = [scheduler.submit(prompt, n) for prompt, n in zip(PROMPTS[::2], MAX_NEW_TOKENS[::2])]
+        while scheduler.active_count == 0:
+            await asyncio.sleep(0.001)
+        second = [scheduler.submit(prompt, n) for prompt, n in zip(PROMPTS[1::2], MAX_NEW_TOKENS[1::2])]
+        return await asyncio.gather(*first), await asyncio.gather(*second)
+
+    try:
+        first, second = asyncio.run(run())
+    finally:
+        scheduler.stop()
+    assert [request.generated for request in first] == expected[::2]
+    assert [request.generated for request in second] == expected[1::2]
+
+
+def test_prefix_cache_hit_counted_only_when_its_kv_states_are_used(tiny_model):
+    prefix_cache = kv_cache.PrefixKVCache()
+    scheduler = make_scheduler(tiny_model, max_batch_size=8, prefix_cache=prefix_cache,
+                               shared_prefix_cache=kv_cache.SharedPrefixCache())
+    first, second = PROMPTS[4][:12], PROMPTS[4]
+    with torch.no_grad():
+        owner_prefix = tiny_model(input_ids=torch.tensor([first[:2]]), use_cache=True).past_key_values
+    prefix_cache.store("linda", first[:2], kv_cache.to_legacy(owner_prefix))
+
+    async def run(prompt):
+        return await scheduler.submit(prompt, 4, cache_owner="linda", shared_prefix_key="student",
+                                      shared_prefix_ids=first[:6])
+
+    try:
+        # The shared prefix covers more than the owner's two cached tokens, so it is used instead
+        request = asyncio.run(run(first))
+        assert request.cached_tokens == 6
+        assert (prefix_cache.hits, prefix_cache.misses) == (0, 1)
+
+        # The next turn extends the cached conversation and resumes from the owner's own KV states
+        request = asyncio.run(run(second))
+        assert request.cached_tokens > 6
+        assert (prefix_cache.hits, prefix_cache.misses) == (1, 1)
+    finally:
+        scheduler.stop()